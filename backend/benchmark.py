@@ -0,0 +1,481 @@
+"""Local benchmark for generation and refinement throughput and latency.
+
+Drives ``SDXSPipeline`` and ``RefinerService`` directly and through the FastAPI
+app in-process over a matrix of sizes, steps, batch sizes, concurrency levels,
+dtypes, thread counts, CPU performance profiles and VAE decoders. By default it
+uses a tiny random-weight pipeline (only the tokenizer bundled under ``models/``
+is read), so it runs on CPU-only machines without downloading anything.
+``--full-size-vae`` builds the fast and large VAEs from the bundled SD-XS
+configs instead, so decode cost is measured at real model size (still with
+random weights).
+
+Usage:
+    python benchmark.py --sizes 64x64,128x128 --steps 2,4 --output results.json
+    python benchmark.py --workloads generate --vaes fast,large --full-size-vae --steps 1
+    python benchmark.py --cpu-profiles eager,channels_last,bf16,channels_last+bf16,compile
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+import psutil
+import torch
+from diffusers import AutoencoderKL, AutoencoderTiny, LCMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+from services.cpu_profile import CpuPerformanceProfile
+
+ROOT_DIR = Path(__file__).parent
+DEFAULT_MODEL_DIR = ROOT_DIR / 'models' / 'IDKiro_sdxs-512-0.9'
+DEFAULT_TOKENIZER = DEFAULT_MODEL_DIR / 'tokenizer'
+
+DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+# CPU profile names are "eager" or "+"-joined knobs, e.g. "channels_last+bf16"
+CPU_PROFILE_KNOBS = {
+    "channels_last": "channels_last",
+    "bf16": "bf16_autocast",
+    "compile": "torch_compile",
+}
+
+PROMPTS = [
+    "a lighthouse on a cliff at sunset",
+    "a cat sleeping on a windowsill",
+    "a bowl of ramen, studio lighting",
+    "a snowy mountain village at night",
+]
+
+def build_tiny_pipeline(
+    tokenizer_path: Path,
+    dtype: torch.dtype,
+    vae_config_dir: Path = None
+) -> StableDiffusionPipeline:
+    """Random-weight pipeline with the SD-XS layout (UNet, tiny VAE, CLIP text encoder) at toy size.
+    
+    With ``vae_config_dir``, the tiny VAE is built at full size from its config there.
+    """
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+        norm_num_groups=8,
+        attention_head_dim=4,
+    )
+    if vae_config_dir is not None:
+        vae = AutoencoderTiny.from_config(AutoencoderTiny.load_config(str(vae_config_dir / 'vae')))
+    else:
+        vae = AutoencoderTiny(
+            encoder_block_out_channels=(8, 8, 8, 8),
+            decoder_block_out_channels=(8, 8, 8, 8),
+            num_encoder_blocks=(1, 1, 1, 1),
+            num_decoder_blocks=(1, 1, 1, 1),
+        )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=2,
+        hidden_size=32,
+        intermediate_size=37,
+        layer_norm_eps=1e-05,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        pad_token_id=1,
+        vocab_size=49408,
+    ))
+    pipeline = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=CLIPTokenizer.from_pretrained(str(tokenizer_path)),
+        unet=unet,
+        scheduler=LCMScheduler(steps_offset=1),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline.to(dtype=dtype)
+
+def build_large_vae(dtype: torch.dtype, vae_config_dir: Path = None) -> AutoencoderKL:
+    """Random-weight stand-in for the SD-XS ``vae_large``, at toy size or from its config."""
+    torch.manual_seed(0)
+    if vae_config_dir is not None:
+        vae = AutoencoderKL.from_config(AutoencoderKL.load_config(str(vae_config_dir / 'vae_large')))
+    else:
+        vae = AutoencoderKL(
+            block_out_channels=(16, 16, 16, 16),
+            down_block_types=("DownEncoderBlock2D",) * 4,
+            up_block_types=("UpDecoderBlock2D",) * 4,
+            layers_per_block=1,
+            latent_channels=4,
+            norm_num_groups=8,
+        )
+    return vae.to(dtype=dtype)
+
+def build_cpu_profile(name: str, warmup_size: str) -> CpuPerformanceProfile:
+    """CPU performance profile for a benchmark profile name."""
+    knobs = [] if name == "eager" else name.split("+")
+    return CpuPerformanceProfile(warmup_size=warmup_size, **{CPU_PROFILE_KNOBS[knob]: True for knob in knobs})
+
+def percentile(values: List[float], pct: float) -> float:
+    """Linearly interpolated percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+class PeakRSSSampler:
+    """Samples process RSS on a background thread and keeps the maximum."""
+    
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def __enter__(self):
+        self.peak = self._process.memory_info().rss
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._process.memory_info().rss)
+
+class Benchmark:
+    """Runs benchmark scenarios against the server's services, in-process."""
+    
+    def __init__(self, args: argparse.Namespace, work_dir: Path):
+        # Seeded scenarios must render every time, and the image index belongs in the work dir, not backend/data
+        os.environ['RESULT_CACHE'] = 'false'
+        os.environ['IMAGE_INDEX_PATH'] = str(work_dir / 'images.sqlite3')
+        # Imported here so env overrides from the command line apply to the services
+        import server
+        self.server = server
+        self.args = args
+        self.work_dir = work_dir
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=server.app),
+            base_url="http://benchmark",
+            timeout=None
+        )
+        self.source_images: Dict[str, str] = {}
+        self.setup_seconds: Dict[str, float] = {}  # repo id: time to build, optimize and warm up
+        
+        # Keep benchmark output out of the real image directories
+        images_dir = work_dir / 'images'
+        refined_dir = images_dir / 'refined'
+        refined_dir.mkdir(parents=True)
+        server.IMAGES_DIR = images_dir
+        server.REFINED_IMAGES_DIR = refined_dir
+        server.sdxs_pipeline.images_dir = images_dir
+        server.refiner_service.images_dir = images_dir
+        server.refiner_service.refined_images_dir = refined_dir
+        server.image_storage.roots = [images_dir.resolve(), refined_dir.resolve()]
+    
+    async def use_model(self, dtype_name: str, profile_name: str) -> str:
+        """Make the pipeline for a dtype and CPU profile active, building it on first use."""
+        server = self.server
+        repo_id = f"benchmark/tiny-{dtype_name}-{profile_name}"
+        profile = build_cpu_profile(profile_name, self.args.sizes[0])
+        server.inference_executor.cpu_profile = profile
+        if server.model_loader.is_loaded(repo_id):
+            # Resident pipelines are reactivated without reloading
+            await server.model_loader.load_model(repo_id, None)
+        else:
+            start = time.perf_counter()
+            vae_config_dir = self.args.model_dir if self.args.full_size_vae else None
+            pipeline = build_tiny_pipeline(self.args.tokenizer, DTYPES[dtype_name], vae_config_dir)
+            profile.optimize_pipeline(pipeline)
+            large_vae = None
+            if "large" in self.args.vaes:
+                large_vae = profile.optimize_vae(build_large_vae(DTYPES[dtype_name], vae_config_dir))
+                profile.warmup_vae(large_vae)
+            self.setup_seconds[repo_id] = time.perf_counter() - start
+            server.model_loader.set_pipeline(repo_id, pipeline, large_vae)
+        server.refiner_service.set_sdxs_pipeline(server.model_loader.get_pipeline(), repo_id)
+        return repo_id
+    
+    async def source_image(self, dtype_name: str, size: str) -> str:
+        """Filename of a generated image to refine, one per dtype and size."""
+        key = f"{dtype_name}:{size}"
+        if key not in self.source_images:
+            path = await self.server.sdxs_pipeline.generate(prompt=PROMPTS[0], size=size, steps=1, seed=0)
+            self.source_images[key] = Path(path).name
+        return self.source_images[key]
+    
+    async def request(self, scenario: dict, index: int, source: str = None):
+        """Issue one generate or refine request for a scenario."""
+        server = self.server
+        prompt = PROMPTS[index % len(PROMPTS)]
+        
+        if scenario["workload"] == "generate":
+            if scenario["mode"] == "direct":
+                await server.sdxs_pipeline.generate(
+                    prompt=prompt,
+                    size=scenario["size"],
+                    steps=scenario["steps"],
+                    guidance=self.args.guidance,
+                    seed=index,
+                    vae=scenario["vae"]
+                )
+            else:
+                response = await self.client.post("/api/generate", json={
+                    "prompt": prompt,
+                    "size": scenario["size"],
+                    "steps": scenario["steps"],
+                    "guidance": self.args.guidance,
+                    "seed": index,
+                    "vae": scenario["vae"]
+                })
+                response.raise_for_status()
+        else:
+            if scenario["mode"] == "direct":
+                await server.refiner_service.refine_image(
+                    original_image_filename=source,
+                    refinement_prompt=prompt,
+                    model_type="sdxs",
+                    strength=self.args.strength,
+                    steps=scenario["steps"],
+                    guidance=self.args.guidance,
+                    seed=index,
+                    vae=scenario["vae"]
+                )
+            else:
+                response = await self.client.post("/api/refiner/refine", json={
+                    "originalImageFilename": source,
+                    "refinementPrompt": prompt,
+                    "modelType": "sdxs",
+                    "strength": self.args.strength,
+                    "steps": scenario["steps"],
+                    "guidance": self.args.guidance,
+                    "seed": index,
+                    "vae": scenario["vae"]
+                })
+                response.raise_for_status()
+    
+    async def run_scenario(self, scenario: dict) -> dict:
+        server = self.server
+        torch.set_num_threads(scenario["threads"])
+        repo_id = await self.use_model(scenario["dtype"], scenario["cpuProfile"])
+        for view in ("sdxs-img2img", "sdxs-img2img-vae_large"):
+            if server.model_pool.contains((view, repo_id)):
+                server.model_pool.get((view, repo_id)).set_progress_bar_config(disable=True)
+        server.generation_batcher.max_batch_size = scenario["batchSize"] or 1
+        
+        source = None
+        if scenario["workload"] == "refine":
+            source = await self.source_image(scenario["dtype"], scenario["size"])
+        
+        for i in range(self.args.warmup):
+            await self.request(scenario, i, source)
+        
+        latencies: List[float] = []
+        errors: List[str] = []
+        counter = itertools.count()
+        
+        async def worker():
+            while True:
+                index = next(counter)
+                if index >= self.args.requests:
+                    return
+                start = time.perf_counter()
+                try:
+                    await self.request(scenario, index, source)
+                    latencies.append(time.perf_counter() - start)
+                except Exception as e:
+                    errors.append(str(e))
+        
+        with PeakRSSSampler() as rss:
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(scenario["concurrency"])))
+            wall = time.perf_counter() - start
+        
+        result = dict(scenario)
+        result.update({
+            "requests": self.args.requests,
+            "errors": len(errors),
+            "wallSeconds": wall,
+            "imagesPerSecond": len(latencies) / wall if wall > 0 else 0.0,
+            "peakRssBytes": rss.peak,
+            "setupSeconds": self.setup_seconds.get(repo_id),
+        })
+        if latencies:
+            result.update({
+                "latencyP50": percentile(latencies, 50),
+                "latencyP95": percentile(latencies, 95),
+                "latencyP99": percentile(latencies, 99),
+                "latencyMean": sum(latencies) / len(latencies),
+            })
+        if errors:
+            result["firstError"] = errors[0]
+        return result
+    
+    def scenarios(self) -> List[dict]:
+        args = self.args
+        scenarios = []
+        for workload, mode, dtype, profile, threads, vae, size, steps, concurrency in itertools.product(
+            args.workloads, args.modes, args.dtypes, args.cpu_profiles, args.threads, args.vaes, args.sizes,
+            args.steps, args.concurrency
+        ):
+            # Refinement is not micro-batched, so batch size does not apply to it
+            batch_sizes = args.batch_sizes if workload == "generate" else [None]
+            for batch_size in batch_sizes:
+                scenarios.append({
+                    "workload": workload,
+                    "mode": mode,
+                    "dtype": dtype,
+                    "cpuProfile": profile,
+                    "threads": threads,
+                    "vae": vae,
+                    "size": size,
+                    "steps": steps,
+                    "batchSize": batch_size,
+                    "concurrency": concurrency,
+                })
+        return scenarios
+    
+    async def run(self) -> List[dict]:
+        results = []
+        scenarios = self.scenarios()
+        try:
+            for i, scenario in enumerate(scenarios, 1):
+                result = await self.run_scenario(scenario)
+                results.append(result)
+                print(format_result(i, len(scenarios), result), flush=True)
+        finally:
+            await self.client.aclose()
+            self.server.inference_executor.shutdown()
+            self.server.image_store.shutdown()
+            self.server.image_storage.close()
+        return results
+
+def format_result(index: int, total: int, result: dict) -> str:
+    label = (
+        f"[{index}/{total}] {result['workload']:<8} {result['mode']:<6} {result['dtype']:<8} "
+        f"profile={result['cpuProfile']} "
+        f"threads={result['threads']} vae={result['vae']} size={result['size']} steps={result['steps']} "
+        f"batch={result['batchSize'] or '-'} conc={result['concurrency']}"
+    )
+    if "latencyP50" not in result:
+        return f"{label}  FAILED: {result.get('firstError')}"
+    return (
+        f"{label}  p50={result['latencyP50'] * 1000:.1f}ms p95={result['latencyP95'] * 1000:.1f}ms "
+        f"p99={result['latencyP99'] * 1000:.1f}ms {result['imagesPerSecond']:.2f} img/s "
+        f"rss={result['peakRssBytes'] / 1024 ** 2:.0f}MB"
+    )
+
+def environment_info() -> dict:
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "cpuCount": os.cpu_count(),
+        "cuda": torch.cuda.is_available(),
+    }
+
+def parse_list(cast):
+    return lambda value: [cast(v.strip()) for v in value.split(",") if v.strip()]
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark generation and refinement in-process")
+    parser.add_argument("--workloads", type=parse_list(str), default=["generate", "refine"],
+                        help="Comma-separated workloads: generate, refine")
+    parser.add_argument("--modes", type=parse_list(str), default=["direct", "api"],
+                        help="direct calls the services, api goes through the FastAPI app")
+    parser.add_argument("--sizes", type=parse_list(str), default=["64x64", "128x128"])
+    parser.add_argument("--steps", type=parse_list(int), default=[2, 4])
+    parser.add_argument("--batch-sizes", type=parse_list(int), default=[1, 4],
+                        help="Maximum micro-batch size for generate requests")
+    parser.add_argument("--concurrency", type=parse_list(int), default=[1, 4],
+                        help="Number of requests kept in flight")
+    parser.add_argument("--dtypes", type=parse_list(str), default=["float32"],
+                        help=f"Comma-separated dtypes: {', '.join(DTYPES)}")
+    parser.add_argument("--threads", type=parse_list(int), default=[torch.get_num_threads()],
+                        help="torch intra-op thread counts")
+    parser.add_argument("--cpu-profiles", type=parse_list(str), default=["eager"],
+                        help="Comma-separated CPU profiles: eager, or knobs joined by '+' "
+                             f"({', '.join(CPU_PROFILE_KNOBS)}), e.g. channels_last+bf16")
+    parser.add_argument("--vaes", type=parse_list(str), default=["fast"],
+                        help="Comma-separated VAE decoders: fast (tiny VAE), large")
+    parser.add_argument("--full-size-vae", action="store_true",
+                        help="Build both VAEs at full size from the bundled configs to measure real decode cost")
+    parser.add_argument("--requests", type=int, default=8, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured requests per scenario")
+    parser.add_argument("--guidance", type=float, default=1.0)
+    parser.add_argument("--strength", type=float, default=0.75)
+    parser.add_argument("--tokenizer", type=Path, default=DEFAULT_TOKENIZER)
+    parser.add_argument("--model-dir", type=Path, default=DEFAULT_MODEL_DIR,
+                        help="Checkpoint directory whose VAE configs --full-size-vae uses")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--verbose", action="store_true", help="Keep server INFO logging")
+    args = parser.parse_args(argv)
+    
+    unknown = [d for d in args.dtypes if d not in DTYPES]
+    if unknown:
+        parser.error(f"Unsupported dtypes: {', '.join(unknown)}")
+    unknown = [w for w in args.workloads if w not in ("generate", "refine")]
+    if unknown:
+        parser.error(f"Unknown workloads: {', '.join(unknown)}")
+    unknown = [p for p in args.cpu_profiles if p != "eager" and not set(p.split("+")) <= set(CPU_PROFILE_KNOBS)]
+    if unknown:
+        parser.error(f"Unknown CPU profiles: {', '.join(unknown)}")
+    unknown = [v for v in args.vaes if v not in ("fast", "large")]
+    if unknown:
+        parser.error(f"Unknown VAEs: {', '.join(unknown)}")
+    unknown = [m for m in args.modes if m not in ("direct", "api")]
+    if unknown:
+        parser.error(f"Unknown modes: {', '.join(unknown)}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    with tempfile.TemporaryDirectory(prefix="sdxs-benchmark-") as work_dir:
+        benchmark = Benchmark(args, Path(work_dir))
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        
+        results = asyncio.run(benchmark.run())
+    
+    report = {
+        "environment": environment_info(),
+        "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        # ru_maxrss is in KiB on Linux
+        "processPeakRssBytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "results": results,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
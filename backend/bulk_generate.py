@@ -0,0 +1,111 @@
+"""Render a JSONL or CSV prompt file in bulk, without going through HTTP.
+
+Loads the model and services exactly as the server does (``.env`` settings
+included, e.g. ``INFERENCE_WORKERS``), then renders every row through
+``SDXSPipeline`` and its batcher. Rows are sorted into (size, steps, guidance,
+VAE) buckets so batches stay full. The output folder gets ``images/``,
+``run.json`` and ``manifest.jsonl`` with one line per finished prompt.
+
+Each JSONL line (or CSV row) takes the generate request fields, e.g.
+``{"id": "cat-1", "prompt": "a cat", "size": "512x512", "steps": 1, "seed": 7, "numImages": 2}``.
+Missing fields fall back to the command-line defaults.
+
+Re-running the same command resumes: prompts the manifest lists as completed
+are skipped, failed ones are retried.
+
+Usage:
+    python bulk_generate.py prompts.jsonl --output data/bulk/cats --repo-id IDKiro/sdxs-512-0.9
+    python bulk_generate.py prompts.csv --output runs/regression --size 256x256 --steps 1 --vae large
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from pathlib import Path
+
+from services.bulk_jobs import BULK_INPUT_FORMATS, BulkGenerator, BulkRun
+from services.model_loader import VAE_MODES
+
+logger = logging.getLogger("bulk_generate")
+
+PROGRESS_INTERVAL_SECONDS = 10.0
+
+async def log_progress(run: BulkRun):
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+        done = run.skipped + run.completed + run.failed
+        logger.info(f"{done}/{run.total} prompts done ({run.failed} failed), {run.images} image(s)")
+
+async def run_bulk(args: argparse.Namespace) -> BulkRun:
+    import server
+    
+    defaults = {"size": args.size, "steps": args.steps, "guidance": args.guidance, "vae": args.vae}
+    run = BulkRun(args.output, args.input.resolve(), args.format, args.repo_id, defaults)
+    if (args.output / "run.json").is_file():
+        previous = BulkRun.load(args.output)
+        run.id, run.created_at = previous.id, previous.created_at
+        logger.info(f"Resuming run {run.id} in {args.output}")
+    
+    # No admission control: the whole process belongs to this run
+    generator = BulkGenerator(
+        server.sdxs_pipeline,
+        concurrency=args.concurrency or server.bulk_generator.concurrency,
+        max_images=server.GENERATE_MAX_IMAGES
+    )
+    # Invalid rows fail here, before any model is loaded
+    generator.validate(run)
+    
+    await server.start_inference_workers()
+    try:
+        # Downloads only if the model is not under MODELS_DIR yet
+        model_path = await server.hf_downloader.download_model(args.repo_id)
+        await server.model_loader.load_model(args.repo_id, model_path)
+        if server.inference_workers is not None:
+            await server.inference_workers.load(args.repo_id)
+        if args.vae == "large" and not server.model_loader.has_large_vae(args.repo_id):
+            raise SystemExit(f"{args.repo_id} does not ship a large VAE")
+        
+        reporter = asyncio.ensure_future(log_progress(run))
+        try:
+            await generator.run(run)
+        finally:
+            reporter.cancel()
+        return run
+    finally:
+        await server.shutdown_inference()
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Render a JSONL or CSV prompt file in bulk")
+    parser.add_argument("input", type=Path, help="JSONL or CSV prompt file")
+    parser.add_argument("--output", type=Path, required=True,
+                        help="Run folder for images and the manifest; re-use it to resume")
+    parser.add_argument("--format", choices=BULK_INPUT_FORMATS,
+                        help="Input format; defaults to the file extension")
+    parser.add_argument("--repo-id", default="IDKiro/sdxs-512-0.9", help="SD-XS model to render with")
+    parser.add_argument("--size", default="512x512")
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--guidance", type=float, default=4.0)
+    parser.add_argument("--vae", choices=VAE_MODES, default="fast")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="Prompts in flight; defaults to BULK_CONCURRENCY or the batch size times workers")
+    args = parser.parse_args(argv)
+    
+    if not args.input.is_file():
+        parser.error(f"No such file: {args.input}")
+    args.format = args.format or ("csv" if args.input.suffix.lower() == ".csv" else "jsonl")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        run = asyncio.run(run_bulk(args))
+    except ValueError as e:
+        sys.exit(f"Invalid input: {e}")
+    
+    print(json.dumps(run.to_dict(), indent=2))
+    print(f"Manifest written to {run.manifest_path}")
+    sys.exit(1 if run.failed else 0)
+
+if __name__ == "__main__":
+    main()
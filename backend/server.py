@@ -1,19 +1,49 @@
-from fastapi import FastAPI, APIRouter, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+import asyncio
 import os
+import json
+import base64
 import logging
+import time
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from pydantic import BaseModel
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 import uuid
+import psutil
+import torch
 
+from services.admission import AdmissionController, AdmissionRejected
+from services.autoload import ModelAutoloader, parse_autoload_config
+from services.background import spawn
+from services.batcher import GenerationBatcher
+from services.bulk_jobs import BULK_INPUT_FORMATS, BulkGenerator, BulkInputTooLarge, BulkRunManager
+from services.cpu_profile import CpuPerformanceProfile
+from services.derivatives import DerivativeStore
+from services.fast_load import PipelineSnapshots
 from services.hf_downloader import HFDownloader
-from services.model_loader import ModelLoader
+from services.image_cache import ImageCache, last_modified_header
+from services.image_storage import ImageStorage
+from services.image_store import IMAGE_FORMATS, ImageStore
+from services.inference_executor import InferenceExecutor
+from services.inference_jobs import InferenceJobManager
+from services.job_store import InferenceJob, create_job_store
+from services.latent_cache import LatentCache
+from services.metrics import RequestMetricsMiddleware, metrics
+from services.model_loader import ModelLoader, VAE_MODES
+from services.model_pool import ModelPool
 from services.pipeline import SDXSPipeline
+from services.prepare_jobs import PrepareJob, PrepareJobManager
+from services.previews import StepProgress
+from services.prompt_cache import PromptEmbeddingCache
 from services.refiner import RefinerService
+from services.result_cache import ResultCache, model_fingerprint
+from services.warmup import ModelWarmup
+from services.worker_pool import InferenceWorkerPool
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -22,6 +52,7 @@ load_dotenv(ROOT_DIR / '.env')
 MODELS_DIR = ROOT_DIR / 'models'
 IMAGES_DIR = ROOT_DIR / 'data' / 'images'
 REFINED_IMAGES_DIR = ROOT_DIR / 'data' / 'images' / 'refined'
+BULK_DIR = ROOT_DIR / 'data' / 'bulk'
 MODELS_DIR.mkdir(parents=True, exist_ok=True)
 IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 REFINED_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
@@ -30,11 +61,246 @@ REFINED_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
+def _env_flag(name: str, default: str = 'false') -> bool:
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
 # Initialize services
+# CPU tuning; thread pools must be sized before any inference runs
+cpu_profile = CpuPerformanceProfile(
+    intra_op_threads=int(os.environ.get('CPU_THREADS', '0')),
+    inter_op_threads=int(os.environ.get('CPU_INTEROP_THREADS', '0')),
+    channels_last=_env_flag('CPU_CHANNELS_LAST'),
+    bf16_autocast=_env_flag('CPU_BF16_AUTOCAST'),
+    torch_compile=_env_flag('CPU_COMPILE'),
+    compile_mode=os.environ.get('CPU_COMPILE_MODE') or None,
+    warmup_size=os.environ.get('CPU_WARMUP_SIZE', '512x512'),
+    warmup_steps=int(os.environ.get('CPU_WARMUP_STEPS', '1'))
+)
+cpu_profile.apply_threads()
 hf_downloader = HFDownloader(MODELS_DIR)
-model_loader = ModelLoader()
-sdxs_pipeline = SDXSPipeline(model_loader, IMAGES_DIR)
-refiner_service = RefinerService(MODELS_DIR, IMAGES_DIR, REFINED_IMAGES_DIR)
+model_pool = ModelPool(
+    budget_bytes=int(os.environ.get('MODEL_POOL_BUDGET_MB', '0')) * 1024 * 1024,
+    offload_budget_bytes=int(os.environ.get('MODEL_POOL_OFFLOAD_BUDGET_MB', '0')) * 1024 * 1024
+)
+# Weights are memory-mapped from safetensors; snapshots keep serving-dtype copies for faster reloads.
+# Worker processes share weights by mapping the same snapshot, so they always need one
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', '0'))
+FAST_LOAD = _env_flag('FAST_LOAD', 'true')
+pipeline_snapshots = (
+    PipelineSnapshots(MODELS_DIR / '.snapshots') if _env_flag('MODEL_SNAPSHOTS') or INFERENCE_WORKERS else None
+)
+model_loader = ModelLoader(
+    model_pool,
+    load_large_vae=_env_flag('LOAD_LARGE_VAE', 'true'),
+    cpu_profile=cpu_profile,
+    fast_load=FAST_LOAD,
+    snapshots=pipeline_snapshots
+)
+
+# Decoder used when a request does not pick one: the tiny VAE keeps plain
+# generation fast, the large VAE gives refined finals full detail
+GENERATE_VAE = os.environ.get('GENERATE_VAE', 'fast')
+REFINE_VAE = os.environ.get('REFINE_VAE', 'large')
+# Images a single generate request may ask for; they run in chunks of GENERATE_MAX_BATCH_SIZE
+GENERATE_MAX_IMAGES = int(os.environ.get('GENERATE_MAX_IMAGES', '8'))
+prepare_jobs = PrepareJobManager()
+inference_executor = InferenceExecutor(cpu_profile, model_pool)
+prompt_cache = PromptEmbeddingCache(
+    max_entries=int(os.environ.get('PROMPT_CACHE_MAX_ENTRIES', '256')),
+    max_bytes=int(os.environ.get('PROMPT_CACHE_MAX_MB', '64')) * 1024 * 1024
+)
+WARMUP_SIZES = [s.strip() for s in os.environ.get('WARMUP_SIZES', '512x512').split(',') if s.strip()]
+WARMUP_BATCH_SIZES = [int(b) for b in os.environ.get('WARMUP_BATCH_SIZES', '1').split(',') if b.strip()]
+WARMUP_STEPS = int(os.environ.get('WARMUP_STEPS', '1'))
+WARMUP_VAES = [v.strip() for v in os.environ.get('WARMUP_VAES', GENERATE_VAE).split(',') if v.strip()]
+# Supervisor mode: generation batches run in worker processes, refinement stays in this one
+inference_workers = InferenceWorkerPool(
+    INFERENCE_WORKERS,
+    pipeline_snapshots.root,
+    hf_downloader.local_path,
+    cpu_profile,
+    threads_per_worker=int(os.environ.get('INFERENCE_WORKER_THREADS', '0')),
+    load_large_vae=_env_flag('LOAD_LARGE_VAE', 'true'),
+    pool_budget_bytes=model_pool.budget_bytes,
+    prompt_cache_entries=prompt_cache.max_entries,
+    prompt_cache_bytes=prompt_cache.max_bytes,
+    warmup_sizes=WARMUP_SIZES,
+    warmup_batch_sizes=WARMUP_BATCH_SIZES,
+    warmup_steps=WARMUP_STEPS,
+    warmup_vaes=WARMUP_VAES
+) if INFERENCE_WORKERS > 0 else None
+generation_batcher = GenerationBatcher(
+    inference_executor,
+    prompt_cache,
+    window_ms=float(os.environ.get('GENERATE_BATCH_WINDOW_MS', '20')),
+    max_batch_size=int(os.environ.get('GENERATE_MAX_BATCH_SIZE', '4')),
+    workers=inference_workers
+)
+# Enough concurrent slots by default to fill a generation batch on every worker
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get(
+        'ADMISSION_MAX_CONCURRENT', str(generation_batcher.max_batch_size * max(1, INFERENCE_WORKERS))
+    )),
+    max_queue_depth=int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', '32')),
+    default_deadline_ms=float(os.environ.get('ADMISSION_DEFAULT_DEADLINE_MS', '0'))
+)
+image_cache = ImageCache(max_bytes=int(os.environ.get('IMAGE_CACHE_MAX_MB', '128')) * 1024 * 1024)
+image_storage = ImageStorage(
+    Path(os.environ.get('IMAGE_INDEX_PATH', str(ROOT_DIR / 'data' / 'images.sqlite3'))),
+    [IMAGES_DIR, REFINED_IMAGES_DIR],
+    shard_depth=int(os.environ.get('IMAGE_SHARD_DEPTH', '2')),
+    max_age_days=float(os.environ.get('IMAGE_RETENTION_DAYS', '0')),
+    max_bytes=int(os.environ.get('IMAGE_QUOTA_MB', '0')) * 1024 * 1024,
+    on_delete=lambda directory, filename: _forget_image(directory, filename),
+    migrate_flat=_env_flag('IMAGE_MIGRATE_FLAT')
+)
+IMAGE_RETENTION_INTERVAL_S = float(os.environ.get('IMAGE_RETENTION_INTERVAL_S', '3600'))
+image_store = ImageStore(
+    image_cache,
+    image_format=os.environ.get('IMAGE_FORMAT', 'png'),
+    png_compress_level=int(os.environ.get('PNG_COMPRESS_LEVEL', '6')),
+    quality=int(os.environ.get('IMAGE_QUALITY', '90')),
+    max_workers=int(os.environ.get('IMAGE_WRITE_WORKERS', '2')),
+    max_pending=int(os.environ.get('IMAGE_MAX_PENDING', '64')),
+    storage=image_storage
+)
+derivative_store = DerivativeStore(
+    image_store,
+    widths=[int(width) for width in os.environ.get('DERIVATIVE_WIDTHS', '128,256,512,1024').split(',') if width.strip()],
+    quality=int(os.environ.get('DERIVATIVE_QUALITY', '80')),
+    max_workers=int(os.environ.get('DERIVATIVE_WORKERS', '2'))
+)
+DERIVATIVE_FORMAT = os.environ.get('DERIVATIVE_FORMAT', 'webp')
+
+def _forget_image(directory: Path, filename: str):
+    # Retention deleted an image: drop it from memory, flat or sharded, and delete its derivatives
+    image_cache.remove(directory / filename)
+    image_cache.remove(image_storage.shard_path(directory, filename))
+    derivative_store.remove(directory, filename)
+
+sdxs_pipeline = SDXSPipeline(model_loader, IMAGES_DIR, generation_batcher, image_store)
+result_cache = ResultCache(
+    Path(os.environ.get('RESULT_CACHE_PATH', str(ROOT_DIR / 'data' / 'result_cache.sqlite3'))),
+    ROOT_DIR / 'data',
+    max_entries=int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '10000')),
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_MB', '1024')) * 1024 * 1024,
+    # Follows images moved into their shard; images still being written count as present
+    locate=image_store.locate
+) if _env_flag('RESULT_CACHE', 'true') else None
+bulk_generator = BulkGenerator(
+    sdxs_pipeline,
+    # Enough rows in flight to keep every worker's batches full
+    concurrency=int(os.environ.get('BULK_CONCURRENCY', '0'))
+    or generation_batcher.max_batch_size * max(1, INFERENCE_WORKERS),
+    admission=admission,
+    priority=int(os.environ.get('BULK_PRIORITY', '-1')),
+    max_images=GENERATE_MAX_IMAGES
+)
+bulk_runs = BulkRunManager(
+    BULK_DIR,
+    bulk_generator,
+    max_input_bytes=int(os.environ.get('BULK_MAX_UPLOAD_MB', '64')) * 1024 * 1024
+)
+latent_cache = LatentCache(
+    max_entries=int(os.environ.get('LATENT_CACHE_MAX_ENTRIES', '64')),
+    max_bytes=int(os.environ.get('LATENT_CACHE_MAX_MB', '64')) * 1024 * 1024
+)
+refiner_service = RefinerService(
+    MODELS_DIR, IMAGES_DIR, REFINED_IMAGES_DIR, inference_executor, prompt_cache, model_pool, image_store, latent_cache,
+    cpu_profile=cpu_profile,
+    fast_load=FAST_LOAD,
+    snapshots=pipeline_snapshots
+)
+inference_jobs = InferenceJobManager(
+    create_job_store(
+        os.environ.get('JOB_STORE', 'memory'),
+        Path(os.environ.get('JOB_STORE_PATH', str(ROOT_DIR / 'data' / 'jobs.sqlite3')))
+    ),
+    admission,
+    max_finished_jobs=int(os.environ.get('JOB_MAX_FINISHED', '1000')),
+    preview_every=int(os.environ.get('JOB_PREVIEW_EVERY', '1'))
+)
+# Dummy generations run after each model load, before the server reports ready
+model_warmup = ModelWarmup(
+    inference_executor,
+    prompt_cache,
+    sizes=WARMUP_SIZES,
+    batch_sizes=WARMUP_BATCH_SIZES,
+    steps=WARMUP_STEPS
+)
+# Models loaded from MODELS_DIR at startup, without touching the network
+model_autoloader = ModelAutoloader(parse_autoload_config(
+    os.environ.get('AUTOLOAD_MODELS', ''),
+    Path(os.environ['AUTOLOAD_CONFIG']) if os.environ.get('AUTOLOAD_CONFIG') else None
+))
+
+# Metrics gauges, evaluated on each scrape of /api/metrics
+process = psutil.Process()
+
+def _model_pool_entries():
+    return [
+        ({"model_type": entry["modelType"], "repo_id": entry["repoId"], "device": entry["device"]},
+         0 if entry["offloaded"] else 1)
+        for entry in model_pool.stats()["entries"]
+    ]
+
+metrics.describe("model_pool_evictions_total", "counter", "Pipelines dropped from the model pool")
+metrics.gauge(
+    "queue_depth",
+    "Work waiting for inference: prompts waiting for a batch and calls queued for the inference thread",
+    lambda: [
+        ({"queue": "batcher"}, generation_batcher.pending_count()),
+        ({"queue": "inference"}, inference_executor.queue_depth())
+    ]
+)
+metrics.gauge("ready", "1 once a model is loaded and warmed up", lambda: 1 if _is_ready() else 0)
+metrics.gauge("inference_in_flight", "Inference calls queued or running", inference_executor.in_flight)
+if inference_workers is not None:
+    metrics.gauge(
+        "inference_worker_in_flight",
+        "Calls sent to each inference worker and not yet answered",
+        lambda: [({"worker": w["index"]}, w["inFlight"]) for w in inference_workers.stats()["workers"]]
+    )
+metrics.gauge("admission_queue_depth", "Requests waiting for an inference slot", admission.queue_depth)
+metrics.gauge("admission_active", "Requests holding an inference slot", admission.active)
+metrics.gauge("model_pool_resident_bytes", "Unique weight bytes held by on-device pipelines", model_pool.resident_bytes)
+metrics.gauge(
+    "model_pool_offloaded_bytes",
+    "Unique weight bytes of pipelines offloaded to CPU",
+    lambda: model_pool.resident_bytes(offloaded=True)
+)
+metrics.gauge("model_pool_entry_resident", "1 if a pooled pipeline is on its device, 0 if offloaded", _model_pool_entries)
+metrics.gauge("process_resident_memory_bytes", "Resident set size of the server process", lambda: process.memory_info().rss)
+metrics.gauge("process_virtual_memory_bytes", "Virtual memory size of the server process", lambda: process.memory_info().vms)
+if result_cache is not None:
+    metrics.gauge("result_cache_entries", "Deterministic requests with a cached result", lambda: result_cache.stats()["entries"])
+if torch.cuda.is_available():
+    metrics.gauge("cuda_memory_allocated_bytes", "CUDA memory allocated by tensors", torch.cuda.memory_allocated)
+    metrics.gauge("cuda_memory_reserved_bytes", "CUDA memory reserved by the caching allocator", torch.cuda.memory_reserved)
+metrics.gauge("image_cache_bytes", "Bytes held by the in-memory image cache", lambda: image_cache.stats()["bytes"])
+metrics.gauge("image_storage_bytes", "Bytes of generated and refined images on disk", lambda: image_storage.stats()["bytes"])
+metrics.gauge("image_storage_images", "Generated and refined images on disk", lambda: image_storage.stats()["images"])
+metrics.gauge(
+    "cache_hits_total",
+    "Cache hits since startup",
+    lambda: [
+        ({"cache": "prompt"}, prompt_cache.hits),
+        ({"cache": "image"}, image_cache.hits),
+        ({"cache": "latent"}, latent_cache.hits)
+    ] + ([({"cache": "result"}, result_cache.hits)] if result_cache is not None else []),
+    metric_type="counter"
+)
+metrics.gauge(
+    "cache_misses_total",
+    "Cache misses since startup",
+    lambda: [
+        ({"cache": "prompt"}, prompt_cache.misses),
+        ({"cache": "image"}, image_cache.misses),
+        ({"cache": "latent"}, latent_cache.misses)
+    ] + ([({"cache": "result"}, result_cache.misses)] if result_cache is not None else []),
+    metric_type="counter"
+)
+model_pool.add_evict_listener(lambda key: metrics.inc("model_pool_evictions_total", model_type=key[0]))
 
 # Models
 class ModelPrepareRequest(BaseModel):
@@ -43,19 +309,47 @@ class ModelPrepareRequest(BaseModel):
 class ModelPrepareResponse(BaseModel):
     ok: bool
     repoId: str
+    jobId: str
+    status: str
+    message: str
+
+class PrepareJobResponse(BaseModel):
+    jobId: str
+    repoId: str
+    kind: str  # "model" or "refiner"
+    status: str  # "queued", "running", "completed" or "failed"
+    phase: str  # "queued", "downloading", "loading", "warming" or "ready"
     message: str
+    error: Optional[str] = None
+    bytesDownloaded: int = 0
+    bytesTotal: Optional[int] = None
+    filesDone: int = 0
+    filesTotal: Optional[int] = None
 
 class GenerateRequest(BaseModel):
     prompt: str
+    negativePrompt: Optional[str] = None
     size: Optional[str] = '512x512'
     steps: Optional[int] = 8
     guidance: Optional[float] = 4.0
     seed: Optional[int] = None
+    numImages: Optional[int] = None  # Images to generate, seeded seed, seed + 1, ... when seed is set
+    seeds: Optional[List[int]] = None  # One image per seed, instead of seed and numImages
+    repoId: Optional[str] = None  # Resident model to use instead of the active one
+    vae: Optional[str] = None  # "fast" (tiny VAE) or "large"; defaults to GENERATE_VAE
+    priority: Optional[int] = 0  # Higher values are served first when queued
+    deadlineMs: Optional[int] = None  # Give up if not started within this time
+
+class GeneratedImage(BaseModel):
+    imagePath: str
+    filename: str
+    seed: int
 
 class GenerateResponse(BaseModel):
     ok: bool
-    imagePath: str
+    imagePath: str  # First image, for single-image clients
     filename: str
+    images: List[GeneratedImage]
 
 class RefinerPrepareRequest(BaseModel):
     modelCardUrl: str
@@ -65,21 +359,54 @@ class RefinerPrepareResponse(BaseModel):
     ok: bool
     modelType: str
     message: str
+    jobId: Optional[str] = None  # Set when the refiner is prepared in the background
+    status: str = "completed"
 
 class RefineRequest(BaseModel):
     originalImageFilename: str
     refinementPrompt: str
+    negativePrompt: Optional[str] = None
     modelType: str  # "sdxs" or "small-sd-v0"
     strength: Optional[float] = 0.75
     steps: Optional[int] = 20
     guidance: Optional[float] = 7.5
     seed: Optional[int] = None
+    vae: Optional[str] = None  # "fast" or "large" for SDXS; defaults to REFINE_VAE
+    priority: Optional[int] = 0
+    deadlineMs: Optional[int] = None
 
 class RefineResponse(BaseModel):
     ok: bool
     refinedImagePath: str
     filename: str
 
+class JobResponse(BaseModel):
+    jobId: str
+    kind: str  # "generate" or "refine"
+    status: str  # "queued", "running", "completed", "failed" or "cancelled"
+    queuePosition: Optional[int] = None  # 1-based while waiting for an inference slot
+    step: Optional[int] = None  # Denoise steps completed, while running
+    totalSteps: Optional[int] = None
+    imagePath: Optional[str] = None
+    filename: Optional[str] = None
+    images: Optional[List[GeneratedImage]] = None  # Every image of a generate job
+    error: Optional[str] = None
+    createdAt: float
+    updatedAt: float
+
+class BulkRunResponse(BaseModel):
+    runId: str
+    status: str  # "queued", "running", "completed", "failed", "cancelled" or "interrupted"
+    repoId: Optional[str] = None
+    total: int  # Prompts in the input
+    completed: int  # Prompts rendered by the current attempt
+    failed: int
+    skipped: int  # Prompts already completed before a resume
+    images: int
+    error: Optional[str] = None
+    createdAt: float
+    updatedAt: float
+
 # Routes
 @api_router.get("/")
 async def root():
@@ -90,69 +417,427 @@ async def prepare_model(request: ModelPrepareRequest):
     try:
         logger.info(f"Preparing model from {request.modelCardUrl}")
         
-        # Download model
         repo_id = hf_downloader.parse_repo_id(request.modelCardUrl)
-        model_path = await hf_downloader.download_model(repo_id)
-        
-        # Load model into memory
-        await model_loader.load_model(repo_id, model_path)
         
-        # Link to refiner service for SDXS refinement
-        refiner_service.set_sdxs_pipeline(model_loader.get_pipeline())
+        # Download and load in the background; concurrent requests for the same repo share a job
+        job = prepare_jobs.start(repo_id, lambda job: _prepare_model(job, repo_id))
         
         return ModelPrepareResponse(
             ok=True,
             repoId=repo_id,
-            message=f"Model {repo_id} loaded successfully"
+            jobId=job.id,
+            status=job.status,
+            message=f"Preparing model {repo_id}"
         )
     except Exception as e:
         logger.error(f"Error preparing model: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _prepare_model(job: PrepareJob, repo_id: str):
+    # Download model
+    job.set_phase("downloading", f"Downloading {repo_id}")
+    model_path = await hf_downloader.download_model(repo_id)
+    _model_fingerprints.pop(repo_id, None)
+    
+    # Load model into memory
+    job.set_phase("loading", f"Loading {repo_id}")
+    was_resident = model_loader.is_loaded(repo_id)
+    await model_loader.load_model(repo_id, model_path)
+    if not was_resident:
+        # Embeddings cached for weights this load replaced must not be served
+        prompt_cache.invalidate(repo_id)
+    if inference_workers is not None:
+        # Workers map the snapshot written by the load above and warm their own copies
+        await inference_workers.load(repo_id)
+    
+    # Link to refiner service for SDXS refinement
+    refiner_service.set_sdxs_pipeline(model_loader.get_pipeline(), model_loader.repo_id)
+    
+    # Workers warmed their own copies; the supervisor's only refines
+    if inference_workers is not None:
+        return
+    
+    # Warm up before readiness flips; nothing awaits between the load and this,
+    # so the new model is never reported ready while still cold
+    report = model_warmup.report(repo_id)
+    if was_resident and report is not None and report["status"] in ("completed", "skipped"):
+        return
+    job.set_phase("warming", f"Warming up {repo_id}")
+    await model_warmup.warm(repo_id, _warmup_pipelines(repo_id))
+
+def _warmup_pipelines(repo_id: str) -> list:
+    pipelines = {}
+    for vae in WARMUP_VAES:
+        if vae == "large" and not model_loader.has_large_vae(repo_id):
+            continue
+        pipeline = model_loader.get_pipeline(repo_id, vae=vae)
+        pipelines.setdefault(id(pipeline), (vae, pipeline))
+    return list(pipelines.values())
+
+def _is_ready() -> bool:
+    # Ready once the active model is loaded and warm; a failed autoload entry is reported, not blocking
+    return (
+        model_autoloader.status not in ("pending", "loading")
+        and model_loader.is_loaded()
+        and not model_warmup.is_warming(model_loader.repo_id)
+        and (inference_workers is None or inference_workers.is_loaded(model_loader.repo_id))
+    )
+
+@api_router.get("/ready")
+async def get_readiness():
+    # 503 until a model is loaded and warmed, so load balancers hold traffic back
+    ready = _is_ready()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "repoId": model_loader.repo_id,
+            "warmup": model_warmup.report(model_loader.repo_id),
+            "autoload": model_autoloader.stats(),
+            "autoloadFailures": [entry.to_dict() for entry in model_autoloader.entries if entry.status == "failed"]
+        }
+    )
+
+async def _autoload_model(entry):
+    model_path = hf_downloader.local_path(entry.repo_id)
+    if not model_path.is_dir():
+        raise Exception(f"Model {entry.repo_id} not found at {model_path}")
+    if entry.model_type == "sdxs":
+        await model_loader.load_model(entry.repo_id, model_path, local_only=True)
+    else:
+        await refiner_service.load_refiner_model(entry.model_type, entry.repo_id, model_path, local_only=True)
+
+async def _finish_autoload(entries):
+    # Models finish loading in any order; the first configured SDXS model becomes active
+    sdxs = next((e for e in entries if e.model_type == "sdxs" and e.status == "loaded"), None)
+    if sdxs is None:
+        return
+    await model_loader.load_model(sdxs.repo_id, hf_downloader.local_path(sdxs.repo_id), local_only=True)
+    refiner_service.set_sdxs_pipeline(model_loader.get_pipeline(), model_loader.repo_id)
+    if inference_workers is not None:
+        await inference_workers.load(sdxs.repo_id)
+    else:
+        await model_warmup.warm(sdxs.repo_id, _warmup_pipelines(sdxs.repo_id))
+
+@api_router.get("/autoload")
+async def get_autoload_status():
+    return model_autoloader.stats()
+
+@api_router.get("/workers")
+async def get_worker_stats():
+    if inference_workers is None:
+        return {"workers": [], "threadsPerWorker": None}
+    return inference_workers.stats()
+
+@api_router.get("/model/prepare/{job_id}", response_model=PrepareJobResponse)
+async def get_prepare_job(job_id: str):
+    job = prepare_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Prepare job not found")
+    
+    progress = hf_downloader.get_progress(job.repo_id)
+    return PrepareJobResponse(
+        jobId=job.id,
+        repoId=job.repo_id,
+        kind=job.kind,
+        status=job.status,
+        phase=job.phase,
+        message=job.message,
+        error=job.error,
+        **(progress.to_dict() if progress is not None else {})
+    )
+
+@api_router.get("/model/pool")
+async def get_model_pool():
+    return {"activeRepoId": model_loader.repo_id, **model_pool.stats()}
+
+def _admission_error(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=str(e), headers=e.headers())
+
+def _check_vae(vae: Optional[str], repo_id: Optional[str]):
+    # An explicitly requested large VAE must exist; the configured default falls back to the fast one
+    if vae is None:
+        return
+    if vae not in VAE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown VAE: {vae}. Use one of: {', '.join(VAE_MODES)}")
+    if vae == "large" and not model_loader.has_large_vae(repo_id):
+        raise HTTPException(status_code=400, detail="This model does not ship a large VAE")
+
+def _request_seeds(request: GenerateRequest) -> List[Optional[int]]:
+    """One seed per requested image; None where the request leaves it random."""
+    if request.seeds is not None:
+        if request.numImages is not None and request.numImages != len(request.seeds):
+            raise HTTPException(status_code=400, detail="numImages does not match the number of seeds")
+        seeds = list(request.seeds)
+    else:
+        count = request.numImages if request.numImages is not None else 1
+        seeds = [None if request.seed is None else request.seed + i for i in range(count)]
+    if not 1 <= len(seeds) <= GENERATE_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"A request can generate 1 to {GENERATE_MAX_IMAGES} images")
+    return seeds
+
+def _check_generate_ready(request: GenerateRequest):
+    if not model_loader.is_loaded(request.repoId):
+        raise HTTPException(status_code=400, detail="No model loaded. Please prepare a model first.")
+    _check_vae(request.vae, request.repoId)
+    _request_seeds(request)
+
+# Weight fingerprints of local models, dropped whenever a prepare may have downloaded new weights
+_model_fingerprints: Dict[str, str] = {}
+# Seeded renders in progress by result cache key, so identical concurrent requests share one render
+_inflight_results: Dict[str, asyncio.Future] = {}
+
+async def _model_identity(repo_id: str) -> dict:
+    # Everything besides the request that changes the pixels it produces
+    weights = _model_fingerprints.get(repo_id)
+    if weights is None:
+        weights = await asyncio.to_thread(model_fingerprint, hf_downloader.local_path(repo_id))
+        _model_fingerprints[repo_id] = weights
+    return {
+        "repoId": repo_id,
+        "weights": weights,
+        "dtype": str(model_loader.dtype),
+        "bf16": cpu_profile.bf16_autocast
+    }
+
+def _lookup_cached(keys: list) -> list:
+    return [None if key is None else result_cache.get(key) for key in keys]
+
+async def _lookup_generate(request: GenerateRequest) -> Tuple[list, list, list]:
+    """Seeds of a generate request, their result cache keys and the images already cached for them."""
+    seeds = _request_seeds(request)
+    keys = [None] * len(seeds)
+    if result_cache is not None:
+        repo_id = request.repoId or model_loader.repo_id
+        vae = request.vae or GENERATE_VAE
+        model = await _model_identity(repo_id)
+        # Only seeded images are deterministic
+        keys = [
+            None if seed is None else ResultCache.key(
+                "generate",
+                model,
+                prompt=request.prompt,
+                negative_prompt=request.negativePrompt,
+                size=request.size,
+                steps=request.steps,
+                guidance=request.guidance,
+                seed=seed,
+                vae=vae
+            )
+            for seed in seeds
+        ]
+    # SQLite lookups stay off the event loop
+    cached = await asyncio.to_thread(_lookup_cached, keys) if result_cache is not None else keys
+    return seeds, keys, cached
+
+def _start_result(key: str) -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    _inflight_results[key] = future
+    return future
+
+def _finish_result(key: str, future: asyncio.Future, path: Optional[Path]):
+    # Requests waiting on a failed render get None and render it themselves
+    future.set_result(path)
+    if path is None:
+        _forget_result(key, future)
+    else:
+        spawn(_cache_result(key, path, future), "result cache write")
+
+def _forget_result(key: str, future: asyncio.Future):
+    if _inflight_results.get(key) is future:
+        del _inflight_results[key]
+
+async def _cache_result(key: str, path: Path, future: asyncio.Future):
+    # Sized once encoded, so the response never waits for it; repeats share the render until it is cached
+    try:
+        image = await image_store.load(path)
+        if image is not None:
+            await asyncio.to_thread(result_cache.put, key, path, len(image.data))
+    finally:
+        _forget_result(key, future)
+
+async def _generate(request: GenerateRequest, progress: Optional[StepProgress] = None, lookup=None) -> dict:
+    _check_generate_ready(request)
+    seeds, keys, cached = lookup or await _lookup_generate(request)
+    paths = list(cached)
+    shared = {
+        i: _inflight_results[keys[i]] for i, path in enumerate(paths)
+        if path is None and keys[i] in _inflight_results
+    }
+    missing = [i for i, path in enumerate(paths) if path is None and i not in shared]
+    owned = {i: _start_result(keys[i]) for i in missing if keys[i] is not None}
+    results = []
+    try:
+        if missing:
+            results = await sdxs_pipeline.generate_batch(
+                prompt=request.prompt,
+                negative_prompt=request.negativePrompt,
+                size=request.size,
+                steps=request.steps,
+                guidance=request.guidance,
+                seeds=[seeds[i] for i in missing],
+                repo_id=request.repoId,
+                progress=progress,
+                vae=request.vae or GENERATE_VAE
+            )
+    finally:
+        rendered = {i: Path(image_path) for i, (image_path, _) in zip(missing, results)}
+        for i, future in owned.items():
+            _finish_result(keys[i], future, rendered.get(i))
+    for i, (image_path, seed) in zip(missing, results):
+        paths[i], seeds[i] = Path(image_path), seed
+    for i, future in shared.items():
+        paths[i] = await asyncio.shield(future)
+    if any(path is None for path in paths):
+        # A render shared with another request failed; try again on our own
+        return await _generate(request, progress)
+    images = []
+    for image_path, seed in zip(paths, seeds):
+        filename = image_path.name
+        images.append({"imagePath": f"/api/images/{filename}", "filename": filename, "seed": seed})
+    return {"imagePath": images[0]["imagePath"], "filename": images[0]["filename"], "images": images}
+
 @api_router.post("/generate", response_model=GenerateResponse)
-async def generate_image(request: GenerateRequest):
+async def generate_image(request: GenerateRequest, http_request: Request):
     try:
         logger.info(f"Generating image for prompt: {request.prompt}")
         
         # Check if model is loaded
-        if not model_loader.is_loaded():
-            raise HTTPException(status_code=400, detail="No model loaded. Please prepare a model first.")
+        _check_generate_ready(request)
         
-        # Generate image
-        image_path = await sdxs_pipeline.generate(
-            prompt=request.prompt,
-            size=request.size,
-            steps=request.steps,
-            guidance=request.guidance,
-            seed=request.seed
-        )
+        # Repeat seeded requests are answered from the result cache, or share a render in progress, without queueing
+        lookup = await _lookup_generate(request)
+        if all(path is not None or key in _inflight_results for key, path in zip(lookup[1], lookup[2])):
+            return GenerateResponse(ok=True, **await _generate(request, lookup=lookup))
         
-        filename = Path(image_path).name
+        # Generate image once admitted to the bounded inference queue
+        async with admission.admit(request.priority or 0, request.deadlineMs, http_request.is_disconnected):
+            result = await _generate(request, lookup=lookup)
         
-        return GenerateResponse(
-            ok=True,
-            imagePath=f"/api/images/{filename}",
-            filename=filename
-        )
+        return GenerateResponse(ok=True, **result)
     except HTTPException:
         raise
+    except AdmissionRejected as e:
+        raise _admission_error(e)
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/images/{filename}")
-async def get_image(filename: str):
-    image_path = IMAGES_DIR / filename
-    if not image_path.exists():
+@api_router.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@api_router.get("/admission/stats")
+async def get_admission_stats():
+    return admission.stats()
+
+@api_router.get("/cpu-profile")
+async def get_cpu_profile():
+    return {"device": model_loader.device, **cpu_profile.describe()}
+
+@api_router.get("/prompt-cache/stats")
+async def get_prompt_cache_stats():
+    return prompt_cache.stats()
+
+@api_router.get("/refiner/latent-cache/stats")
+async def get_latent_cache_stats():
+    return latent_cache.stats()
+
+@api_router.get("/image-cache/stats")
+async def get_image_cache_stats():
+    return image_cache.stats()
+
+@api_router.get("/storage/stats")
+async def get_storage_stats():
+    return {**image_storage.stats(), "derivatives": derivative_store.stats()}
+
+@api_router.get("/storage/images/{filename}")
+async def get_image_metadata(filename: str):
+    # Creation time, size, parent image and generation parameters of a generated or refined image
+    metadata = image_storage.metadata(filename)
+    if metadata is None:
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(image_path)
+    return metadata
+
+@api_router.get("/result-cache/stats")
+async def get_result_cache_stats():
+    if result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **result_cache.stats()}
+
+# Image filenames are UUIDs that are never reused, so responses can be cached forever
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def _is_not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= int(last_modified)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _image_headers(etag: str, last_modified: float) -> dict:
+    return {
+        "ETag": etag,
+        "Last-Modified": last_modified_header(last_modified),
+        "Cache-Control": IMAGE_CACHE_CONTROL
+    }
+
+async def _serve_image(
+    request: Request,
+    directory: Path,
+    filename: str,
+    not_found_detail: str,
+    w: Optional[int] = None,
+    image_format: Optional[str] = None
+):
+    derivative = w is not None or image_format is not None
+    if derivative:
+        # A resized and/or re-encoded copy, made on first request and kept next to the original
+        if w is not None and w < 1:
+            raise HTTPException(status_code=400, detail="w must be a positive width")
+        image_format = image_format or DERIVATIVE_FORMAT
+        if image_format not in IMAGE_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unknown format: {image_format}. Use one of: {', '.join(IMAGE_FORMATS)}")
+        width = derivative_store.snap_width(w or derivative_store.widths[-1])
+        path = derivative_store.path_for(directory, filename, width, image_format)
+    else:
+        path = image_store.resolve(directory, filename)
+    
+    # Revalidations are answered from the filename and a stat, without reading the image
+    if "if-none-match" in request.headers or "if-modified-since" in request.headers:
+        validators = await image_store.validators(path)
+        if derivative and validators is not None and not await derivative_store.has_original(directory, filename):
+            validators = None
+        if validators is not None and _is_not_modified(request, *validators):
+            return Response(status_code=304, headers=_image_headers(*validators))
+    
+    if derivative:
+        image = await derivative_store.load(directory, filename, width, image_format)
+    else:
+        # Recent images come from the in-memory cache, including ones not yet written to disk
+        image = await image_store.load(path)
+    if image is None:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    return Response(
+        content=image.data,
+        media_type=image.media_type,
+        headers=_image_headers(image.etag, image.last_modified)
+    )
+
+@api_router.get("/images/{filename}")
+async def get_image(filename: str, request: Request, w: Optional[int] = None, image_format: Optional[str] = Query(None, alias="format")):
+    return await _serve_image(request, IMAGES_DIR, filename, "Image not found", w, image_format)
 
 @api_router.get("/images/refined/{filename}")
-async def get_refined_image(filename: str):
-    image_path = REFINED_IMAGES_DIR / filename
-    if not image_path.exists():
-        raise HTTPException(status_code=404, detail="Refined image not found")
-    return FileResponse(image_path)
+async def get_refined_image(filename: str, request: Request, w: Optional[int] = None, image_format: Optional[str] = Query(None, alias="format")):
+    return await _serve_image(request, REFINED_IMAGES_DIR, filename, "Refined image not found", w, image_format)
 
 @api_router.post("/refiner/prepare", response_model=RefinerPrepareResponse)
 async def prepare_refiner(request: RefinerPrepareRequest):
@@ -164,7 +849,7 @@ async def prepare_refiner(request: RefinerPrepareRequest):
             if not model_loader.is_loaded():
                 raise HTTPException(status_code=400, detail="SDXS model not loaded. Please load SDXS first.")
             
-            refiner_service.set_sdxs_pipeline(model_loader.get_pipeline())
+            refiner_service.set_sdxs_pipeline(model_loader.get_pipeline(), model_loader.repo_id)
             return RefinerPrepareResponse(
                 ok=True,
                 modelType="sdxs",
@@ -172,15 +857,16 @@ async def prepare_refiner(request: RefinerPrepareRequest):
             )
         
         elif request.modelType == "small-sd-v0":
-            # Download and load Small SD V0
+            # Download and load Small SD V0 in the background, polled via GET /api/model/prepare/{jobId}
             repo_id = hf_downloader.parse_repo_id(request.modelCardUrl)
-            model_path = await hf_downloader.download_model(repo_id)
-            await refiner_service.load_refiner_model("small-sd-v0", repo_id, model_path)
+            job = prepare_jobs.start(repo_id, lambda job: _prepare_refiner(job, repo_id), kind="refiner")
             
             return RefinerPrepareResponse(
                 ok=True,
                 modelType="small-sd-v0",
-                message=f"Small SD V0 refiner loaded successfully"
+                message=f"Preparing Small SD V0 refiner {repo_id}",
+                jobId=job.id,
+                status=job.status
             )
         else:
             raise HTTPException(status_code=400, detail=f"Unknown model type: {request.modelType}")
@@ -191,39 +877,321 @@ async def prepare_refiner(request: RefinerPrepareRequest):
         logger.error(f"Error preparing refiner: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.post("/refiner/refine", response_model=RefineResponse)
-async def refine_image(request: RefineRequest):
+async def _prepare_refiner(job: PrepareJob, repo_id: str):
+    job.set_phase("downloading", f"Downloading {repo_id}")
+    model_path = await hf_downloader.download_model(repo_id)
+    _model_fingerprints.pop(repo_id, None)
+    job.set_phase("loading", f"Loading {repo_id}")
+    await refiner_service.load_refiner_model("small-sd-v0", repo_id, model_path)
+    prompt_cache.invalidate(repo_id)
+
+def _check_refine_ready(request: RefineRequest):
+    if not refiner_service.is_refiner_loaded(request.modelType):
+        raise HTTPException(status_code=400, detail=f"Refiner model {request.modelType} not loaded. Please prepare it first.")
+    if request.modelType == "sdxs":
+        _check_vae(request.vae, refiner_service.sdxs_repo_id)
+
+async def _lookup_refine(request: RefineRequest) -> Tuple[Optional[str], Optional[Path]]:
+    """Result cache key of a refine request and the image already cached for it."""
+    if result_cache is None or request.seed is None:
+        return None, None
+    if request.modelType == "sdxs":
+        repo_id = refiner_service.sdxs_repo_id
+        large = (request.vae or REFINE_VAE) == "large"
+        vae = "large" if large and model_pool.contains(("sdxs-img2img-vae_large", repo_id)) else "fast"
+    else:
+        # Other refiners always decode with their own VAE
+        repo_id = refiner_service.refiner_repo_ids.get(request.modelType)
+        vae = None
+    key = ResultCache.key(
+        "refine",
+        await _model_identity(repo_id),
+        model_type=request.modelType,
+        original=request.originalImageFilename,
+        prompt=request.refinementPrompt,
+        negative_prompt=request.negativePrompt,
+        strength=request.strength,
+        steps=request.steps,
+        guidance=request.guidance,
+        seed=request.seed,
+        vae=vae
+    )
+    return key, await asyncio.to_thread(result_cache.get, key)
+
+def _refine_result(refined_path: Path) -> dict:
+    filename = refined_path.name
+    return {"imagePath": f"/api/images/refined/{filename}", "filename": filename}
+
+async def _refine(request: RefineRequest, progress: Optional[StepProgress] = None, lookup=None) -> dict:
+    _check_refine_ready(request)
+    key, cached = lookup or await _lookup_refine(request)
+    if cached is not None:
+        return _refine_result(cached)
+    if key in _inflight_results:
+        shared = await asyncio.shield(_inflight_results[key])
+        # A failed shared render is retried on our own
+        return _refine_result(shared) if shared is not None else await _refine(request, progress)
+    
+    future = _start_result(key) if key is not None else None
+    refined_path = None
     try:
-        logger.info(f"Refining image with {request.modelType}: {request.originalImageFilename}")
-        
-        # Check if refiner is loaded
-        if not refiner_service.is_refiner_loaded(request.modelType):
-            raise HTTPException(status_code=400, detail=f"Refiner model {request.modelType} not loaded. Please prepare it first.")
-        
-        # Refine image
-        refined_path = await refiner_service.refine_image(
+        refined_path = Path(await refiner_service.refine_image(
             original_image_filename=request.originalImageFilename,
             refinement_prompt=request.refinementPrompt,
+            negative_prompt=request.negativePrompt,
             model_type=request.modelType,
             strength=request.strength,
             steps=request.steps,
             guidance=request.guidance,
-            seed=request.seed
-        )
+            seed=request.seed,
+            progress=progress,
+            vae=request.vae or REFINE_VAE
+        ))
+    finally:
+        if future is not None:
+            _finish_result(key, future, refined_path)
+    return _refine_result(refined_path)
+
+@api_router.post("/refiner/refine", response_model=RefineResponse)
+async def refine_image(request: RefineRequest, http_request: Request):
+    try:
+        logger.info(f"Refining image with {request.modelType}: {request.originalImageFilename}")
         
-        filename = Path(refined_path).name
+        # Check if refiner is loaded
+        _check_refine_ready(request)
+        
+        # Refine image once admitted to the bounded inference queue, unless its result is cached
+        lookup = await _lookup_refine(request)
+        if lookup[1] is not None or lookup[0] in _inflight_results:
+            result = await _refine(request, lookup=lookup)
+        else:
+            async with admission.admit(request.priority or 0, request.deadlineMs, http_request.is_disconnected):
+                result = await _refine(request, lookup=lookup)
         
         return RefineResponse(
             ok=True,
-            refinedImagePath=f"/api/images/refined/{filename}",
-            filename=filename
+            refinedImagePath=result["imagePath"],
+            filename=result["filename"]
         )
     except HTTPException:
         raise
+    except AdmissionRejected as e:
+        raise _admission_error(e)
     except Exception as e:
         logger.error(f"Error refining image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Asynchronous job API: POST returns a job id at once, GET polls it and /events streams it
+def _job_response(job: InferenceJob) -> JobResponse:
+    result = job.result or {}
+    preview = inference_jobs.preview(job.id)
+    return JobResponse(
+        jobId=job.id,
+        kind=job.kind,
+        status=job.status,
+        queuePosition=inference_jobs.queue_position(job.id),
+        step=preview[0] if preview else None,
+        totalSteps=preview[1] if preview else None,
+        imagePath=result.get("imagePath"),
+        filename=result.get("filename"),
+        images=result.get("images"),
+        error=job.error,
+        createdAt=job.created_at,
+        updatedAt=job.updated_at
+    )
+
+@api_router.post("/jobs/generate", response_model=JobResponse, status_code=202)
+async def submit_generate_job(request: GenerateRequest):
+    _check_generate_ready(request)
+    try:
+        job = await inference_jobs.submit(
+            "generate",
+            request.model_dump(),
+            lambda job, progress: _generate(request, progress),
+            priority=request.priority or 0,
+            deadline_ms=request.deadlineMs
+        )
+    except AdmissionRejected as e:
+        raise _admission_error(e)
+    return _job_response(job)
+
+@api_router.post("/jobs/refine", response_model=JobResponse, status_code=202)
+async def submit_refine_job(request: RefineRequest):
+    _check_refine_ready(request)
+    try:
+        job = await inference_jobs.submit(
+            "refine",
+            request.model_dump(),
+            lambda job, progress: _refine(request, progress),
+            priority=request.priority or 0,
+            deadline_ms=request.deadlineMs
+        )
+    except AdmissionRejected as e:
+        raise _admission_error(e)
+    return _job_response(job)
+
+@api_router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    job = inference_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_response(job)
+
+@api_router.post("/jobs/{job_id}/cancel", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    job = inference_jobs.cancel(job_id)
+    if job is None:
+        job = inference_jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    return _job_response(job)
+
+@api_router.get("/jobs/{job_id}/preview")
+async def get_job_preview(job_id: str):
+    preview = inference_jobs.preview(job_id)
+    if preview is None:
+        raise HTTPException(status_code=404, detail="No preview available")
+    step, total_steps, image = preview
+    return Response(
+        content=image,
+        media_type="image/jpeg",
+        headers={"Cache-Control": "no-store", "X-Step": str(step), "X-Total-Steps": str(total_steps)}
+    )
+
+# Seconds between checks for queue position changes, and between keep-alive comments
+JOB_EVENTS_POLL_SECONDS = 1.0
+JOB_EVENTS_KEEPALIVE_SECONDS = 15.0
+
+@api_router.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request):
+    if inference_jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def events():
+        last = None
+        last_preview_step = None
+        last_sent = 0.0
+        while True:
+            job = inference_jobs.get(job_id)
+            if job is None:
+                return
+            
+            # Step progress goes out as preview events, everything else as status events
+            state = _job_response(job).model_dump(exclude={"step", "totalSteps"})
+            preview = inference_jobs.preview(job_id)
+            if state != last:
+                yield f"event: {job.status}\ndata: {json.dumps(state)}\n\n"
+                last = state
+                last_sent = time.monotonic()
+            if preview is not None and preview[0] != last_preview_step:
+                step, total_steps, image = preview
+                data = {
+                    "jobId": job_id,
+                    "step": step,
+                    "totalSteps": total_steps,
+                    "image": "data:image/jpeg;base64," + base64.b64encode(image).decode("ascii")
+                }
+                yield f"event: preview\ndata: {json.dumps(data)}\n\n"
+                last_preview_step = step
+                last_sent = time.monotonic()
+            # Quiet streams get a comment so proxies do not close them as idle
+            if time.monotonic() - last_sent >= JOB_EVENTS_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            
+            if job.is_finished() or await request.is_disconnected():
+                return
+            await inference_jobs.wait_for_change(job_id, JOB_EVENTS_POLL_SECONDS)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Bulk runs: POST streams a JSONL or CSV prompt file, the run renders in the background
+@api_router.post("/bulk", response_model=BulkRunResponse, status_code=202)
+async def submit_bulk_run(
+    request: Request,
+    input_format: Optional[str] = Query(None, alias="format"),
+    repoId: Optional[str] = None,
+    size: str = '512x512',
+    steps: int = 8,
+    guidance: float = 4.0,
+    vae: Optional[str] = None
+):
+    input_format = input_format or ("csv" if "csv" in request.headers.get("content-type", "") else "jsonl")
+    if input_format not in BULK_INPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {input_format}. Use one of: {', '.join(BULK_INPUT_FORMATS)}")
+    # Rejects a declared oversize body up front; the cap is enforced again while the body streams in,
+    # since the header is optional and can be wrong
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            declared = int(content_length)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Content-Length header")
+        if bulk_runs.max_input_bytes and declared > bulk_runs.max_input_bytes:
+            raise HTTPException(status_code=413, detail="The prompt file is too large")
+    if not model_loader.is_loaded(repoId):
+        raise HTTPException(status_code=400, detail="No model loaded. Please prepare a model first.")
+    _check_vae(vae, repoId)
+    
+    defaults = {"size": size, "steps": steps, "guidance": guidance, "vae": vae or GENERATE_VAE}
+    try:
+        # Pin the model, so a resume after switching models renders with the same one
+        run = await bulk_runs.create(request.stream(), input_format, repoId or model_loader.repo_id, defaults)
+    except BulkInputTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    bulk_runs.start(run)
+    return BulkRunResponse(**run.to_dict())
+
+@api_router.get("/bulk")
+async def list_bulk_runs():
+    return {"runs": [run.to_dict() for run in bulk_runs.runs()]}
+
+def _get_bulk_run(run_id: str):
+    run = bulk_runs.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Bulk run not found")
+    return run
+
+@api_router.get("/bulk/{run_id}", response_model=BulkRunResponse)
+async def get_bulk_run(run_id: str):
+    return BulkRunResponse(**_get_bulk_run(run_id).to_dict())
+
+@api_router.get("/bulk/{run_id}/manifest")
+async def get_bulk_manifest(run_id: str):
+    run = _get_bulk_run(run_id)
+    if not run.manifest_path.is_file():
+        raise HTTPException(status_code=404, detail="No prompts finished yet")
+    return FileResponse(run.manifest_path, media_type="application/x-ndjson", headers={"Cache-Control": "no-store"})
+
+@api_router.get("/bulk/{run_id}/images/{filename}")
+async def get_bulk_image(run_id: str, filename: str, request: Request, w: Optional[int] = None, image_format: Optional[str] = Query(None, alias="format")):
+    run = _get_bulk_run(run_id)
+    return await _serve_image(request, run.images_dir, Path(filename).name, "Image not found", w, image_format)
+
+@api_router.post("/bulk/{run_id}/cancel", response_model=BulkRunResponse)
+async def cancel_bulk_run(run_id: str):
+    run = bulk_runs.cancel(run_id)
+    if run is None:
+        raise HTTPException(status_code=409, detail=f"Bulk run already {_get_bulk_run(run_id).status}")
+    return BulkRunResponse(**run.to_dict())
+
+@api_router.post("/bulk/{run_id}/resume", response_model=BulkRunResponse, status_code=202)
+async def resume_bulk_run(run_id: str):
+    run = _get_bulk_run(run_id)
+    if run.is_active():
+        raise HTTPException(status_code=409, detail=f"Bulk run already {run.status}")
+    if not model_loader.is_loaded(run.repo_id):
+        raise HTTPException(status_code=400, detail=f"Model {run.repo_id} is not loaded")
+    bulk_runs.start(run)
+    return BulkRunResponse(**run.to_dict())
+
 # Include router
 app.include_router(api_router)
 
@@ -234,6 +1202,51 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestMetricsMiddleware)
+
+@app.on_event("startup")
+async def start_inference_workers():
+    if inference_workers is not None:
+        inference_workers.start()
+
+@app.on_event("startup")
+async def start_image_storage():
+    async def maintain():
+        # Moving old flat files into shards can take a while; the old paths keep resolving meanwhile
+        try:
+            await asyncio.to_thread(image_storage.reconcile)
+        except Exception as e:
+            logger.error(f"Image storage reconcile failed: {e}")
+        if image_storage.max_age_days or image_storage.max_bytes:
+            await image_storage.run_retention(IMAGE_RETENTION_INTERVAL_S, image_store.is_pending)
+    spawn(maintain(), "image storage maintenance")
+
+@app.on_event("startup")
+async def recover_inference_jobs():
+    # At startup rather than import, so tools importing this module leave a live server's jobs alone
+    inference_jobs.recover()
+
+@app.on_event("startup")
+async def recover_bulk_runs():
+    bulk_runs.recover()
+
+@app.on_event("startup")
+async def autoload_models():
+    # Loads in the background so the server answers health checks (as not ready) meanwhile
+    if model_autoloader.entries:
+        spawn(model_autoloader.run(_autoload_model, _finish_autoload), "model autoload")
+
+@app.on_event("shutdown")
+async def shutdown_inference():
+    inference_executor.shutdown()
+    if inference_workers is not None:
+        inference_workers.shutdown()
+    image_store.shutdown()
+    derivative_store.shutdown()
+    inference_jobs.shutdown()
+    if result_cache is not None:
+        result_cache.close()
+    image_storage.close()
 
 # Configure logging
 logging.basicConfig(
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """A request was turned away before any inference work was spent on it."""
+    
+    status_code = 503
+    reason = "rejected"
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+    
+    def headers(self) -> dict:
+        if self.retry_after is None:
+            return {}
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+class QueueFullError(AdmissionRejected):
+    status_code = 429
+    reason = "queue_full"
+
+class DeadlineExceededError(AdmissionRejected):
+    status_code = 503
+    reason = "deadline"
+
+class ClientDisconnectedError(AdmissionRejected):
+    status_code = 499  # Client closed request; the response is never read
+    reason = "disconnected"
+
+class _Waiter:
+    def __init__(self, future: asyncio.Future, deadline: Optional[float], order: Tuple[int, int]):
+        self.future = future
+        self.deadline = deadline
+        self.order = order  # (-priority, arrival), the heap ordering
+        self.abandoned = False
+    
+    def is_waiting(self) -> bool:
+        return not self.abandoned and not self.future.done()
+
+class AdmissionController:
+    """Bounded priority queue in front of inference.
+    
+    At most ``max_concurrent`` requests hold a slot at once; the rest wait in a
+    queue of at most ``max_queue_depth`` entries, served by priority (higher
+    first) and then arrival order. Requests are rejected up front when the
+    queue is full or their deadline cannot be met at the observed service
+    time, and dropped from the queue when their deadline passes or their
+    client disconnects, so no compute is spent on them.
+    """
+    
+    def __init__(
+        self,
+        max_concurrent: int = 4,
+        max_queue_depth: int = 32,
+        default_deadline_ms: float = 0,
+        disconnect_poll_ms: float = 250
+    ):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue_depth = max_queue_depth
+        self.default_deadline = default_deadline_ms / 1000 if default_deadline_ms else None
+        self.disconnect_poll = disconnect_poll_ms / 1000
+        self._active = 0
+        self._queue: List[Tuple[int, int, _Waiter]] = []
+        self._waiting = 0
+        self._keyed: Dict[Hashable, _Waiter] = {}
+        self._seq = itertools.count()
+        self._service_time: Optional[float] = None  # moving average of slot hold time
+        self.admitted = 0
+        self.rejected = 0
+        logger.info(
+            f"Admission control: max_concurrent={self.max_concurrent}, max_queue_depth={max_queue_depth}, "
+            f"default_deadline_ms={default_deadline_ms}"
+        )
+    
+    @asynccontextmanager
+    async def admit(
+        self,
+        priority: int = 0,
+        deadline_ms: Optional[float] = None,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+        key: Optional[Hashable] = None
+    ):
+        """Hold an inference slot for the duration of the block, waiting in the queue if needed.
+        
+        ``key`` identifies the request for ``queue_position`` while it waits.
+        """
+        timeout = deadline_ms / 1000 if deadline_ms else self.default_deadline
+        deadline = time.monotonic() + timeout if timeout else None
+        
+        await self._acquire(priority, deadline, is_disconnected, key)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._record_service_time(time.monotonic() - start)
+            self._release()
+    
+    def queue_depth(self) -> int:
+        return self._waiting
+    
+    def active(self) -> int:
+        return self._active
+    
+    def queue_position(self, key: Hashable) -> Optional[int]:
+        """1-based position of a keyed request in the queue, or None if it is not waiting."""
+        waiter = self._keyed.get(key)
+        if waiter is None or not waiter.is_waiting():
+            return None
+        return 1 + sum(1 for _, _, other in self._queue if other.is_waiting() and other.order < waiter.order)
+    
+    def check_capacity(self):
+        """Raise QueueFullError if a new request could not be queued right now."""
+        if self._active >= self.max_concurrent and self._waiting >= self.max_queue_depth:
+            self._reject(QueueFullError(
+                f"Inference queue is full ({self.max_queue_depth} waiting)", self.estimated_wait()
+            ))
+    
+    def estimated_wait(self, queue_position: Optional[int] = None) -> float:
+        """Seconds until a request joining the queue now would get a slot."""
+        if self._service_time is None:
+            return 0.0
+        position = self._waiting if queue_position is None else queue_position
+        return (position // self.max_concurrent + 1) * self._service_time
+    
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "queued": self._waiting,
+            "maxConcurrent": self.max_concurrent,
+            "maxQueueDepth": self.max_queue_depth,
+            "serviceTimeSeconds": round(self._service_time, 4) if self._service_time is not None else None,
+            "admitted": self.admitted,
+            "rejected": self.rejected
+        }
+    
+    async def _acquire(self, priority: int, deadline: Optional[float], is_disconnected, key: Optional[Hashable]):
+        if self._active < self.max_concurrent and not self._waiting:
+            self._active += 1
+            self.admitted += 1
+            return
+        
+        if self._waiting >= self.max_queue_depth:
+            self._reject(QueueFullError(
+                f"Inference queue is full ({self.max_queue_depth} waiting)", self.estimated_wait()
+            ))
+        
+        # Fail fast when the queue ahead cannot drain before the deadline
+        wait = self.estimated_wait()
+        if deadline is not None and time.monotonic() + wait > deadline:
+            self._reject(DeadlineExceededError(
+                f"Estimated queue wait of {wait:.1f}s exceeds the request deadline", wait
+            ))
+        
+        order = (-priority, next(self._seq))
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), deadline, order)
+        heapq.heappush(self._queue, (*order, waiter))
+        self._waiting += 1
+        if key is not None:
+            self._keyed[key] = waiter
+        
+        try:
+            await self._wait(waiter, is_disconnected)
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was granted while we were giving up; pass it on
+                self._release()
+            else:
+                self._abandon(waiter)
+            raise
+        finally:
+            if key is not None:
+                self._keyed.pop(key, None)
+        self.admitted += 1
+    
+    async def _wait(self, waiter: _Waiter, is_disconnected):
+        while not waiter.future.done():
+            timeout = self.disconnect_poll if is_disconnected is not None else None
+            if waiter.deadline is not None:
+                remaining = waiter.deadline - time.monotonic()
+                if remaining <= 0:
+                    self._reject(DeadlineExceededError(
+                        "Request deadline passed while queued", self.estimated_wait()
+                    ))
+                timeout = min(timeout, remaining) if timeout is not None else remaining
+            
+            await asyncio.wait({waiter.future}, timeout=timeout)
+            if not waiter.future.done() and is_disconnected is not None and await is_disconnected():
+                self._reject(ClientDisconnectedError("Client disconnected while queued"))
+    
+    def _release(self):
+        self._active -= 1
+        while self._queue and self._active < self.max_concurrent:
+            _, _, waiter = heapq.heappop(self._queue)
+            if waiter.abandoned:
+                continue
+            self._waiting -= 1
+            self._active += 1
+            waiter.future.set_result(None)
+    
+    def _abandon(self, waiter: _Waiter):
+        # Lazily removed from the heap when it reaches the front
+        if not waiter.abandoned:
+            waiter.abandoned = True
+            self._waiting -= 1
+    
+    def _reject(self, error: AdmissionRejected):
+        self.rejected += 1
+        metrics.inc("admission_rejected_total", reason=error.reason)
+        logger.warning(f"Admission rejected ({error.reason}): {error}")
+        raise error
+    
+    def _record_service_time(self, seconds: float):
+        if self._service_time is None:
+            self._service_time = seconds
+        else:
+            self._service_time = 0.8 * self._service_time + 0.2 * seconds
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+AUTOLOAD_MODEL_TYPES = ("sdxs", "small-sd-v0")
+
+class AutoloadEntry:
+    """A model to load from ``MODELS_DIR`` at startup."""
+    
+    def __init__(self, model_type: str, repo_id: str):
+        self.model_type = model_type  # "sdxs" or a refiner model type
+        self.repo_id = repo_id
+        self.status = "pending"  # pending, loading, loaded, failed
+        self.error: Optional[str] = None
+        self.seconds: Optional[float] = None
+    
+    def to_dict(self) -> dict:
+        return {
+            "modelType": self.model_type,
+            "repoId": self.repo_id,
+            "status": self.status,
+            "error": self.error,
+            "seconds": self.seconds
+        }
+
+def parse_autoload_config(spec: str = "", config_path: Optional[Path] = None) -> List[AutoloadEntry]:
+    """Build the autoload list from a JSON config file and/or an inline spec.
+    
+    The file holds ``{"models": [{"modelType": "sdxs", "repoId": "IDKiro/sdxs-512-0.9"}, ...]}``;
+    the inline spec is the same as comma-separated ``model_type=repo_id`` pairs.
+    """
+    pairs = []
+    if config_path is not None:
+        config = json.loads(config_path.read_text())
+        pairs.extend((model["modelType"], model["repoId"]) for model in config.get("models", []))
+    for item in spec.split(","):
+        if item.strip():
+            model_type, _, repo_id = item.partition("=")
+            pairs.append((model_type.strip(), repo_id.strip()))
+    
+    entries = []
+    for model_type, repo_id in pairs:
+        if model_type not in AUTOLOAD_MODEL_TYPES or not repo_id:
+            raise ValueError(f"Invalid autoload entry: {model_type}={repo_id}")
+        entries.append(AutoloadEntry(model_type, repo_id))
+    return entries
+
+class ModelAutoloader:
+    """Loads the configured models concurrently when the server starts.
+    
+    Loading is delegated to ``load`` so the services keep owning their
+    pipelines; ``finish`` runs once everything has loaded (activation,
+    warmup), and only then does the autoload count as completed.
+    """
+    
+    def __init__(self, entries: List[AutoloadEntry]):
+        self.entries = entries
+        self.status = "idle" if not entries else "pending"  # idle, pending, loading, completed, failed
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.total_seconds: Optional[float] = None
+    
+    async def run(
+        self,
+        load: Callable[[AutoloadEntry], Awaitable[None]],
+        finish: Optional[Callable[[List[AutoloadEntry]], Awaitable[None]]] = None
+    ):
+        if not self.entries:
+            return
+        
+        self.status = "loading"
+        self.started_at = time.time()
+        start = time.perf_counter()
+        logger.info(f"Autoloading {len(self.entries)} model(s): {', '.join(e.repo_id for e in self.entries)}")
+        
+        await asyncio.gather(*(self._load(entry, load) for entry in self.entries))
+        
+        failed = [entry.repo_id for entry in self.entries if entry.status == "failed"]
+        if failed:
+            self.error = f"Failed to load: {', '.join(failed)}"
+        try:
+            if finish is not None:
+                await finish(self.entries)
+        except Exception as e:
+            logger.error(f"Autoload finish step failed: {e}")
+            self.error = str(e)
+        
+        self.total_seconds = time.perf_counter() - start
+        self.status = "failed" if self.error else "completed"
+        logger.info(f"Autoload {self.status} in {self.total_seconds:.1f}s")
+    
+    def stats(self) -> dict:
+        return {
+            "status": self.status,
+            "error": self.error,
+            "startedAt": self.started_at,
+            "totalSeconds": self.total_seconds,
+            "models": [entry.to_dict() for entry in self.entries]
+        }
+    
+    async def _load(self, entry: AutoloadEntry, load: Callable[[AutoloadEntry], Awaitable[None]]):
+        entry.status = "loading"
+        start = time.perf_counter()
+        try:
+            await load(entry)
+            entry.status = "loaded"
+        except Exception as e:
+            logger.error(f"Autoload of {entry.model_type} {entry.repo_id} failed: {e}")
+            entry.status = "failed"
+            entry.error = str(e)
+        finally:
+            entry.seconds = time.perf_counter() - start
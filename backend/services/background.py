@@ -0,0 +1,23 @@
+import asyncio
+import logging
+from typing import Awaitable, Set
+
+logger = logging.getLogger(__name__)
+
+# The event loop only keeps weak references to tasks, so fire-and-forget ones are held here until they finish
+_tasks: Set[asyncio.Future] = set()
+
+def spawn(awaitable: Awaitable, name: str) -> asyncio.Future:
+    """Run a coroutine in the background; its failure is logged instead of lost."""
+    task = asyncio.ensure_future(awaitable)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    task.add_done_callback(lambda done: _log_failure(done, name))
+    return task
+
+def _log_failure(task: asyncio.Future, name: str):
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        logger.error(f"Background task {name} failed: {error!r}", exc_info=error)
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from PIL import Image
+
+from services.background import spawn
+from services.inference_executor import InferenceExecutor
+from services.previews import StepProgress
+from services.prompt_cache import PromptEmbeddingCache
+from services.worker_pool import InferenceWorkerPool
+
+logger = logging.getLogger(__name__)
+
+class _PendingGeneration:
+    """A single prompt waiting to be folded into a batch."""
+    
+    def __init__(
+        self,
+        prompt: str,
+        negative_prompt: Optional[str],
+        seed: Optional[int],
+        progress: Optional[StepProgress],
+        future: asyncio.Future
+    ):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.seed = seed
+        self.progress = progress
+        self.future = future
+
+class GenerationBatcher:
+    """Collects concurrent text-to-image requests into batched pipeline calls.
+    
+    Requests are grouped by pipeline, size, steps and guidance. A group is
+    flushed when it reaches ``max_batch_size`` or when ``window_ms`` has
+    elapsed since its first request arrived, whichever comes first. With
+    ``workers``, batches run in the worker processes instead of in-process.
+    """
+    
+    def __init__(
+        self,
+        executor: InferenceExecutor,
+        prompt_cache: PromptEmbeddingCache,
+        window_ms: float = 20,
+        max_batch_size: int = 4,
+        workers: Optional[InferenceWorkerPool] = None
+    ):
+        self.executor = executor
+        self.prompt_cache = prompt_cache
+        self.workers = workers
+        self.window = window_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self._pending: Dict[Tuple, List[_PendingGeneration]] = {}
+        self._timers: Dict[Tuple, asyncio.TimerHandle] = {}
+        logger.info(f"Generation batcher: window={window_ms}ms, max_batch_size={self.max_batch_size}")
+    
+    async def submit(
+        self,
+        pipeline,
+        repo_id: str,
+        device: str,
+        prompt: str,
+        negative_prompt: Optional[str],
+        width: int,
+        height: int,
+        steps: int,
+        guidance: float,
+        seed: Optional[int] = None,
+        progress: Optional[StepProgress] = None,
+        vae: str = "fast"
+    ) -> Image.Image:
+        """Queue a prompt and wait for the image produced by its batch."""
+        images = await self.submit_many(
+            pipeline, repo_id, device, prompt, negative_prompt, width, height, steps, guidance,
+            [seed], [progress], vae
+        )
+        return images[0]
+    
+    async def submit_many(
+        self,
+        pipeline,
+        repo_id: str,
+        device: str,
+        prompt: str,
+        negative_prompt: Optional[str],
+        width: int,
+        height: int,
+        steps: int,
+        guidance: float,
+        seeds: List[Optional[int]],
+        progress: List[Optional[StepProgress]],
+        vae: str = "fast"
+    ) -> List[Image.Image]:
+        """Queue one prompt per seed and wait for all of their images.
+        
+        The samples join the batch group together, so a request larger than
+        ``max_batch_size`` is dispatched as full chunks right away.
+        """
+        loop = asyncio.get_running_loop()
+        key = (id(pipeline), repo_id, vae, width, height, steps, guidance)
+        items = [
+            _PendingGeneration(prompt, negative_prompt, seed, sample_progress, loop.create_future())
+            for seed, sample_progress in zip(seeds, progress)
+        ]
+        
+        for item in items:
+            group = self._pending.setdefault(key, [])
+            group.append(item)
+            if len(group) >= self.max_batch_size:
+                self._flush(key, pipeline, device)
+        if key in self._pending and key not in self._timers:
+            self._timers[key] = loop.call_later(self.window, self._flush, key, pipeline, device)
+        
+        return await asyncio.gather(*(item.future for item in items))
+    
+    def pending_count(self) -> int:
+        """Number of prompts waiting for their batch to be dispatched."""
+        return sum(len(group) for group in self._pending.values())
+    
+    def _flush(self, key: Tuple, pipeline, device: str):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if batch:
+            spawn(self._run_batch(key, pipeline, device, batch), "generation batch")
+    
+    async def _run_batch(self, key: Tuple, pipeline, device: str, batch: List[_PendingGeneration]):
+        _, repo_id, vae, width, height, steps, guidance = key
+        
+        # Requests abandoned while waiting for the batch window are not worth running
+        batch = [item for item in batch if not item.future.done()]
+        if not batch:
+            return
+        
+        # One generator per sample keeps seeded requests reproducible
+        # regardless of which other requests share the batch
+        generators = []
+        for item in batch:
+            generator = torch.Generator(device=device)
+            if item.seed is not None:
+                generator.manual_seed(item.seed)
+            else:
+                generator.seed()
+            generators.append(generator)
+        
+        gen_params = {
+            "num_inference_steps": steps,
+            "width": width,
+            "height": height,
+            "guidance_scale": guidance,
+            "generator": generators
+        }
+        
+        logger.info(f"Running batch of {len(batch)}: {width}x{height}, steps={steps}, guidance={guidance}")
+        
+        try:
+            if self.workers is not None:
+                # Unseeded requests get their seed here, so workers only ever see explicit ones
+                images = await self.workers.generate(
+                    repo_id,
+                    vae,
+                    [item.prompt for item in batch],
+                    [item.negative_prompt for item in batch],
+                    [generator.initial_seed() for generator in generators],
+                    width,
+                    height,
+                    steps,
+                    guidance,
+                    [item.progress for item in batch]
+                )
+            else:
+                # Text-encoder outputs come from the shared cache, so retried prompts skip CLIP
+                embeds = await self.executor.submit(
+                    self.prompt_cache.encode,
+                    repo_id,
+                    pipeline,
+                    [item.prompt for item in batch],
+                    [item.negative_prompt for item in batch],
+                    guidance
+                )
+                result = await self.executor.run_pipeline(
+                    pipeline, progress=[item.progress for item in batch], **gen_params, **embeds
+                )
+                images = result.images
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        
+        for item, image in zip(batch, images):
+            if not item.future.done():
+                item.future.set_result(image)
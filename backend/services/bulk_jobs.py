@@ -0,0 +1,460 @@
+import asyncio
+import csv
+import json
+import logging
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
+
+from services.admission import AdmissionController, AdmissionRejected
+from services.background import spawn
+from services.model_loader import VAE_MODES
+from services.pipeline import SDXSPipeline
+from services.previews import StepProgress
+
+logger = logging.getLogger(__name__)
+
+BULK_INPUT_FORMATS = ("jsonl", "csv")
+
+class BulkPrompt:
+    """One row of a bulk input file: a prompt and the images to render for it."""
+    
+    def __init__(
+        self,
+        row_id: str,
+        prompt: str,
+        negative_prompt: Optional[str],
+        size: str,
+        steps: int,
+        guidance: float,
+        seeds: List[Optional[int]],
+        vae: str
+    ):
+        self.row_id = row_id
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.size = size
+        self.steps = steps
+        self.guidance = guidance
+        self.seeds = seeds
+        self.vae = vae
+    
+    @property
+    def bucket(self) -> Tuple:
+        """Rows sharing a bucket can share pipeline calls."""
+        width, height = map(int, self.size.split("x"))
+        return (width * height, self.size, self.steps, self.guidance, self.vae)
+
+def _input_rows(path: Path, input_format: str) -> Iterator[Tuple[int, dict]]:
+    with open(path, newline="", encoding="utf-8") as f:
+        if input_format == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, {key: value for key, value in row.items() if key and value not in (None, "")}
+            return
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Line {line_number}: invalid JSON ({e})")
+            if not isinstance(row, dict):
+                raise ValueError(f"Line {line_number}: expected a JSON object")
+            yield line_number, row
+
+def read_prompts(path: Path, input_format: str, defaults: dict, max_images: int = 8) -> Iterator[BulkPrompt]:
+    """Parse a JSONL or CSV prompt file row by row.
+    
+    Columns are the generate request fields (``prompt``, ``negativePrompt``,
+    ``size``, ``steps``, ``guidance``, ``seed``, ``numImages``, ``vae``) plus
+    an optional ``id``; missing ones come from ``defaults``. Rows without an
+    id are keyed by line number, which is stable across resumes of the same file.
+    """
+    for line_number, row in _input_rows(path, input_format):
+        try:
+            prompt = str(row.get("prompt") or "").strip()
+            if not prompt:
+                raise ValueError("prompt is required")
+            size = str(row.get("size") or defaults["size"])
+            width, height = map(int, size.split("x"))
+            if width <= 0 or height <= 0:
+                raise ValueError(f"invalid size {size}")
+            steps = int(row.get("steps") or defaults["steps"])
+            if steps < 1:
+                raise ValueError("steps must be at least 1")
+            guidance = float(row.get("guidance", defaults["guidance"]))
+            vae = str(row.get("vae") or defaults["vae"])
+            if vae not in VAE_MODES:
+                raise ValueError(f"unknown VAE {vae}")
+            num_images = int(row.get("numImages") or 1)
+            if not 1 <= num_images <= max_images:
+                raise ValueError(f"numImages must be between 1 and {max_images}")
+            seed = row.get("seed")
+            seeds = [None if seed is None else int(seed) + i for i in range(num_images)]
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Line {line_number}: {e}")
+        
+        yield BulkPrompt(
+            str(row.get("id") or line_number),
+            prompt,
+            row.get("negativePrompt") or None,
+            f"{width}x{height}",
+            steps,
+            guidance,
+            seeds,
+            vae
+        )
+
+class BulkRun:
+    """A bulk generation run, kept in its own directory so it can resume.
+    
+    ``run.json`` holds the settings and last status, ``images/`` the outputs
+    and ``manifest.jsonl`` one line per finished prompt. The manifest doubles
+    as the checkpoint: a resumed run skips every row it lists as completed.
+    """
+    
+    def __init__(
+        self,
+        directory: Path,
+        input_path: Path,
+        input_format: str,
+        repo_id: Optional[str],
+        defaults: dict,
+        run_id: Optional[str] = None
+    ):
+        self.id = run_id or str(uuid.uuid4())
+        self.directory = directory
+        self.input_path = input_path
+        self.input_format = input_format
+        self.repo_id = repo_id
+        self.defaults = defaults  # size, steps, guidance and vae for rows that leave them out
+        self.status = "queued"  # queued, running, completed, failed, cancelled, interrupted
+        self.error: Optional[str] = None
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0  # Rows already completed by an earlier attempt
+        self.images = 0
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._progress: Set[StepProgress] = set()
+        self._cancel_requested = False
+    
+    @property
+    def images_dir(self) -> Path:
+        return self.directory / "images"
+    
+    @property
+    def manifest_path(self) -> Path:
+        return self.directory / "manifest.jsonl"
+    
+    def is_active(self) -> bool:
+        return self.status in ("queued", "running")
+    
+    @classmethod
+    def load(cls, directory: Path) -> "BulkRun":
+        state = json.loads((directory / "run.json").read_text())
+        run = cls(
+            directory,
+            Path(state["inputPath"]),
+            state["inputFormat"],
+            state.get("repoId"),
+            state["defaults"],
+            state["runId"]
+        )
+        run.status = state["status"]
+        run.error = state.get("error")
+        run.created_at = state["createdAt"]
+        run.updated_at = state["updatedAt"]
+        for key in ("total", "completed", "failed", "skipped", "images"):
+            setattr(run, key, state.get(key, 0))
+        return run
+    
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        state = {
+            "runId": self.id,
+            "inputPath": str(self.input_path),
+            "inputFormat": self.input_format,
+            "repoId": self.repo_id,
+            "defaults": self.defaults,
+            **self.to_dict()
+        }
+        tmp_path = self.directory / ".run.json.tmp"
+        tmp_path.write_text(json.dumps(state, indent=2))
+        tmp_path.replace(self.directory / "run.json")
+    
+    def set_status(self, status: str, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        self.updated_at = time.time()
+        self.save()
+    
+    def finished_rows(self) -> Set[str]:
+        """Ids of rows the manifest records as completed; a later retry overrides a failure."""
+        statuses: Dict[str, str] = {}
+        if self.manifest_path.is_file():
+            with open(self.manifest_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash; that row simply runs again
+                        continue
+                    statuses[entry["id"]] = entry["status"]
+        return {row_id for row_id, status in statuses.items() if status == "completed"}
+    
+    def record(self, prompt: BulkPrompt, images: Optional[List[Tuple[str, int]]] = None, error: Optional[str] = None):
+        """Append a finished row to the manifest."""
+        entry = {
+            "id": prompt.row_id,
+            "status": "failed" if error else "completed",
+            "prompt": prompt.prompt,
+            "negativePrompt": prompt.negative_prompt,
+            "size": prompt.size,
+            "steps": prompt.steps,
+            "guidance": prompt.guidance,
+            "vae": prompt.vae,
+            "images": [
+                {"path": str(Path(path).relative_to(self.directory)), "seed": seed}
+                for path, seed in images or []
+            ],
+            "error": error,
+            "finishedAt": time.time()
+        }
+        with open(self.manifest_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        if error:
+            self.failed += 1
+        else:
+            self.completed += 1
+            self.images += len(entry["images"])
+        self.updated_at = entry["finishedAt"]
+    
+    def cancel(self):
+        self._cancel_requested = True
+        for progress in list(self._progress):
+            progress.cancel()
+    
+    def to_dict(self) -> dict:
+        return {
+            "runId": self.id,
+            "status": self.status,
+            "repoId": self.repo_id,
+            "total": self.total,
+            "completed": self.completed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "images": self.images,
+            "error": self.error,
+            "createdAt": self.created_at,
+            "updatedAt": self.updated_at
+        }
+
+class BulkGenerator:
+    """Renders bulk runs through ``SDXSPipeline`` and its batcher.
+    
+    Rows are sorted into (size, steps, guidance, VAE) buckets and up to
+    ``concurrency`` of them are kept in flight, so the batcher sees a steady
+    stream of requests with the same key and dispatches full batches. With
+    an ``admission`` controller each row queues at ``priority``, which keeps
+    a bulk run from starving interactive requests.
+    """
+    
+    def __init__(
+        self,
+        pipeline: SDXSPipeline,
+        concurrency: int = 4,
+        admission: Optional[AdmissionController] = None,
+        priority: int = -1,
+        max_images: int = 8
+    ):
+        self.pipeline = pipeline
+        self.concurrency = max(1, concurrency)
+        self.admission = admission
+        self.priority = priority
+        self.max_images = max_images
+        logger.info(f"Bulk generation: concurrency={self.concurrency}, priority={priority}")
+    
+    def validate(self, run: BulkRun) -> int:
+        """Parse a run's whole input up front; returns the row count or raises ValueError."""
+        row_ids = set()
+        for prompt in read_prompts(run.input_path, run.input_format, run.defaults, self.max_images):
+            if prompt.row_id in row_ids:
+                raise ValueError(f"Duplicate row id {prompt.row_id}")
+            row_ids.add(prompt.row_id)
+        return len(row_ids)
+    
+    async def run(self, run: BulkRun):
+        run._cancel_requested = False
+        finished = run.finished_rows()
+        prompts = list(read_prompts(run.input_path, run.input_format, run.defaults, self.max_images))
+        pending = [prompt for prompt in prompts if prompt.row_id not in finished]
+        # Stable sort, so rows keep their file order within a bucket
+        pending.sort(key=lambda prompt: prompt.bucket)
+        
+        run.total = len(prompts)
+        run.skipped = len(prompts) - len(pending)
+        run.completed = run.failed = run.images = 0
+        run.images_dir.mkdir(parents=True, exist_ok=True)
+        run.set_status("running")
+        logger.info(
+            f"Bulk run {run.id}: {len(pending)} of {len(prompts)} prompt(s) to render "
+            f"in {len({prompt.bucket for prompt in pending})} bucket(s)"
+        )
+        
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        for prompt in pending:
+            await slots.acquire()
+            if run._cancel_requested:
+                slots.release()
+                break
+            task = asyncio.ensure_future(self._render(run, prompt))
+            tasks.add(task)
+            task.add_done_callback(lambda t: (tasks.discard(t), slots.release()))
+        await asyncio.gather(*tasks)
+        
+        if run._cancel_requested:
+            run.set_status("cancelled")
+        else:
+            run.set_status("completed")
+        logger.info(
+            f"Bulk run {run.id} {run.status}: {run.completed} completed, {run.failed} failed, "
+            f"{run.skipped} skipped, {run.images} image(s)"
+        )
+    
+    async def _render(self, run: BulkRun, prompt: BulkPrompt):
+        progress = StepProgress()
+        run._progress.add(progress)
+        try:
+            images = await self._generate(run, prompt, progress)
+            # Only checkpoint rows whose images are durably on disk
+            await self.pipeline.image_store.wait_written([Path(path) for path, _ in images])
+        except Exception as e:
+            if run._cancel_requested:
+                return
+            logger.warning(f"Bulk run {run.id} row {prompt.row_id} failed: {e}")
+            run.record(prompt, error=str(e))
+            return
+        finally:
+            run._progress.discard(progress)
+        run.record(prompt, images=images)
+    
+    async def _generate(self, run: BulkRun, prompt: BulkPrompt, progress: StepProgress) -> List[Tuple[str, int]]:
+        def generate():
+            return self.pipeline.generate_batch(
+                prompt=prompt.prompt,
+                negative_prompt=prompt.negative_prompt,
+                size=prompt.size,
+                steps=prompt.steps,
+                guidance=prompt.guidance,
+                seeds=prompt.seeds,
+                repo_id=run.repo_id,
+                progress=progress,
+                vae=prompt.vae,
+                images_dir=run.images_dir
+            )
+        
+        if self.admission is None:
+            return await generate()
+        while True:
+            try:
+                async with self.admission.admit(self.priority):
+                    return await generate()
+            except AdmissionRejected as e:
+                # A full queue only delays a bulk row, it never fails it
+                await asyncio.sleep(e.retry_after or 1.0)
+
+class BulkInputTooLarge(ValueError):
+    """An uploaded prompt file went over the manager's size limit."""
+
+class BulkRunManager:
+    """Creates, tracks and runs bulk runs under ``root``, one at a time."""
+    
+    def __init__(self, root: Path, generator: BulkGenerator, max_input_bytes: int = 0):
+        self.root = root
+        self.generator = generator
+        self.max_input_bytes = max_input_bytes  # 0 means no limit
+        self._runs: Dict[str, BulkRun] = {}
+        self._lock = asyncio.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+    
+    def recover(self):
+        """List the runs found on disk; any still queued or running were interrupted and can be resumed."""
+        for directory in sorted(self.root.iterdir()):
+            if not (directory / "run.json").is_file():
+                continue
+            try:
+                run = BulkRun.load(directory)
+            except Exception as e:
+                logger.warning(f"Skipping unreadable bulk run {directory}: {e}")
+                continue
+            if run.is_active():
+                run.set_status("interrupted")
+            self._runs.setdefault(run.id, run)
+    
+    async def create(
+        self,
+        chunks: AsyncIterator[bytes],
+        input_format: str,
+        repo_id: Optional[str],
+        defaults: dict
+    ) -> BulkRun:
+        """Stream an uploaded prompt file into a new run directory and validate it."""
+        run_id = str(uuid.uuid4())
+        directory = self.root / run_id
+        directory.mkdir(parents=True)
+        input_path = directory / f"input.{input_format}"
+        try:
+            with open(input_path, "wb") as f:
+                size = 0
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if self.max_input_bytes and size > self.max_input_bytes:
+                        raise BulkInputTooLarge(f"The input is larger than {self.max_input_bytes} bytes")
+                    f.write(chunk)
+            run = BulkRun(directory, input_path, input_format, repo_id, defaults, run_id)
+            run.total = await asyncio.to_thread(self.generator.validate, run)
+            if not run.total:
+                raise ValueError("The input has no prompts")
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        run.save()
+        self._runs[run.id] = run
+        return run
+    
+    def get(self, run_id: str) -> Optional[BulkRun]:
+        return self._runs.get(run_id)
+    
+    def runs(self) -> List[BulkRun]:
+        return sorted(self._runs.values(), key=lambda run: run.created_at)
+    
+    def start(self, run: BulkRun):
+        """Queue a new or resumed run behind the one currently rendering."""
+        run.set_status("queued")
+        spawn(self._run(run), f"bulk run {run.id}")
+    
+    def cancel(self, run_id: str) -> Optional[BulkRun]:
+        """Cancel an active run; returns None if it is not active."""
+        run = self._runs.get(run_id)
+        if run is None or not run.is_active():
+            return None
+        run.cancel()
+        if run.status == "queued":
+            run.set_status("cancelled")
+        return run
+    
+    async def _run(self, run: BulkRun):
+        async with self._lock:
+            if run.status != "queued":
+                return
+            try:
+                await self.generator.run(run)
+            except Exception as e:
+                logger.error(f"Bulk run {run.id} failed: {e}")
+                run.set_status("failed", str(e))
@@ -0,0 +1,169 @@
+import asyncio
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+from services.image_cache import CachedImage
+from services.image_store import IMAGE_FORMATS, ImageStore
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DERIVED_DIR = "derived"
+
+class DerivativeStore:
+    """Resized and re-encoded copies of stored images, made on first request.
+    
+    A derivative of ``<folder>/ab/cd/<stem>.png`` is written next to it as
+    ``<folder>/ab/cd/derived/<stem>.w256.webp``, outside the storage index,
+    and goes into the hot image cache like any served image. Requested widths
+    snap up to the nearest of ``widths`` so arbitrary ``w`` values cannot fill
+    the disk. Originals never change, so a derivative is valid for as long as
+    its original exists; ``remove`` drops them together.
+    """
+    
+    def __init__(
+        self,
+        image_store: ImageStore,
+        widths: List[int],
+        quality: int = 80,
+        max_workers: int = 2
+    ):
+        if not widths:
+            raise ValueError("At least one derivative width is required")
+        self.image_store = image_store
+        self.widths = sorted(widths)
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-derive")
+        self._inflight: Dict[Path, asyncio.Future] = {}
+        self.created = 0
+        self._created_lock = threading.Lock()
+        logger.info(f"Derivative store: widths={self.widths}, quality={quality}, workers={max_workers}")
+    
+    def snap_width(self, width: int) -> int:
+        for allowed in self.widths:
+            if allowed >= width:
+                return allowed
+        return self.widths[-1]
+    
+    def path_for(self, directory: Path, filename: str, width: int, image_format: str) -> Path:
+        """Where the derivative of an image is cached, next to the image's canonical location."""
+        extension = IMAGE_FORMATS[image_format][1]
+        return self._derived_dir(directory, filename) / f"{Path(filename).stem}.w{width}.{extension}"
+    
+    async def has_original(self, directory: Path, filename: str) -> bool:
+        """Whether the image a derivative is made from still exists (cached, pending or on disk)."""
+        return await self.image_store.validators(self.image_store.resolve(directory, filename)) is not None
+    
+    async def load(self, directory: Path, filename: str, width: int, image_format: str) -> Optional[CachedImage]:
+        """Encoded derivative from the hot cache, disk or a fresh resize; None if the original does not exist."""
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format: {image_format}")
+        width = self.snap_width(width)
+        path = self.path_for(directory, filename, width, image_format)
+        # A derivative left behind by a deleted original is not served
+        if not await self.has_original(directory, filename):
+            return None
+        
+        # Concurrent requests for the same derivative share one resize
+        inflight = self._inflight.get(path)
+        if inflight is None:
+            existing = await self.image_store.load(path)
+            if existing is not None:
+                return existing
+            inflight = self._inflight.get(path)
+        if inflight is None:
+            source = self.image_store.resolve(directory, filename)
+            inflight = asyncio.ensure_future(self._create_async(path, source, width, image_format))
+            self._inflight[path] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(path, None))
+        return await asyncio.shield(inflight)
+    
+    def remove(self, directory: Path, filename: str):
+        """Delete every derivative of a deleted original."""
+        derived = self._derived_dir(directory, filename)
+        if not derived.is_dir():
+            return
+        for path in derived.glob(f"{Path(filename).stem}.w*"):
+            try:
+                path.unlink()
+            except OSError as e:
+                logger.warning(f"Could not delete {path}: {e}")
+            self.image_store.image_cache.remove(path)
+    
+    def stats(self) -> dict:
+        return {"widths": self.widths, "quality": self.quality, "created": self.created}
+    
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+    
+    def _derived_dir(self, directory: Path, filename: str) -> Path:
+        # Beside the image's shard even when the original still sits flat, so lookups and removal agree
+        storage = self.image_store.storage
+        original = storage.shard_path(directory, filename) if storage is not None else directory / filename
+        return original.parent / DERIVED_DIR
+    
+    async def _create_async(self, path: Path, source: Path, width: int, image_format: str) -> Optional[CachedImage]:
+        original = None
+        if self.image_store.is_pending(source):
+            # Not on disk yet; resize the in-memory copy
+            original = await self.image_store.open_image(source)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._create, path, source, original, width, image_format
+        )
+    
+    def _create(
+        self,
+        path: Path,
+        source: Path,
+        original: Optional[Image.Image],
+        width: int,
+        image_format: str
+    ) -> Optional[CachedImage]:
+        try:
+            with metrics.time_stage("image_derive"):
+                if original is None:
+                    with Image.open(source) as opened:
+                        # JPEG sources decode straight at a reduced scale
+                        opened.draft("RGB", (width, width * opened.height // opened.width))
+                        original = opened.convert("RGB")
+                data = self.encode(self.resize(original, width), image_format)
+        except FileNotFoundError:
+            return None
+        
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        # Resizes run on several pool threads
+        with self._created_lock:
+            self.created += 1
+        return self.image_store.image_cache.put(path, data, IMAGE_FORMATS[image_format][2], path.stat().st_mtime)
+    
+    @staticmethod
+    def resize(image: Image.Image, width: int) -> Image.Image:
+        """Downscale to ``width``, keeping the aspect ratio; never upscales."""
+        if image.width <= width:
+            return image
+        height = max(1, round(image.height * width / image.width))
+        # Box-reduce by an integer factor first, then a cheap bilinear pass for the remainder
+        return image.resize((width, height), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    
+    def encode(self, image: Image.Image, image_format: str) -> bytes:
+        pil_format = IMAGE_FORMATS[image_format][0]
+        buffer = io.BytesIO()
+        if image_format == "png":
+            image.save(buffer, format=pil_format, compress_level=1)
+        elif image_format == "webp":
+            # method 2 trades a little size for several times faster encoding than the default
+            image.save(buffer, format=pil_format, quality=self.quality, method=2)
+        else:
+            image.save(buffer, format=pil_format, quality=self.quality)
+        return buffer.getvalue()
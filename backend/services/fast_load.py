@@ -0,0 +1,220 @@
+import importlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import diffusers
+import torch
+from accelerate import init_empty_weights
+from diffusers import DiffusionPipeline, ModelMixin
+
+from services.metrics import metrics
+from services.result_cache import model_fingerprint
+
+logger = logging.getLogger(__name__)
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+def load_safetensors_mmap(path: Path) -> Dict[str, torch.Tensor]:
+    """Tensors of a safetensors file as views into a single private memory map.
+    
+    Nothing is copied: pages are read on first touch straight from the page
+    cache, so every process mapping the same file shares them.
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    
+    storage = torch.UntypedStorage.from_file(str(path), shared=False, nbytes=path.stat().st_size)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        if dtype is None:
+            raise ValueError(f"Unsupported dtype {info['dtype']} for {name} in {path}")
+        offset = data_start + info["data_offsets"][0]
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        if offset % itemsize:
+            raise ValueError(f"Misaligned tensor {name} in {path}")
+        tensors[name] = torch.empty(0, dtype=dtype).set_(storage, offset // itemsize, info["shape"])
+    return tensors
+
+def _weight_files(directory: Path) -> List[Path]:
+    """Safetensors weights of a component, skipping variants (``*.fp16.safetensors``) when a default exists."""
+    files = sorted(directory.glob("*.safetensors"))
+    return [f for f in files if "." not in f.stem] or files
+
+def load_module_mmap(module_class, directory: Path, torch_dtype: Optional[torch.dtype] = None) -> torch.nn.Module:
+    """Build a diffusers or transformers model with memory-mapped weights.
+    
+    The module is created without allocating parameters and the mapped
+    tensors are assigned in place of them. A dtype that differs from the
+    file's forces a converted copy, which is what snapshots avoid.
+    """
+    files = _weight_files(directory)
+    if not files:
+        raise FileNotFoundError(f"No safetensors weights in {directory}")
+    state = {}
+    for file in files:
+        state.update(load_safetensors_mmap(file))
+    
+    with init_empty_weights():
+        if issubclass(module_class, ModelMixin):
+            module = module_class.from_config(module_class.load_config(str(directory)))
+        else:
+            module = module_class(module_class.config_class.from_pretrained(str(directory)))
+    module.load_state_dict(state, strict=False, assign=True)
+    
+    missing = [name for name, tensor in module.state_dict().items() if tensor.is_meta]
+    if missing:
+        raise ValueError(f"{directory} is missing weights for {', '.join(missing[:5])}")
+    if torch_dtype is not None and module.dtype != torch_dtype:
+        module = module.to(torch_dtype)
+    return module.eval()
+
+def load_pipeline_mmap(model_path: Path, pipeline_class=DiffusionPipeline, torch_dtype: Optional[torch.dtype] = None):
+    """Assemble a pipeline from a local diffusers folder, memory-mapping every model component."""
+    index = json.loads((model_path / "model_index.json").read_text())
+    if pipeline_class is DiffusionPipeline:
+        pipeline_class = getattr(diffusers, index["_class_name"])
+    
+    components = {}
+    for name, spec in index.items():
+        if name.startswith("_") or not isinstance(spec, list):
+            continue
+        library, class_name = spec
+        if library is None or class_name is None or name == "safety_checker":
+            components[name] = None
+            continue
+        component_class = getattr(importlib.import_module(library), class_name)
+        if issubclass(component_class, torch.nn.Module):
+            components[name] = load_module_mmap(component_class, model_path / name, torch_dtype)
+        else:
+            components[name] = component_class.from_pretrained(str(model_path / name))
+    
+    parameters = inspect.signature(pipeline_class.__init__).parameters
+    kwargs = {name: components.get(name) for name in parameters if name not in ("self", "requires_safety_checker")}
+    if "requires_safety_checker" in parameters:
+        kwargs["requires_safety_checker"] = False
+    return pipeline_class(**kwargs)
+
+def load_pipeline(pipeline_class, model_path: Path, torch_dtype: torch.dtype, fast: bool = True):
+    """Load a pipeline from a local folder, memory-mapped when ``fast`` and the layout allows it."""
+    if fast:
+        start = time.perf_counter()
+        try:
+            pipeline = load_pipeline_mmap(model_path, pipeline_class, torch_dtype)
+            logger.info(f"Memory-mapped {model_path} in {time.perf_counter() - start:.1f}s")
+            return pipeline
+        except Exception as e:
+            logger.warning(f"Fast load of {model_path} failed, using from_pretrained: {e}")
+    return pipeline_class.from_pretrained(
+        str(model_path),
+        torch_dtype=torch_dtype,
+        safety_checker=None,
+        use_safetensors=True
+    )
+
+def load_module(module_class, directory: Path, torch_dtype: torch.dtype, fast: bool = True) -> torch.nn.Module:
+    """Load a single model component, memory-mapped when ``fast`` and the layout allows it."""
+    if fast:
+        try:
+            return load_module_mmap(module_class, directory, torch_dtype)
+        except Exception as e:
+            logger.warning(f"Fast load of {directory} failed, using from_pretrained: {e}")
+    return module_class.from_pretrained(str(directory), torch_dtype=torch_dtype, use_safetensors=True)
+
+class PipelineSnapshots:
+    """Serving-ready copies of loaded pipelines, kept under ``MODELS_DIR``.
+    
+    A snapshot stores every component already converted to the serving
+    dtype, with the scheduler swap and extra modules (the large VAE) baked
+    in, so loading it is a plain memory map with no conversion copies.
+    Snapshots are keyed by repo and dtype and record the fingerprint of the
+    weights they were made from, so a re-downloaded or re-converted model
+    gets a fresh snapshot on its next load.
+    """
+    
+    META_FILE = "snapshot.json"
+    
+    def __init__(self, root: Path):
+        self.root = root
+    
+    def path(self, repo_id: str, dtype: torch.dtype) -> Path:
+        return self.root / f"{repo_id.replace('/', '_')}-{str(dtype).replace('torch.', '')}"
+    
+    def find(self, repo_id: str, dtype: torch.dtype, model_path: Path) -> Optional[Path]:
+        """Snapshot folder of a repo in a dtype, if one was written from the weights now at ``model_path``."""
+        path = self.path(repo_id, dtype)
+        if not (path / "model_index.json").is_file():
+            return None
+        if not self._is_current(path, model_fingerprint(model_path)):
+            logger.info(f"Snapshot {path} was made from other weights than {model_path}, rebuilding it")
+            return None
+        return path
+    
+    def save(
+        self,
+        repo_id: str,
+        dtype: torch.dtype,
+        model_path: Path,
+        pipeline,
+        extra_modules: Optional[Dict[str, torch.nn.Module]] = None
+    ) -> Path:
+        """Write a snapshot of the weights at ``model_path``; it only becomes visible once complete."""
+        target = self.path(repo_id, dtype)
+        source = model_fingerprint(model_path)
+        # Per-process staging, so concurrent writers cannot interleave files
+        staging = target.with_name(f"{target.name}.tmp-{os.getpid()}")
+        shutil.rmtree(staging, ignore_errors=True)
+        with metrics.time_stage("snapshot_save"):
+            pipeline.save_pretrained(str(staging), safe_serialization=True)
+            for name, module in (extra_modules or {}).items():
+                module.save_pretrained(str(staging / name), safe_serialization=True)
+            (staging / self.META_FILE).write_text(json.dumps({"source": source}))
+        
+        if target.exists():
+            if self._is_current(target, source):
+                # Another process finished the same snapshot first
+                shutil.rmtree(staging, ignore_errors=True)
+                return target
+            # Processes still mapping the stale snapshot keep their open files after it is removed
+            stale = target.with_name(f"{target.name}.stale-{os.getpid()}")
+            try:
+                target.rename(stale)
+            except OSError:
+                pass
+            shutil.rmtree(stale, ignore_errors=True)
+        try:
+            staging.rename(target)
+        except OSError:
+            # Another process replaced it at the same time
+            shutil.rmtree(staging, ignore_errors=True)
+            return target
+        logger.info(f"Saved {dtype} snapshot of {repo_id} to {target}")
+        return target
+    
+    def _is_current(self, path: Path, source: str) -> bool:
+        try:
+            return json.loads((path / self.META_FILE).read_text()).get("source") == source
+        except (OSError, ValueError):
+            # Snapshots written before fingerprints were recorded are treated as stale
+            return False
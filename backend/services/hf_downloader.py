@@ -1,15 +1,38 @@
+import asyncio
 import os
 import re
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 import logging
-from huggingface_hub import snapshot_download, hf_hub_url, list_repo_files
+from huggingface_hub import snapshot_download, hf_hub_url, list_repo_files, HfApi
+
+from services.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+class DownloadProgress:
+    """Byte and file counters for an in-flight repository download."""
+    
+    def __init__(self):
+        self.bytes_downloaded = 0
+        self.bytes_total: Optional[int] = None
+        self.files_done = 0
+        self.files_total: Optional[int] = None
+    
+    def to_dict(self) -> dict:
+        return {
+            "bytesDownloaded": self.bytes_downloaded,
+            "bytesTotal": self.bytes_total,
+            "filesDone": self.files_done,
+            "filesTotal": self.files_total
+        }
+
 class HFDownloader:
-    def __init__(self, models_dir: Path):
+    def __init__(self, models_dir: Path, poll_interval: float = 0.5):
         self.models_dir = models_dir
+        self.poll_interval = poll_interval
+        self._downloads: Dict[str, asyncio.Task] = {}
+        self._progress: Dict[str, DownloadProgress] = {}
     
     def parse_repo_id(self, model_card_url: str) -> str:
         """Extract repo_id from HuggingFace URL."""
@@ -26,10 +49,31 @@ class HFDownloader:
         
         raise ValueError(f"Could not parse repo_id from: {model_card_url}")
     
+    def local_path(self, repo_id: str) -> Path:
+        """Directory a repo is (or would be) downloaded to under ``models_dir``."""
+        return self.models_dir / repo_id.replace('/', '_')
+    
+    def get_progress(self, repo_id: str) -> Optional[DownloadProgress]:
+        """Progress of the current or most recent download of a repo."""
+        return self._progress.get(repo_id)
+    
     async def download_model(self, repo_id: str) -> Path:
-        """Download model from HuggingFace."""
+        """Download model from HuggingFace.
+        
+        Concurrent calls for the same repo share a single download.
+        """
+        task = self._downloads.get(repo_id)
+        if task is None:
+            task = asyncio.ensure_future(self._download(repo_id))
+            self._downloads[repo_id] = task
+            task.add_done_callback(lambda _: self._downloads.pop(repo_id, None))
+        else:
+            logger.info(f"Download of {repo_id} already in progress, waiting for it")
+        return await asyncio.shield(task)
+    
+    async def _download(self, repo_id: str) -> Path:
         try:
-            model_path = self.models_dir / repo_id.replace('/', '_')
+            model_path = self.local_path(repo_id)
             
             # Check if already downloaded
             if model_path.exists():
@@ -38,13 +82,27 @@ class HFDownloader:
             
             logger.info(f"Downloading model {repo_id} from HuggingFace...")
             
-            # Download the entire repository
-            download_path = snapshot_download(
+            progress = DownloadProgress()
+            self._progress[repo_id] = progress
+            sizes = await asyncio.to_thread(self._list_file_sizes, repo_id)
+            if sizes:
+                progress.files_total = len(sizes)
+                progress.bytes_total = sum(sizes.values())
+            
+            # Download the entire repository in a worker thread, polling the
+            # target directory to report progress while it runs
+            download = asyncio.ensure_future(asyncio.to_thread(
+                snapshot_download,
                 repo_id=repo_id,
                 local_dir=str(model_path),
                 local_dir_use_symlinks=False,
                 resume_download=True
-            )
+            ))
+            with metrics.time_stage("download"):
+                while not download.done():
+                    await asyncio.wait({download}, timeout=self.poll_interval)
+                    await asyncio.to_thread(self._update_progress, progress, model_path, sizes)
+                download_path = download.result()
             
             logger.info(f"Model downloaded successfully to {download_path}")
             return Path(download_path)
@@ -52,3 +110,23 @@ class HFDownloader:
         except Exception as e:
             logger.error(f"Error downloading model: {e}")
             raise Exception(f"Failed to download model {repo_id}: {str(e)}")
+    
+    @staticmethod
+    def _list_file_sizes(repo_id: str) -> Dict[str, int]:
+        """Map each file in the repo to its size, or an empty dict if unavailable."""
+        try:
+            info = HfApi().model_info(repo_id, files_metadata=True)
+            return {sibling.rfilename: sibling.size or 0 for sibling in info.siblings}
+        except Exception as e:
+            logger.warning(f"Could not list files for {repo_id}: {e}")
+            return {}
+    
+    @staticmethod
+    def _update_progress(progress: DownloadProgress, model_path: Path, sizes: Dict[str, int]):
+        if not model_path.exists():
+            return
+        # Partially downloaded files live under .cache until they are complete
+        progress.bytes_downloaded = sum(
+            f.stat().st_size for f in model_path.rglob('*') if f.is_file()
+        )
+        progress.files_done = sum(1 for name in sizes if (model_path / name).is_file())
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+def image_etag(path: Path) -> str:
+    """Strong ETag of an image file.
+    
+    Image filenames are UUIDs (derivatives add their width and format) and
+    files are never rewritten, so the name identifies the content and the tag
+    is known without reading the file.
+    """
+    return f'"{hashlib.sha256(path.name.encode()).hexdigest()[:32]}"'
+
+def last_modified_header(last_modified: float) -> str:
+    return formatdate(int(last_modified), usegmt=True)
+
+class CachedImage:
+    """Encoded image bytes with the validators used for HTTP caching."""
+    
+    def __init__(self, data: bytes, media_type: str, last_modified: float, etag: str):
+        self.data = data
+        self.media_type = media_type
+        self.last_modified = int(last_modified)
+        self.etag = etag
+    
+    @property
+    def last_modified_header(self) -> str:
+        return last_modified_header(self.last_modified)
+
+class ImageCache:
+    """Byte-bounded LRU cache of recently produced and recently served images.
+    
+    Image filenames are UUIDs and never change, so entries never need to be
+    invalidated; they are only evicted to stay within ``max_bytes``.
+    """
+    
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Path, CachedImage]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, path: Path) -> Optional[CachedImage]:
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry
+    
+    def put(self, path: Path, data: bytes, media_type: str, last_modified: float) -> CachedImage:
+        """Cache encoded bytes for a path; safe to call from worker threads."""
+        entry = CachedImage(data, media_type, last_modified, image_etag(path))
+        if len(data) > self.max_bytes:
+            return entry
+        
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= len(old.data)
+            self._entries[path] = entry
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.data)
+        return entry
+    
+    def remove(self, path: Path):
+        """Forget a deleted image."""
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._bytes -= len(entry.data)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,282 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SHARD_NAME = re.compile(r"^[0-9a-f]{2}$")
+
+class ImageStorage:
+    """Hash-sharded layout, metadata index and retention for the served image folders.
+    
+    An image lives at ``<root>/ab/cd/<filename>``, the shard taken from a hash
+    of its filename, so no directory grows past a few hundred files however
+    many images accumulate. URLs keep using bare filenames: the shard is
+    derived, never stored in them. Files from the old flat layout are still
+    found, and with ``migrate_flat`` ``reconcile`` moves them into their shards.
+    
+    The index (SQLite) records each image's size, creation time, parent image
+    and generation parameters. ``sweep`` deletes images older than
+    ``max_age_days`` and then the oldest ones until the total fits ``max_bytes``.
+    """
+    
+    def __init__(
+        self,
+        index_path: Path,
+        roots: List[Path],
+        shard_depth: int = 2,
+        max_age_days: float = 0,
+        max_bytes: int = 0,
+        on_delete: Optional[Callable[[Path, str], None]] = None,
+        migrate_flat: bool = False
+    ):
+        self.index_path = index_path
+        self.base = index_path.parent  # Indexed paths under it are stored relative to it
+        self.roots = [root.resolve() for root in roots]
+        self.shard_depth = shard_depth
+        self.max_age_days = max_age_days  # 0 keeps images forever
+        self.max_bytes = max_bytes  # 0 means no quota
+        self.on_delete = on_delete  # Called with the folder and filename of each deleted image
+        self.migrate_flat = migrate_flat
+        self.deleted = 0
+        self.last_sweep: Optional[float] = None
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(index_path), check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                " path TEXT PRIMARY KEY, filename TEXT NOT NULL, bytes INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, parent TEXT, params TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS images_filename ON images (filename)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS images_created_at ON images (created_at)")
+            self._count, self._bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM images"
+            ).fetchone()
+        logger.info(
+            f"Image storage: {self._count} images indexed at {index_path}, shard_depth={shard_depth}, "
+            f"max_age_days={max_age_days}, max_bytes={max_bytes}"
+        )
+    
+    def manages(self, directory: Path) -> bool:
+        return directory.resolve() in self.roots
+    
+    def shard_path(self, directory: Path, filename: str) -> Path:
+        """Where an image of a managed folder lives; unmanaged folders stay flat."""
+        if not self.manages(directory):
+            return directory / filename
+        digest = hashlib.sha1(filename.encode()).hexdigest()
+        shards = [digest[2 * i:2 * i + 2] for i in range(self.shard_depth)]
+        return directory.joinpath(*shards, filename)
+    
+    def folder_of(self, path: Path) -> Path:
+        """Managed folder an image file belongs to, whether it sits in a shard or flat."""
+        resolved = path.resolve()
+        for root in self.roots:
+            if resolved.is_relative_to(root):
+                shards = resolved.relative_to(root).parts[:-1]
+                if all(SHARD_NAME.match(part) for part in shards):
+                    return root
+        return path.parent
+    
+    def new_path(self, directory: Path, filename: str) -> Path:
+        path = self.shard_path(directory, filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+    
+    def locate(self, directory: Path, filename: str) -> Optional[Path]:
+        """Existing file of an image, in its shard or at its old flat location."""
+        for path in (self.shard_path(directory, filename), directory / filename):
+            if path.is_file():
+                return path
+        return None
+    
+    def record(
+        self,
+        path: Path,
+        size: int,
+        created_at: Optional[float] = None,
+        parent: Optional[str] = None,
+        params: Optional[dict] = None
+    ):
+        """Index a written image; safe to call from worker threads."""
+        with self._lock:
+            self._insert(path, size, created_at or time.time(), parent, params)
+    
+    def metadata(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path, filename, bytes, created_at, parent, params FROM images WHERE filename = ?",
+                (filename,)
+            ).fetchone()
+        if row is None:
+            return None
+        path, filename, size, created_at, parent, params = row
+        return {
+            "filename": filename,
+            "path": path,
+            "bytes": size,
+            "createdAt": created_at,
+            "parent": parent,
+            "params": json.loads(params) if params else None
+        }
+    
+    def reconcile(self):
+        """Bring the index in line with the disk; runs in a worker thread at startup.
+        
+        Flat-layout files move into their shards (or, without ``migrate_flat``,
+        are indexed where they are), files missing from the index are added
+        (from their mtime, without parameters) and rows whose file is gone are
+        dropped.
+        """
+        start = time.perf_counter()
+        moved = added = 0
+        with self._lock:
+            indexed = {row[0] for row in self._conn.execute("SELECT path FROM images")}
+        
+        for root in self.roots:
+            flat = []
+            for entry in list(os.scandir(root)):
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                if self.migrate_flat:
+                    os.replace(entry.path, self.new_path(root, entry.name))
+                    moved += 1
+                else:
+                    flat.append(Path(entry.path))
+            for path in itertools.chain(flat, self._sharded_files(root)):
+                key = self._key(path)
+                if key in indexed:
+                    indexed.discard(key)
+                    continue
+                stat = path.stat()
+                with self._lock:
+                    # An image written since the snapshot above is already indexed, with its parameters
+                    if self._conn.execute("SELECT 1 FROM images WHERE path = ?", (key,)).fetchone() is None:
+                        self._insert(path, stat.st_size, stat.st_mtime, None, None)
+                        added += 1
+        
+        # Whatever is left was indexed but no longer exists
+        with self._lock:
+            for key in indexed:
+                self._remove_row(key)
+        logger.info(
+            f"Image storage reconciled in {time.perf_counter() - start:.1f}s: {moved} moved into shards, "
+            f"{added} indexed, {len(indexed)} missing files dropped"
+        )
+    
+    def sweep(self, is_protected: Callable[[Path], bool] = lambda path: False) -> int:
+        """Delete expired images, then the oldest ones while over quota; returns how many were removed."""
+        self.last_sweep = time.time()
+        victims = []
+        with self._lock:
+            if self.max_age_days:
+                cutoff = time.time() - self.max_age_days * 86400
+                victims.extend(self._conn.execute(
+                    "SELECT path, bytes FROM images WHERE created_at < ? ORDER BY created_at", (cutoff,)
+                ).fetchall())
+            excess = self._bytes - sum(size for _, size in victims) - self.max_bytes
+            if self.max_bytes and excess > 0:
+                expired = {key for key, _ in victims}
+                for key, size in self._conn.execute("SELECT path, bytes FROM images ORDER BY created_at"):
+                    if excess <= 0:
+                        break
+                    if key not in expired:
+                        victims.append((key, size))
+                        excess -= size
+        
+        removed = 0
+        for key, _ in victims:
+            path = self.base / key
+            if is_protected(path):
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not delete {path}: {e}")
+                continue
+            with self._lock:
+                self._remove_row(key)
+            if self.on_delete is not None:
+                self.on_delete(self.folder_of(path), path.name)
+            removed += 1
+        
+        self.deleted += removed
+        if removed:
+            logger.info(f"Image retention removed {removed} image(s), {self._count} left ({self._bytes} bytes)")
+        return removed
+    
+    async def run_retention(self, interval: float, is_protected: Callable[[Path], bool] = lambda path: False):
+        """Sweep every ``interval`` seconds, off the event loop."""
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep, is_protected)
+            except Exception as e:
+                logger.error(f"Image retention sweep failed: {e}")
+            await asyncio.sleep(interval)
+    
+    def stats(self) -> dict:
+        return {
+            "images": self._count,
+            "bytes": self._bytes,
+            "shardDepth": self.shard_depth,
+            "maxAgeDays": self.max_age_days,
+            "maxBytes": self.max_bytes,
+            "deleted": self.deleted,
+            "lastSweep": self.last_sweep
+        }
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    
+    def _sharded_files(self, root: Path) -> Iterator[Path]:
+        def walk(directory: Path, depth: int) -> Iterator[Path]:
+            for entry in os.scandir(directory):
+                if depth < self.shard_depth:
+                    if entry.is_dir() and SHARD_NAME.match(entry.name):
+                        yield from walk(Path(entry.path), depth + 1)
+                elif entry.is_file() and not entry.name.startswith("."):
+                    yield Path(entry.path)
+        return walk(root, 0)
+    
+    def _key(self, path: Path) -> str:
+        try:
+            return str(path.resolve().relative_to(self.base.resolve()))
+        except ValueError:
+            return str(path.resolve())
+    
+    def _insert(self, path: Path, size: int, created_at: float, parent: Optional[str], params: Optional[dict]):
+        key = self._key(path)
+        previous = self._conn.execute("SELECT bytes FROM images WHERE path = ?", (key,)).fetchone()
+        if previous is not None:
+            self._count -= 1
+            self._bytes -= previous[0]
+        self._conn.execute(
+            "INSERT OR REPLACE INTO images (path, filename, bytes, created_at, parent, params)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (key, path.name, size, created_at, parent, json.dumps(params) if params is not None else None)
+        )
+        self._count += 1
+        self._bytes += size
+    
+    def _remove_row(self, key: str):
+        row = self._conn.execute("SELECT bytes FROM images WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            return
+        self._conn.execute("DELETE FROM images WHERE path = ?", (key,))
+        self._count -= 1
+        self._bytes -= row[0]
@@ -0,0 +1,213 @@
+import asyncio
+import io
+import logging
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from services.image_cache import CachedImage, ImageCache, image_etag
+from services.image_storage import ImageStorage
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = {
+    # format: (PIL format, file extension, media type)
+    "png": ("PNG", "png", "image/png"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+
+class _PendingImage:
+    def __init__(self, image: Image.Image, parent: Optional[str] = None, params: Optional[dict] = None):
+        self.image = image
+        self.parent = parent  # Filename of the image this one was derived from
+        self.params = params
+        self.indexed = False  # Whether the write is recorded in the storage index
+        self.encoded: Future = Future()  # resolves to the encoded bytes
+        self.written: Optional[asyncio.Future] = None  # resolves once the file is on disk
+
+class ImageStore:
+    """Write-behind persistence for generated images.
+    
+    ``save`` returns as soon as the image is queued. Encoding and the disk write
+    run on a bounded thread pool. Encoded bytes go straight into the hot image
+    cache, so the image can be served via ``load`` before the write completes.
+    At most ``max_pending`` images are held in memory; further saves wait for a slot.
+    With ``storage``, images of the folders it manages go to hash-sharded
+    paths and are indexed once written.
+    """
+    
+    def __init__(
+        self,
+        image_cache: ImageCache,
+        image_format: str = "png",
+        png_compress_level: int = 6,
+        quality: int = 90,
+        max_workers: int = 2,
+        max_pending: int = 64,
+        storage: Optional[ImageStorage] = None
+    ):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format: {image_format}")
+        self.image_cache = image_cache
+        self.storage = storage
+        self.image_format = image_format
+        self.png_compress_level = png_compress_level
+        self.quality = quality
+        self._pil_format, self.extension, self.media_type = IMAGE_FORMATS[image_format]
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-writer")
+        self._pending: Dict[Path, _PendingImage] = {}
+        self._slots = asyncio.Semaphore(max_pending)
+        logger.info(f"Image store: format={image_format}, workers={max_workers}, max_pending={max_pending}")
+    
+    async def save(
+        self,
+        image: Image.Image,
+        directory: Path,
+        stem: str,
+        parent: Optional[str] = None,
+        params: Optional[dict] = None
+    ) -> Path:
+        """Queue an image for encoding and writing; returns its final path immediately.
+        
+        ``parent`` and ``params`` go into the storage index with the image.
+        """
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        
+        filename = f"{stem}.{self.extension}"
+        pending = _PendingImage(image, parent, params)
+        if self.storage is not None:
+            path = self.storage.new_path(directory, filename)
+            pending.indexed = self.storage.manages(directory)
+        else:
+            path = directory / filename
+        self._pending[path] = pending
+        
+        write = loop.run_in_executor(self._executor, self._encode_and_write, path, pending)
+        write.add_done_callback(lambda f: self._finish(path, f))
+        pending.written = write
+        return path
+    
+    def is_pending(self, path: Path) -> bool:
+        return path in self._pending
+    
+    def resolve(self, directory: Path, filename: str) -> Path:
+        """Current path of an image by folder and filename, or where it would be if it does not exist."""
+        if self.storage is None:
+            return directory / filename
+        path = self.storage.shard_path(directory, filename)
+        if path in self._pending:
+            return path
+        return self.storage.locate(directory, filename) or path
+    
+    def locate(self, path: Path) -> Optional[Path]:
+        """Where a previously saved image is now, following a move into its shard; None if deleted."""
+        path = self.resolve(path.parent, path.name)
+        return path if path in self._pending or path.is_file() else None
+    
+    async def wait_written(self, paths: List[Path]):
+        """Wait until queued images are on disk; raises if any of them could not be written."""
+        writes = [self._pending[path].written for path in paths if path in self._pending]
+        await asyncio.gather(*(asyncio.shield(write) for write in writes))
+        missing = [str(path) for path in paths if not path.is_file()]
+        if missing:
+            raise Exception(f"Failed to write images: {', '.join(missing)}")
+    
+    async def load(self, path: Path) -> Optional[CachedImage]:
+        """Encoded image from the hot cache, the pending queue or disk; None if it does not exist."""
+        cached = self.image_cache.get(path)
+        if cached is not None:
+            return cached
+        
+        pending = self._pending.get(path)
+        if pending is not None:
+            data = await asyncio.wrap_future(pending.encoded)
+            return self.image_cache.get(path) or CachedImage(data, self.media_type, time.time(), image_etag(path))
+        
+        return await asyncio.to_thread(self._load_from_disk, path)
+    
+    async def validators(self, path: Path) -> Optional[Tuple[str, float]]:
+        """ETag and modification time of an image without reading it; None if it does not exist."""
+        cached = self.image_cache.get(path)
+        if cached is not None:
+            return cached.etag, cached.last_modified
+        if path in self._pending:
+            return image_etag(path), time.time()
+        try:
+            stat = await asyncio.to_thread(path.stat)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return image_etag(path), stat.st_mtime
+    
+    async def open_image(self, path: Path) -> Image.Image:
+        """Open an image as RGB, using the in-memory copy while its write is pending."""
+        pending = self._pending.get(path)
+        if pending is not None:
+            return pending.image.convert("RGB")
+        return await asyncio.to_thread(self._open_from_disk, path)
+    
+    def media_type_for(self, path: Path) -> str:
+        for _, extension, media_type in IMAGE_FORMATS.values():
+            if path.suffix == f".{extension}":
+                return media_type
+        return "application/octet-stream"
+    
+    def shutdown(self):
+        """Wait for queued writes to reach disk."""
+        self._executor.shutdown(wait=True)
+        logger.info("Image store flushed")
+    
+    def _encode_and_write(self, path: Path, pending: _PendingImage):
+        try:
+            with metrics.time_stage("image_encode"):
+                data = self.encode(pending.image)
+        except Exception as e:
+            pending.encoded.set_exception(e)
+            raise
+        self.image_cache.put(path, data, self.media_type, time.time())
+        pending.encoded.set_result(data)
+        
+        # Write to a temporary name first so readers never see a partial file
+        with metrics.time_stage("image_write"):
+            tmp_path = path.with_name(f".{path.name}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        # Serve the file's own mtime from now on, matching what a load from disk reports
+        self.image_cache.put(path, data, self.media_type, path.stat().st_mtime)
+        if pending.indexed:
+            self.storage.record(path, len(data), parent=pending.parent, params=pending.params)
+    
+    def encode(self, image: Image.Image) -> bytes:
+        """Encode an image in the configured format."""
+        buffer = io.BytesIO()
+        if self.image_format == "png":
+            image.save(buffer, format=self._pil_format, compress_level=self.png_compress_level)
+        else:
+            image.save(buffer, format=self._pil_format, quality=self.quality)
+        return buffer.getvalue()
+    
+    def _finish(self, path: Path, write: asyncio.Future):
+        self._pending.pop(path, None)
+        self._slots.release()
+        if write.exception() is not None:
+            logger.error(f"Error writing image {path}: {write.exception()}")
+        else:
+            logger.info(f"Image saved to {path}")
+    
+    def _load_from_disk(self, path: Path) -> Optional[CachedImage]:
+        try:
+            data = path.read_bytes()
+            last_modified = path.stat().st_mtime
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        return self.image_cache.put(path, data, self.media_type_for(path), last_modified)
+    
+    @staticmethod
+    def _open_from_disk(path: Path) -> Image.Image:
+        return Image.open(path).convert("RGB")
@@ -0,0 +1,153 @@
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+import torch
+
+from services.cpu_profile import CpuPerformanceProfile
+from services.metrics import metrics
+from services.model_pool import ModelPool
+from services.previews import InferenceCancelled, StepProgress
+
+logger = logging.getLogger(__name__)
+
+class _StepCallback:
+    """Step-end callback that times denoise steps and the decode that follows.
+    
+    The first step is not timed, since nothing marks where the pipeline's
+    setup ends and its denoise loop begins. It also feeds each sample's
+    latents to its ``StepProgress`` for previews, and aborts the call once
+    every sample in it has been cancelled.
+    """
+    
+    def __init__(self, pipeline, progress: List[Optional[StepProgress]]):
+        self.pipeline_name = type(pipeline).__name__
+        self.vae_name = type(pipeline.vae).__name__ if getattr(pipeline, "vae", None) is not None else "none"
+        self.progress = progress
+        self.last = time.perf_counter()
+        self.steps = 0
+    
+    def __call__(self, pipeline, step: int, timestep, callback_kwargs: dict) -> dict:
+        now = time.perf_counter()
+        # The interval before the first callback also covers prompt encoding and latent setup, so it is not a step sample
+        if self.steps:
+            metrics.observe_stage("denoise_step", now - self.last, pipeline=self.pipeline_name)
+        self.last = now
+        self.steps += 1
+        
+        if self.progress:
+            if all(p is not None and p.cancelled for p in self.progress):
+                raise InferenceCancelled("Generation cancelled")
+            
+            latents = callback_kwargs.get("latents")
+            total_steps = getattr(pipeline, "num_timesteps", None) or step + 1
+            for i, progress in enumerate(self.progress):
+                if progress is not None and not progress.cancelled and latents is not None:
+                    progress.on_step(step, total_steps, latents[i])
+        return callback_kwargs
+    
+    def finish(self):
+        # Everything after the last step is the VAE decode and image postprocessing
+        if self.steps:
+            metrics.observe_stage(
+                "vae_decode", time.perf_counter() - self.last, pipeline=self.pipeline_name, vae=self.vae_name
+            )
+
+class InferenceExecutor:
+    """Dedicated worker thread that runs blocking diffusion calls off the event loop.
+    
+    The loaded pipelines share modules and scheduler state (the SDXS img2img
+    refiner reuses the generation UNet), so every pipeline call is funnelled
+    through a single worker to keep them from running concurrently. Pipeline
+    calls on CPU run under the autocast of ``cpu_profile``, if given.
+    
+    With ``model_pool``, the pool's device moves run on this thread too, and a
+    pooled pipeline passed to a call is moved back onto its device first if it
+    was offloaded.
+    """
+    
+    def __init__(self, cpu_profile: Optional[CpuPerformanceProfile] = None, model_pool: Optional[ModelPool] = None):
+        self.cpu_profile = cpu_profile
+        self.model_pool = model_pool
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        if model_pool is not None:
+            model_pool.device_mover = self.schedule
+        logger.info("Inference executor started")
+    
+    async def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a blocking callable on the inference thread and await its result."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._queued += 1
+        return await loop.run_in_executor(
+            self._executor, self._run, time.perf_counter(), functools.partial(fn, *args, **kwargs)
+        )
+    
+    def schedule(self, fn: Callable[[], Any]):
+        """Queue a blocking callable behind the calls already waiting, without awaiting it; safe from any thread."""
+        with self._lock:
+            self._queued += 1
+        future = self._executor.submit(self._run, time.perf_counter(), functools.partial(fn))
+        future.add_done_callback(self._log_failure)
+    
+    def queue_depth(self) -> int:
+        """Calls waiting for the inference thread."""
+        return self._queued
+    
+    def in_flight(self) -> int:
+        """Calls queued or running."""
+        return self._queued + self._running
+    
+    def _run(self, submitted: float, call: Callable[[], Any]) -> Any:
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        metrics.observe_stage("inference_queue_wait", time.perf_counter() - submitted)
+        try:
+            if self.model_pool is not None:
+                for arg in call.args:
+                    self.model_pool.ensure_resident(arg)
+            return call()
+        finally:
+            with self._lock:
+                self._running -= 1
+    
+    async def run_pipeline(self, pipeline, progress: Optional[List[Optional[StepProgress]]] = None, **gen_params):
+        """Run a diffusers pipeline call under inference mode on the inference thread.
+        
+        ``progress`` holds one optional ``StepProgress`` per sample in the batch.
+        """
+        return await self.submit(self._call_pipeline, pipeline, gen_params, progress or [])
+    
+    def _call_pipeline(self, pipeline, gen_params: dict, progress: List[Optional[StepProgress]]):
+        # Everything queued behind a cancelled request would otherwise wait for it
+        if progress and all(p is not None and p.cancelled for p in progress):
+            raise InferenceCancelled("Generation cancelled")
+        
+        callback = _StepCallback(pipeline, progress)
+        if "callback_on_step_end" in inspect.signature(pipeline.__call__).parameters:
+            gen_params = dict(gen_params, callback_on_step_end=callback)
+        autocast = self.cpu_profile.autocast(pipeline.device.type) if self.cpu_profile is not None else nullcontext()
+        with torch.inference_mode(), autocast:
+            result = pipeline(**gen_params)
+        callback.finish()
+        return result
+    
+    @staticmethod
+    def _log_failure(future: Future):
+        if future.exception() is not None:
+            logger.error(f"Scheduled inference-thread call failed: {future.exception()!r}")
+    
+    def shutdown(self):
+        """Stop accepting work and wait for the running call to finish."""
+        self._executor.shutdown(wait=True)
+        logger.info("Inference executor stopped")
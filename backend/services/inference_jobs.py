@@ -0,0 +1,170 @@
+import asyncio
+import copy
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from services.admission import AdmissionController
+from services.job_store import InferenceJob, JobStore
+from services.previews import StepProgress
+
+logger = logging.getLogger(__name__)
+
+JobRunner = Callable[[InferenceJob, StepProgress], Awaitable[dict]]
+
+class InferenceJobManager:
+    """Runs generate and refine requests as background jobs.
+    
+    Jobs go through the same admission queue as synchronous requests. Every
+    state change wakes anyone waiting on the job, which is how the SSE
+    endpoint streams updates without busy polling, and is written to the job
+    store by a single writer thread, in order and off the event loop. A
+    finished job stays in memory until its final state is stored, and old
+    finished jobs are pruned after each one finishes.
+    Running jobs publish latent previews every ``preview_every`` steps and can
+    be cancelled, which stops their denoise loop at the next step.
+    """
+    
+    def __init__(
+        self,
+        store: JobStore,
+        admission: AdmissionController,
+        max_finished_jobs: int = 1000,
+        preview_every: int = 1
+    ):
+        self.store = store
+        self.admission = admission
+        self.max_finished_jobs = max_finished_jobs
+        self.preview_every = preview_every
+        self._active: Dict[str, InferenceJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._progress: Dict[str, StepProgress] = {}
+        self._previews: Dict[str, Tuple[int, int, bytes]] = {}  # job id: (step, total steps, JPEG)
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+    
+    def recover(self):
+        """Fail jobs left unfinished by a previous process; their work is gone."""
+        for job in self.store.list_unfinished():
+            job.status = "failed"
+            job.error = "Server restarted before the job finished"
+            job.updated_at = time.time()
+            self.store.save(job)
+            logger.warning(f"Marked interrupted job {job.id} as failed")
+    
+    async def submit(
+        self,
+        kind: str,
+        params: dict,
+        runner: JobRunner,
+        priority: int = 0,
+        deadline_ms: Optional[float] = None
+    ) -> InferenceJob:
+        """Record a job and start it in the background, returning once it has joined the queue."""
+        # Fail fast instead of recording a job that could never be queued
+        self.admission.check_capacity()
+        
+        job = InferenceJob(kind, params)
+        self._active[job.id] = job
+        self._progress[job.id] = StepProgress(
+            on_preview=lambda step, total, image: self._set_preview(job.id, step, total, image),
+            preview_every=self.preview_every
+        )
+        self._save(job)
+        
+        self._tasks[job.id] = asyncio.ensure_future(self._run(job, runner, priority, deadline_ms))
+        await asyncio.sleep(0)  # let the job reach the admission queue so its position is known
+        logger.info(f"Started {kind} job {job.id}")
+        return job
+    
+    def get(self, job_id: str) -> Optional[InferenceJob]:
+        return self._active.get(job_id) or self.store.get(job_id)
+    
+    def cancel(self, job_id: str) -> Optional[InferenceJob]:
+        """Cancel a queued or running job; returns None if it is not active."""
+        job = self._active.get(job_id)
+        if job is None:
+            return None
+        
+        # The flag stops the denoise loop on the inference thread; cancelling
+        # the task takes the job out of the admission queue or batch it waits in
+        self._progress[job_id].cancel()
+        self._tasks[job_id].cancel()
+        logger.info(f"Cancelling job {job_id}")
+        return job
+    
+    def preview(self, job_id: str) -> Optional[Tuple[int, int, bytes]]:
+        """Latest (step, total steps, JPEG bytes) preview of a running job."""
+        return self._previews.get(job_id)
+    
+    def queue_position(self, job_id: str) -> Optional[int]:
+        """1-based position in the admission queue, or None if not waiting."""
+        return self.admission.queue_position(job_id)
+    
+    async def wait_for_change(self, job_id: str, timeout: float):
+        """Wait until the job changes state or ``timeout`` seconds pass."""
+        event = self._changed.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def shutdown(self):
+        """Finish pending job store writes and close the store."""
+        self._writer.shutdown(wait=True)
+        self.store.close()
+    
+    async def _run(self, job: InferenceJob, runner: JobRunner, priority: int, deadline_ms: Optional[float]):
+        try:
+            async with self.admission.admit(priority, deadline_ms, key=job.id):
+                self._update(job, "running")
+                job.result = await runner(job, self._progress[job.id])
+            self._update(job, "completed")
+        except asyncio.CancelledError:
+            job.error = "Cancelled"
+            self._update(job, "cancelled")
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            job.error = getattr(e, "detail", None) or str(e)
+            self._update(job, "failed")
+        finally:
+            self._tasks.pop(job.id, None)
+            self._progress.pop(job.id, None)
+            self._previews.pop(job.id, None)
+            self._write(self.store.prune, self.max_finished_jobs)
+            # Served from memory until the store has its final state, so it never reads as missing
+            try:
+                await asyncio.wrap_future(self._write(lambda: None))
+            finally:
+                self._active.pop(job.id, None)
+    
+    def _set_preview(self, job_id: str, step: int, total_steps: int, image: bytes):
+        if job_id in self._active:
+            self._previews[job_id] = (step, total_steps, image)
+            self._notify(job_id)
+    
+    def _update(self, job: InferenceJob, status: str):
+        job.status = status
+        job.updated_at = time.time()
+        self._save(job)
+        self._notify(job.id)
+    
+    def _save(self, job: InferenceJob):
+        # A copy, so the write stores this state even if the job changes again before it runs
+        self._write(self.store.save, copy.copy(job))
+    
+    def _write(self, fn: Callable, *args) -> Future:
+        future = self._writer.submit(fn, *args)
+        future.add_done_callback(self._log_write_failure)
+        return future
+    
+    @staticmethod
+    def _log_write_failure(future: Future):
+        if future.exception() is not None:
+            logger.error(f"Job store write failed: {future.exception()!r}")
+    
+    def _notify(self, job_id: str):
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            event.set()
@@ -0,0 +1,171 @@
+import json
+from abc import ABC, abstractmethod
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class InferenceJob:
+    """State of an asynchronous generate or refine request."""
+    
+    TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+    
+    def __init__(
+        self,
+        kind: str,
+        params: dict,
+        job_id: Optional[str] = None,
+        status: str = "queued",
+        result: Optional[dict] = None,
+        error: Optional[str] = None,
+        created_at: Optional[float] = None,
+        updated_at: Optional[float] = None
+    ):
+        self.id = job_id or str(uuid.uuid4())
+        self.kind = kind  # "generate" or "refine"
+        self.params = params
+        self.status = status  # queued, running, completed, failed, cancelled
+        self.result = result
+        self.error = error
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+    
+    def is_finished(self) -> bool:
+        return self.status in self.TERMINAL_STATUSES
+
+class JobStore(ABC):
+    """Persistence for inference jobs. Subclasses decide where job state lives."""
+    
+    @abstractmethod
+    def save(self, job: InferenceJob):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[InferenceJob]:
+        raise NotImplementedError
+    
+    @abstractmethod
+    def list_unfinished(self) -> List[InferenceJob]:
+        raise NotImplementedError
+    
+    @abstractmethod
+    def prune(self, max_finished: int):
+        """Delete the oldest finished jobs beyond ``max_finished``."""
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+
+class MemoryJobStore(JobStore):
+    """Keeps jobs in process memory; they are lost on restart."""
+    
+    def __init__(self):
+        self._jobs: Dict[str, InferenceJob] = {}
+    
+    def save(self, job: InferenceJob):
+        self._jobs[job.id] = job
+    
+    def get(self, job_id: str) -> Optional[InferenceJob]:
+        return self._jobs.get(job_id)
+    
+    def list_unfinished(self) -> List[InferenceJob]:
+        return [job for job in self._jobs.values() if not job.is_finished()]
+    
+    def prune(self, max_finished: int):
+        finished = sorted((job for job in self._jobs.values() if job.is_finished()), key=lambda j: j.updated_at)
+        for job in finished[:-max_finished or None]:
+            del self._jobs[job.id]
+
+class SqliteJobStore(JobStore):
+    """Keeps jobs in a local SQLite database so results survive restarts."""
+    
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL,"
+                " params TEXT NOT NULL, result TEXT, error TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated_at)")
+        logger.info(f"SQLite job store at {path}")
+    
+    def save(self, job: InferenceJob):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, kind, status, params, result, error, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.id,
+                    job.kind,
+                    job.status,
+                    json.dumps(job.params),
+                    json.dumps(job.result) if job.result is not None else None,
+                    job.error,
+                    job.created_at,
+                    job.updated_at
+                )
+            )
+    
+    def get(self, job_id: str) -> Optional[InferenceJob]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, status, params, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        return self._from_row(row) if row else None
+    
+    def list_unfinished(self) -> List[InferenceJob]:
+        placeholders = ",".join("?" * len(InferenceJob.TERMINAL_STATUSES))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, kind, status, params, result, error, created_at, updated_at FROM jobs"
+                f" WHERE status NOT IN ({placeholders})",
+                InferenceJob.TERMINAL_STATUSES
+            ).fetchall()
+        return [self._from_row(row) for row in rows]
+    
+    def prune(self, max_finished: int):
+        placeholders = ",".join("?" * len(InferenceJob.TERMINAL_STATUSES))
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({placeholders}) AND id NOT IN ("
+                f" SELECT id FROM jobs WHERE status IN ({placeholders}) ORDER BY updated_at DESC LIMIT ?)",
+                InferenceJob.TERMINAL_STATUSES + InferenceJob.TERMINAL_STATUSES + (max_finished,)
+            )
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    
+    @staticmethod
+    def _from_row(row) -> InferenceJob:
+        job_id, kind, status, params, result, error, created_at, updated_at = row
+        return InferenceJob(
+            kind,
+            json.loads(params),
+            job_id=job_id,
+            status=status,
+            result=json.loads(result) if result else None,
+            error=error,
+            created_at=created_at,
+            updated_at=updated_at
+        )
+
+def create_job_store(backend: str, sqlite_path: Path) -> JobStore:
+    """Build the job store named by ``backend`` ("memory" or "sqlite")."""
+    if backend == "memory":
+        return MemoryJobStore()
+    if backend == "sqlite":
+        return SqliteJobStore(sqlite_path)
+    raise ValueError(f"Unknown job store: {backend}")
@@ -0,0 +1,69 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Mean and standard deviation of the VAE posterior; no deviation for encoders that return latents directly
+EncodedLatents = Tuple[torch.Tensor, Optional[torch.Tensor]]
+
+def _size(latents: EncodedLatents) -> int:
+    return sum(t.numel() * t.element_size() for t in latents if t is not None)
+
+class LatentCache:
+    """LRU cache of VAE-encoded refine inputs.
+    
+    Entries hold the posterior distribution rather than a sample, so every
+    refine still draws its own sample from the request's generator. Keys
+    identify both the source image and the VAE that encoded it, so switching
+    refiner models never reuses latents from another VAE. Bounded by entry
+    count and total tensor bytes.
+    """
+    
+    def __init__(self, max_entries: int = 64, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, EncodedLatents]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: Hashable) -> Optional[EncodedLatents]:
+        with self._lock:
+            latents = self._entries.get(key)
+            if latents is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return latents
+    
+    def put(self, key: Hashable, latents: EncodedLatents):
+        size = _size(latents)
+        if size > self.max_bytes:
+            return
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= _size(old)
+            self._entries[key] = latents
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= _size(evicted)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxEntries": self.max_entries,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
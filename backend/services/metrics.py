@@ -0,0 +1,200 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Stage durations range from sub-millisecond UNet steps on tiny models to
+# multi-minute downloads, so the buckets span both ends
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Histogram:
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+class Metrics:
+    """Minimal Prometheus-style registry of counters, histograms and gauges.
+    
+    Counters and histograms are updated from any thread. Gauges are callbacks
+    evaluated when the metrics are rendered, so they always reflect live state
+    (queue depth, pool residency, memory) without bookkeeping at every change.
+    """
+    
+    def __init__(self, namespace: str = "sdxs"):
+        self.namespace = namespace
+        self._help: Dict[str, Tuple[str, str]] = {}  # name: (type, help)
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+        self._gauges: Dict[str, Callable[[], object]] = {}
+        self._lock = threading.Lock()
+        
+        self.describe("stage_seconds", "histogram", "Time spent in each processing stage")
+    
+    def describe(self, name: str, metric_type: str, help_text: str):
+        self._help[self._name(name)] = (metric_type, help_text)
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment a counter (or a gauge declared with ``describe``)."""
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(self._name(name), {})
+            series[key] = series.get(key, 0) + value
+    
+    def dec(self, name: str, value: float = 1, **labels):
+        """Decrement a gauge declared with ``describe``."""
+        self.inc(name, -value, **labels)
+    
+    def observe(self, name: str, value: float, **labels):
+        """Record a value in a histogram."""
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(self._name(name), {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(DEFAULT_BUCKETS)
+            histogram.observe(value)
+    
+    def observe_stage(self, stage: str, seconds: float, **labels):
+        """Record the duration of a processing stage."""
+        self.observe("stage_seconds", seconds, stage=stage, **labels)
+    
+    @contextmanager
+    def time_stage(self, stage: str, **labels):
+        """Time the enclosed block as a processing stage, including when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start, **labels)
+    
+    def gauge(self, name: str, help_text: str, collect: Callable[[], object], metric_type: str = "gauge"):
+        """Register a metric whose value is computed at render time.
+        
+        ``collect`` returns either a number or a list of ``(labels, value)`` pairs.
+        Pass ``metric_type="counter"`` to expose a counter a service already keeps.
+        """
+        self.describe(name, metric_type, help_text)
+        self._gauges[self._name(name)] = collect
+    
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                name: {key: (list(h.buckets), list(h.counts), h.count, h.sum) for key, h in series.items()}
+                for name, series in self._histograms.items()
+            }
+        
+        for name, series in sorted(counters.items()):
+            self._header(lines, name, "counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        
+        for name, series in sorted(histograms.items()):
+            self._header(lines, name, "histogram")
+            for key, (buckets, counts, count, total) in sorted(series.items()):
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{_format_labels(key, (('le', _format_value(float(bound))),))} {bucket_count}")
+                lines.append(f"{name}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        
+        for name, collect in sorted(self._gauges.items()):
+            try:
+                value = collect()
+            except Exception as e:
+                logger.error(f"Error collecting metric {name}: {e}")
+                continue
+            self._header(lines, name, "gauge")
+            samples = value if isinstance(value, list) else [({}, value)]
+            for labels, sample in samples:
+                lines.append(f"{name}{_format_labels(_labels(labels))} {_format_value(sample)}")
+        
+        return "\n".join(lines) + "\n"
+    
+    def _name(self, name: str) -> str:
+        return f"{self.namespace}_{name}"
+    
+    def _header(self, lines: List[str], name: str, default_type: str):
+        metric_type, help_text = self._help.get(name, (default_type, name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording in-flight HTTP requests and latency by route.
+    
+    Written against raw ASGI rather than ``BaseHTTPMiddleware``, which hides
+    client disconnects from ``Request.is_disconnected`` in the handlers.
+    """
+    
+    def __init__(self, app, registry: "Metrics" = None):
+        self.app = app
+        self.registry = registry or metrics
+        self.registry.describe("http_requests_in_flight", "gauge", "HTTP requests currently being handled")
+        self.registry.describe("http_request_seconds", "histogram", "HTTP request latency by route")
+        self.registry.inc("http_requests_in_flight", 0)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status = 500
+        
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        self.registry.inc("http_requests_in_flight")
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.registry.dec("http_requests_in_flight")
+            # Label by route template, not the raw path, to keep image filenames out of the labels
+            route = scope.get("route")
+            self.registry.observe(
+                "http_request_seconds",
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=route.path if route is not None else "unmatched",
+                status=status
+            )
+
+# Shared registry; services record into it and server.py exposes it at /api/metrics
+metrics = Metrics()
@@ -1,74 +1,211 @@
+import asyncio
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 import torch
-from diffusers import StableDiffusionPipeline, DiffusionPipeline
+from diffusers import AutoencoderKL, AutoencoderTiny, StableDiffusionPipeline, DiffusionPipeline
 from diffusers.schedulers import LCMScheduler
 
+from services.cpu_profile import CpuPerformanceProfile
+from services.fast_load import PipelineSnapshots, load_module, load_pipeline
+from services.metrics import metrics
+from services.model_pool import ModelPool, PoolKey
+
 logger = logging.getLogger(__name__)
 
+MODEL_TYPE = "sdxs"
+
+# SD-XS checkpoints ship the tiny VAE as `vae` and the original SD VAE as
+# `vae_large`. The large one decodes noticeably sharper images but is much
+# slower, so it is registered as a separate view sharing everything else
+LARGE_VAE_SUBFOLDER = "vae_large"
+LARGE_VAE_MODEL_TYPE = "sdxs-vae_large"
+VAE_MODES = ("fast", "large")
+
 class ModelLoader:
-    def __init__(self):
-        self.pipeline: Optional[StableDiffusionPipeline] = None
-        self.repo_id: Optional[str] = None
+    def __init__(
+        self,
+        model_pool: ModelPool,
+        load_large_vae: bool = True,
+        cpu_profile: Optional[CpuPerformanceProfile] = None,
+        fast_load: bool = True,
+        snapshots: Optional[PipelineSnapshots] = None
+    ):
+        self.model_pool = model_pool
+        self.load_large_vae = load_large_vae
+        self.cpu_profile = cpu_profile
+        self.fast_load = fast_load  # Memory-map safetensors weights instead of copying them
+        self.snapshots = snapshots
+        self.repo_id: Optional[str] = None  # Active generation model
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
+        self.model_pool.add_evict_listener(self._on_evict)
         logger.info(f"Using device: {self.device}")
     
-    async def load_model(self, repo_id: str, model_path: Path):
-        """Load SD-XS model using diffusers."""
+    async def load_model(self, repo_id: str, model_path: Path, local_only: bool = False):
+        """Load SD-XS model using diffusers; ``local_only`` forbids falling back to the Hub."""
         try:
-            logger.info(f"Loading model from {model_path}...")
+            # Models still resident in the pool are reactivated without reloading
+            if self.model_pool.contains((MODEL_TYPE, repo_id)):
+                self._activate(repo_id)
+                logger.info(f"Model {repo_id} already resident, switching to it")
+                return
             
-            # Try to load as a complete pipeline first
-            try:
-                self.pipeline = DiffusionPipeline.from_pretrained(
-                    str(model_path),
-                    torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                    safety_checker=None,
-                    use_safetensors=True
-                )
-                logger.info("Loaded as complete pipeline")
-            except Exception as e:
-                logger.warning(f"Could not load as pipeline: {e}")
-                # Fall back to loading from HuggingFace directly
-                logger.info("Loading from HuggingFace directly...")
-                self.pipeline = DiffusionPipeline.from_pretrained(
-                    repo_id,
-                    torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                    safety_checker=None,
-                    use_safetensors=True
-                )
-            
-            # Configure scheduler for fast inference
-            try:
-                self.pipeline.scheduler = LCMScheduler.from_config(
-                    self.pipeline.scheduler.config
-                )
-            except:
-                logger.warning("Could not set LCM scheduler, using default")
-            
-            self.pipeline = self.pipeline.to(self.device)
+            logger.info(f"Loading model from {model_path}...")
             
-            # Enable optimizations
-            if self.device == "cuda":
-                try:
-                    self.pipeline.enable_attention_slicing()
-                except:
-                    pass
+            # Weight loading takes minutes on CPU, keep it off the event loop
+            with metrics.time_stage("model_load", model_type=MODEL_TYPE):
+                pipeline, large_vae = await asyncio.to_thread(self._load_weights, repo_id, model_path, local_only)
             
-            self.repo_id = repo_id
+            # Swap in the new pipeline only once it is fully loaded
+            self.set_pipeline(repo_id, pipeline, large_vae)
             logger.info(f"Model {repo_id} loaded successfully")
             
         except Exception as e:
             logger.error(f"Error loading model: {e}")
             raise Exception(f"Failed to load model: {str(e)}")
     
-    def is_loaded(self) -> bool:
-        """Check if a model is currently loaded."""
-        return self.pipeline is not None
+    def _load_weights(
+        self,
+        repo_id: str,
+        model_path: Path,
+        local_only: bool = False
+    ) -> Tuple[StableDiffusionPipeline, Optional[AutoencoderKL]]:
+        """Load the pipeline and large VAE, preferring a snapshot; runs in a worker thread."""
+        snapshot = self.snapshots.find(repo_id, self.dtype, model_path) if self.snapshots is not None else None
+        if snapshot is not None:
+            logger.info(f"Loading snapshot {snapshot}")
+        pipeline = self._load_pipeline(repo_id, snapshot or model_path, local_only)
+        large_vae = self._load_large_vae(snapshot or model_path)
+        
+        # Snapshot before device placement and CPU optimizations, which are redone on every load
+        if self.snapshots is not None and snapshot is None:
+            try:
+                extra = {LARGE_VAE_SUBFOLDER: large_vae} if large_vae is not None else None
+                self.snapshots.save(repo_id, self.dtype, model_path, pipeline, extra)
+            except Exception as e:
+                logger.warning(f"Could not save snapshot of {repo_id}: {e}")
+        
+        return self._configure_pipeline(pipeline), self._configure_large_vae(large_vae)
     
-    def get_pipeline(self) -> StableDiffusionPipeline:
-        """Get the loaded pipeline."""
-        if not self.is_loaded():
+    def _load_pipeline(self, repo_id: str, model_path: Path, local_only: bool = False) -> StableDiffusionPipeline:
+        """Load a pipeline with the LCM scheduler; runs in a worker thread."""
+        # Try to load as a complete pipeline first
+        try:
+            pipeline = load_pipeline(DiffusionPipeline, model_path, self.dtype, fast=self.fast_load)
+            logger.info("Loaded as complete pipeline")
+        except Exception as e:
+            logger.warning(f"Could not load as pipeline: {e}")
+            if local_only:
+                raise
+            # Fall back to loading from HuggingFace directly
+            logger.info("Loading from HuggingFace directly...")
+            pipeline = DiffusionPipeline.from_pretrained(
+                repo_id,
+                torch_dtype=self.dtype,
+                safety_checker=None,
+                use_safetensors=True
+            )
+        
+        # Configure scheduler for fast inference
+        try:
+            pipeline.scheduler = LCMScheduler.from_config(
+                pipeline.scheduler.config
+            )
+        except:
+            logger.warning("Could not set LCM scheduler, using default")
+        
+        return pipeline
+    
+    def _configure_pipeline(self, pipeline: StableDiffusionPipeline) -> StableDiffusionPipeline:
+        """Move a loaded pipeline to the device and apply its optimizations."""
+        pipeline = pipeline.to(self.device)
+        
+        # Enable optimizations
+        if self.device == "cuda":
+            try:
+                pipeline.enable_attention_slicing()
+            except:
+                pass
+        elif self.cpu_profile is not None:
+            self.cpu_profile.optimize_pipeline(pipeline)
+        
+        return pipeline
+    
+    def _load_large_vae(self, model_path: Path) -> Optional[AutoencoderKL]:
+        """Load the checkpoint's large VAE if it ships one; runs in a worker thread."""
+        if not self.load_large_vae or not (model_path / LARGE_VAE_SUBFOLDER).is_dir():
+            return None
+        try:
+            vae = load_module(AutoencoderKL, model_path / LARGE_VAE_SUBFOLDER, self.dtype, fast=self.fast_load)
+            logger.info(f"Loaded large VAE from {model_path / LARGE_VAE_SUBFOLDER}")
+            return vae
+        except Exception as e:
+            logger.warning(f"Could not load large VAE, only fast decoding is available: {e}")
+            return None
+    
+    def _configure_large_vae(self, vae: Optional[AutoencoderKL]) -> Optional[AutoencoderKL]:
+        if vae is None:
+            return None
+        vae = vae.to(self.device)
+        if self.device == "cpu" and self.cpu_profile is not None:
+            self.cpu_profile.optimize_vae(vae)
+            self.cpu_profile.warmup_vae(vae)
+        return vae
+    
+    def set_pipeline(self, repo_id: str, pipeline: StableDiffusionPipeline, large_vae: Optional[AutoencoderKL] = None):
+        """Add an already constructed pipeline to the pool and make it the active model.
+        
+        With ``large_vae``, a view of the pipeline that decodes with it is pooled
+        alongside, sharing the UNet and text encoder.
+        """
+        self.model_pool.put((MODEL_TYPE, repo_id), pipeline, self.device)
+        if large_vae is not None:
+            components = {**pipeline.components, "vae": large_vae}
+            if "requires_safety_checker" in pipeline.config:
+                components["requires_safety_checker"] = pipeline.config.requires_safety_checker
+            view = type(pipeline)(**components)
+            view.set_progress_bar_config(**getattr(pipeline, "_progress_bar_config", {}))
+            self.model_pool.put((LARGE_VAE_MODEL_TYPE, repo_id), view, self.device, parent=(MODEL_TYPE, repo_id))
+        self._activate(repo_id)
+    
+    def _activate(self, repo_id: str):
+        # The active model serves requests that name no repo, so the pool never evicts it
+        if self.repo_id is not None:
+            self.model_pool.unpin((MODEL_TYPE, self.repo_id))
+        self.model_pool.pin((MODEL_TYPE, repo_id))
+        self.repo_id = repo_id
+    
+    def is_loaded(self, repo_id: Optional[str] = None) -> bool:
+        """Check if a model (the active one by default) is currently loaded."""
+        repo_id = repo_id or self.repo_id
+        return repo_id is not None and self.model_pool.contains((MODEL_TYPE, repo_id))
+    
+    def has_large_vae(self, repo_id: Optional[str] = None) -> bool:
+        """Whether a model (the active one by default) can decode with a full-size VAE."""
+        repo_id = repo_id or self.repo_id
+        if self.model_pool.contains((LARGE_VAE_MODEL_TYPE, repo_id)):
+            return True
+        # Checkpoints whose only VAE is already a full one decode at full quality anyway
+        pipeline = self.model_pool.peek((MODEL_TYPE, repo_id))
+        return pipeline is not None and not isinstance(pipeline.vae, AutoencoderTiny)
+    
+    def get_pipeline(self, repo_id: Optional[str] = None, vae: str = "fast") -> StableDiffusionPipeline:
+        """Get a loaded pipeline, the active one by default.
+        
+        ``vae="large"`` returns the view decoding with the large VAE when the
+        model has one, and the pipeline itself otherwise.
+        """
+        repo_id = repo_id or self.repo_id
+        if vae == "large":
+            view = self.model_pool.get((LARGE_VAE_MODEL_TYPE, repo_id))
+            if view is not None:
+                return view
+        pipeline = self.model_pool.get((MODEL_TYPE, repo_id))
+        if pipeline is None:
             raise Exception("No model loaded")
-        return self.pipeline
+        return pipeline
+    
+    def _on_evict(self, key: PoolKey):
+        if key == (MODEL_TYPE, self.repo_id):
+            logger.warning(f"Active model {self.repo_id} was evicted from the model pool")
@@ -0,0 +1,252 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+PoolKey = Tuple[str, str]  # (model_type, repo_id)
+
+class _PoolEntry:
+    def __init__(self, pipeline, device: str, parent: Optional[PoolKey], module_bytes: Dict[int, int]):
+        self.pipeline = pipeline
+        self.device = device
+        self.parent = parent
+        self.module_bytes = module_bytes  # id(module) -> bytes, measured once when pooled
+        self.offloaded = False  # Where the entry should be
+        self.on_cpu = device == "cpu"  # Where its weights actually are
+
+class ModelPool:
+    """Resident pipelines keyed by (model_type, repo_id) under a memory budget.
+    
+    Memory is accounted per unique tensor storage, so components shared between
+    entries (the SDXS pipeline and its img2img view) are only counted once. When
+    the budget is exceeded the least recently used entries are offloaded to CPU
+    (if they live on a GPU and ``offload_budget_bytes`` allows it) and otherwise
+    dropped. Entries registered with a ``parent`` share its weights: they are
+    evicted and offloaded together with it, and using them keeps the parent warm.
+    Modules a child adds (such as a second VAE) move along with the group.
+    
+    Offloading only marks an entry; the device moves themselves are handed to
+    ``device_mover`` (the inference thread, see ``InferenceExecutor``) so they
+    never overlap a running pipeline call, and ``ensure_resident`` moves an
+    offloaded pipeline back right before its next call. Pinned entries, such as
+    the active model, are never evicted.
+    """
+    
+    def __init__(self, budget_bytes: int = 0, offload_budget_bytes: int = 0):
+        self.budget_bytes = budget_bytes  # 0 means unlimited
+        self.offload_budget_bytes = offload_budget_bytes
+        self.device_mover: Callable[[Callable[[], None]], None] = lambda move: move()
+        self._entries: "OrderedDict[PoolKey, _PoolEntry]" = OrderedDict()
+        self._keys_by_pipeline: Dict[int, PoolKey] = {}
+        self._pinned: Set[PoolKey] = set()
+        self._evict_listeners: List[Callable[[PoolKey], None]] = []
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.offloads = 0
+    
+    def add_evict_listener(self, listener: Callable[[PoolKey], None]):
+        """Register a callback invoked with the key of every dropped entry."""
+        self._evict_listeners.append(listener)
+    
+    def put(self, key: PoolKey, pipeline, device: str, parent: Optional[PoolKey] = None):
+        """Add or replace a pipeline and evict others until the budget is met."""
+        module_bytes = self._module_bytes(pipeline)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = _PoolEntry(pipeline, device, parent, module_bytes)
+            self._keys_by_pipeline[id(pipeline)] = key
+            self._touch(key)
+            self._enforce_budget(protect=key)
+        logger.info(f"Model pool: added {key}, resident={self.resident_bytes() / 1024 ** 2:.0f}MB")
+    
+    def get(self, key: PoolKey):
+        """Return a pipeline and mark it most recently used.
+        
+        An offloaded pipeline is returned as is; it is moved back onto its
+        device by ``ensure_resident`` before it next runs.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._touch(key)
+            return entry.pipeline
+    
+    def peek(self, key: PoolKey):
+        """Return a pipeline without touching its LRU position or residency."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.pipeline if entry is not None else None
+    
+    def contains(self, key: PoolKey) -> bool:
+        with self._lock:
+            return key in self._entries
+    
+    def pin(self, key: PoolKey):
+        """Keep an entry (and its group) from being evicted."""
+        with self._lock:
+            self._pinned.add(key)
+    
+    def unpin(self, key: PoolKey):
+        with self._lock:
+            self._pinned.discard(key)
+    
+    def ensure_resident(self, pipeline):
+        """Move a pooled, offloaded pipeline back onto its device; runs on the inference thread."""
+        with self._lock:
+            key = self._keys_by_pipeline.get(id(pipeline))
+            if key is None or key not in self._entries:
+                return
+            root = self._root(key)
+            group = self._group(root)
+            if self._entries[root].offloaded:
+                logger.info(f"Model pool: restoring {root} to {self._entries[root].device}")
+                for member in group:
+                    self._entries[member].offloaded = False
+                self._enforce_budget(protect=key)
+        self._apply_placement(group)
+    
+    def remove(self, key: PoolKey):
+        """Drop a pipeline and everything that shares its weights."""
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+    
+    def resident_bytes(self, offloaded: bool = False) -> int:
+        """Bytes of unique modules held by on-device (or offloaded) entries."""
+        with self._lock:
+            modules: Dict[int, int] = {}
+            for entry in self._entries.values():
+                if entry.offloaded == offloaded:
+                    modules.update(entry.module_bytes)
+            return sum(modules.values())
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budgetBytes": self.budget_bytes,
+                "offloadBudgetBytes": self.offload_budget_bytes,
+                "residentBytes": self.resident_bytes(),
+                "offloadedBytes": self.resident_bytes(offloaded=True),
+                "evictions": self.evictions,
+                "offloads": self.offloads,
+                "entries": [
+                    {
+                        "modelType": key[0],
+                        "repoId": key[1],
+                        "device": "cpu" if entry.offloaded else entry.device,
+                        "offloaded": entry.offloaded,
+                        "pinned": key in self._pinned,
+                        "parent": list(entry.parent) if entry.parent else None
+                    }
+                    # Most recently used first
+                    for key, entry in reversed(self._entries.items())
+                ]
+            }
+    
+    def _root(self, key: PoolKey) -> PoolKey:
+        parent = self._entries[key].parent
+        return parent if parent in self._entries else key
+    
+    def _touch(self, key: PoolKey):
+        self._entries.move_to_end(key)
+        parent = self._entries[key].parent
+        if parent in self._entries:
+            self._entries.move_to_end(parent)
+    
+    def _group(self, key: PoolKey) -> List[PoolKey]:
+        return [key] + [k for k, e in self._entries.items() if e.parent == key]
+    
+    def _drop(self, key: PoolKey):
+        for member in self._group(key):
+            entry = self._entries.pop(member)
+            self._keys_by_pipeline.pop(id(entry.pipeline), None)
+            self._pinned.discard(member)
+            for listener in self._evict_listeners:
+                try:
+                    listener(member)
+                except Exception as e:
+                    logger.error(f"Model pool evict listener failed for {member}: {e}")
+    
+    def _apply_placement(self, keys: List[PoolKey]):
+        """Move entries to where they should be; only ever runs on the inference thread."""
+        moves = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry.on_cpu != (entry.offloaded or entry.device == "cpu"):
+                    moves.append(entry)
+        for entry in moves:
+            target = "cpu" if entry.offloaded else entry.device
+            entry.pipeline.to(target)
+            entry.on_cpu = target == "cpu"
+        if any(entry.on_cpu and entry.device == "cuda" for entry in moves):
+            torch.cuda.empty_cache()
+    
+    def _enforce_budget(self, protect: PoolKey):
+        if not self.budget_bytes:
+            return
+        
+        protected = set(self._group(self._root(protect)))
+        for pinned in self._pinned:
+            if pinned in self._entries:
+                protected.update(self._group(self._root(pinned)))
+        while self.resident_bytes() > self.budget_bytes:
+            victim = next(
+                (k for k, e in self._entries.items()
+                 if k not in protected and not e.offloaded and e.parent not in self._entries),
+                None
+            )
+            if victim is None:
+                logger.warning("Model pool over budget but nothing left to evict")
+                break
+            self._evict(victim)
+        
+        while self.offload_budget_bytes and self.resident_bytes(offloaded=True) > self.offload_budget_bytes:
+            victim = next((k for k, e in self._entries.items() if e.offloaded and e.parent not in self._entries), None)
+            if victim is None:
+                break
+            logger.info(f"Model pool: dropping offloaded {victim}")
+            self._drop(victim)
+            self.evictions += 1
+    
+    def _evict(self, key: PoolKey):
+        entry = self._entries[key]
+        if entry.device != "cpu" and self.offload_budget_bytes:
+            logger.info(f"Model pool: offloading {key} to CPU")
+            group = self._group(key)
+            for member in group:
+                self._entries[member].offloaded = True
+            self.offloads += 1
+            # The move waits for calls already queued on the inference thread
+            self.device_mover(lambda: self._apply_placement(group))
+        else:
+            # Dropping only releases the pool's reference; a call still using the pipeline finishes normally
+            logger.info(f"Model pool: evicting {key}")
+            self._drop(key)
+            self.evictions += 1
+            if entry.device == "cuda":
+                self.device_mover(torch.cuda.empty_cache)
+    
+    @staticmethod
+    def _module_bytes(pipeline) -> Dict[int, int]:
+        """Bytes of unique tensor storage per module, keyed by module identity.
+        
+        Pipelines sharing a module (the SDXS pipeline and its img2img view) map
+        it to the same key, so it is counted once.
+        """
+        modules = {}
+        for component in pipeline.components.values():
+            if not isinstance(component, torch.nn.Module):
+                continue
+            storages = {}
+            for tensor in list(component.parameters()) + list(component.buffers()):
+                storage = tensor.untyped_storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+            modules[id(component)] = sum(storages.values())
+        return modules
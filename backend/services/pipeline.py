@@ -1,71 +1,124 @@
+import asyncio
 import logging
+import random
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Sequence, Tuple
 import uuid
-import torch
-from PIL import Image
 
+from services.batcher import GenerationBatcher
+from services.image_store import ImageStore
 from services.model_loader import ModelLoader
+from services.previews import StepProgress
 
 logger = logging.getLogger(__name__)
 
 class SDXSPipeline:
-    def __init__(self, model_loader: ModelLoader, images_dir: Path):
+    def __init__(
+        self,
+        model_loader: ModelLoader,
+        images_dir: Path,
+        batcher: GenerationBatcher,
+        image_store: ImageStore
+    ):
         self.model_loader = model_loader
         self.images_dir = images_dir
+        self.batcher = batcher
+        self.image_store = image_store
     
     async def generate(
         self,
         prompt: str,
+        negative_prompt: Optional[str] = None,
         size: str = '512x512',
         steps: int = 8,
         guidance: float = 4.0,
-        seed: Optional[int] = None
+        seed: Optional[int] = None,
+        repo_id: Optional[str] = None,
+        progress: Optional[StepProgress] = None,
+        vae: str = "fast"
     ) -> str:
-        """Generate an image using SD-XS pipeline."""
+        """Generate an image using SD-XS pipeline, decoding with the "fast" or "large" VAE."""
+        images = await self.generate_batch(
+            prompt, negative_prompt, size, steps, guidance, [seed], repo_id, progress, vae
+        )
+        return images[0][0]
+    
+    async def generate_batch(
+        self,
+        prompt: str,
+        negative_prompt: Optional[str] = None,
+        size: str = '512x512',
+        steps: int = 8,
+        guidance: float = 4.0,
+        seeds: Sequence[Optional[int]] = (None,),
+        repo_id: Optional[str] = None,
+        progress: Optional[StepProgress] = None,
+        vae: str = "fast",
+        images_dir: Optional[Path] = None
+    ) -> List[Tuple[str, int]]:
+        """Generate one image per seed in batched pipeline calls, returning (path, seed) pairs.
+        
+        Each image gets its own generator, so a seed yields the same image
+        whatever else shares its batch. Missing seeds are drawn at random and
+        reported back. ``progress`` previews the first image and cancels all.
+        Images go to ``images_dir`` when given instead of the served folder.
+        """
         try:
             # Parse size
             width, height = map(int, size.split('x'))
             
-            # Get pipeline
-            pipeline = self.model_loader.get_pipeline()
+            # Get pipeline, the active model unless another resident one is requested
+            repo_id = repo_id or self.model_loader.repo_id
+            pipeline = self.model_loader.get_pipeline(repo_id, vae=vae)
+            
+            seeds = [seed if seed is not None else random.randrange(2**32) for seed in seeds]
+            logger.info(
+                f"Generating {len(seeds)} image(s): {width}x{height}, steps={steps}, guidance={guidance}, "
+                f"vae={type(pipeline.vae).__name__}"
+            )
             
-            # Set seed for reproducibility
-            if seed is not None:
-                generator = torch.Generator(device=self.model_loader.device).manual_seed(seed)
-            else:
-                generator = None
+            sample_progress = [progress] + [None] * (len(seeds) - 1)
+            if progress is not None:
+                # Silent trackers let a cancel stop every sample, not just the previewed one
+                for i in range(1, len(seeds)):
+                    sample_progress[i] = StepProgress()
+                    progress.add_cancel_callback(sample_progress[i].cancel)
             
-            logger.info(f"Generating image: {width}x{height}, steps={steps}, guidance={guidance}")
+            # Generate the images as part of batches, together with concurrent requests
+            images = await self.batcher.submit_many(
+                pipeline,
+                repo_id,
+                self.model_loader.device,
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                width=width,
+                height=height,
+                steps=steps,
+                guidance=guidance,
+                seeds=seeds,
+                progress=sample_progress,
+                vae=vae
+            )
             
-            # Prepare generation parameters
-            gen_params = {
+            # Queue images for saving, they are served from memory until written
+            params = {
+                "kind": "generate",
+                "repoId": repo_id,
                 "prompt": prompt,
-                "num_inference_steps": steps,
-                "width": width,
-                "height": height,
-                "generator": generator
+                "negativePrompt": negative_prompt,
+                "size": f"{width}x{height}",
+                "steps": steps,
+                "guidance": guidance,
+                # The decoder actually used, after falling back from a missing large VAE
+                "vae": vae if vae != "large" or self.model_loader.has_large_vae(repo_id) else "fast"
             }
+            paths = await asyncio.gather(*(
+                self.image_store.save(image, images_dir or self.images_dir, str(uuid.uuid4()), params={**params, "seed": seed})
+                for image, seed in zip(images, seeds)
+            ))
             
-            # Add guidance scale only if supported
-            try:
-                gen_params["guidance_scale"] = guidance
-            except:
-                logger.warning("Guidance scale not supported for this model")
-            
-            # Generate image
-            with torch.inference_mode():
-                result = pipeline(**gen_params)
-            
-            image = result.images[0]
-            
-            # Save image
-            filename = f"{uuid.uuid4()}.png"
-            image_path = self.images_dir / filename
-            image.save(image_path)
-            
-            logger.info(f"Image saved to {image_path}")
-            return str(image_path)
+            logger.info(f"{len(paths)} image(s) queued, first at {paths[0]}")
+            return [(str(path), seed) for path, seed in zip(paths, seeds)]
             
         except Exception as e:
             logger.error(f"Error generating image: {e}")
@@ -0,0 +1,83 @@
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from services.background import spawn
+
+logger = logging.getLogger(__name__)
+
+class PrepareJob:
+    """State of a background model download-and-load job."""
+    
+    def __init__(self, repo_id: str, kind: str = "model"):
+        self.id = str(uuid.uuid4())
+        self.repo_id = repo_id
+        self.kind = kind  # model or refiner
+        self.status = "queued"  # queued, running, completed, failed
+        self.phase = "queued"  # queued, downloading, loading, warming, ready
+        self.message = ""
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+    
+    def set_phase(self, phase: str, message: str = ""):
+        self.phase = phase
+        self.message = message
+        self.updated_at = time.time()
+    
+    def is_active(self) -> bool:
+        return self.status in ("queued", "running")
+
+class PrepareJobManager:
+    """Runs model prepare work in the background, one job per repo at a time."""
+    
+    def __init__(self, max_finished_jobs: int = 100):
+        self.max_finished_jobs = max_finished_jobs
+        self._jobs: Dict[str, PrepareJob] = {}
+        self._active_by_repo: Dict[Tuple[str, str], str] = {}
+    
+    def start(
+        self,
+        repo_id: str,
+        runner: Callable[[PrepareJob], Awaitable[None]],
+        kind: str = "model"
+    ) -> PrepareJob:
+        """Start a prepare job, or return the one already running for this repo and kind."""
+        key = (kind, repo_id)
+        active_id = self._active_by_repo.get(key)
+        if active_id is not None and self._jobs[active_id].is_active():
+            logger.info(f"Prepare for {repo_id} already in progress as job {active_id}")
+            return self._jobs[active_id]
+        
+        job = PrepareJob(repo_id, kind)
+        self._jobs[job.id] = job
+        self._active_by_repo[key] = job.id
+        self._prune()
+        
+        spawn(self._run(job, runner), f"prepare job {job.id}")
+        logger.info(f"Started prepare job {job.id} for {repo_id}")
+        return job
+    
+    def get(self, job_id: str) -> Optional[PrepareJob]:
+        return self._jobs.get(job_id)
+    
+    async def _run(self, job: PrepareJob, runner: Callable[[PrepareJob], Awaitable[None]]):
+        job.status = "running"
+        try:
+            await runner(job)
+            job.status = "completed"
+            job.set_phase("ready", f"Model {job.repo_id} loaded successfully")
+        except Exception as e:
+            logger.error(f"Prepare job {job.id} failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+            job.updated_at = time.time()
+        finally:
+            if self._active_by_repo.get((job.kind, job.repo_id)) == job.id:
+                del self._active_by_repo[(job.kind, job.repo_id)]
+    
+    def _prune(self):
+        finished = [job for job in self._jobs.values() if not job.is_active()]
+        for job in sorted(finished, key=lambda j: j.updated_at)[:-self.max_finished_jobs or None]:
+            del self._jobs[job.id]
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import torch
+
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class PromptEmbeddingCache:
+    """LRU cache of CLIP text-encoder outputs shared by generation and refinement.
+    
+    Entries are keyed by ``(repo_id, prompt, negative_prompt)`` and bounded both
+    by entry count and by the total size of the cached tensors. The negative
+    embedding is only computed when a request actually uses classifier-free
+    guidance, and is filled in lazily on a later hit that needs it.
+    """
+    
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple[str, str, str], List[Optional[torch.Tensor]]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.encode_seconds = 0.0
+    
+    def encode(
+        self,
+        repo_id: str,
+        pipeline,
+        prompts: List[str],
+        negative_prompts: List[Optional[str]],
+        guidance: float
+    ) -> Dict[str, Optional[torch.Tensor]]:
+        """Return pipeline kwargs with batched prompt embeddings for the given prompts.
+        
+        Must be called on the inference thread, as it runs the pipeline's text encoder.
+        """
+        do_cfg = guidance > 1 and pipeline.unet.config.time_cond_proj_dim is None
+        device = pipeline._execution_device
+        
+        prompt_embeds = []
+        negative_embeds = []
+        with torch.inference_mode():
+            for prompt, negative_prompt in zip(prompts, negative_prompts):
+                positive, negative = self._get_or_encode(
+                    repo_id, pipeline, device, prompt, negative_prompt or "", do_cfg
+                )
+                prompt_embeds.append(positive)
+                negative_embeds.append(negative)
+        
+        return {
+            "prompt_embeds": torch.cat(prompt_embeds),
+            "negative_prompt_embeds": torch.cat(negative_embeds) if do_cfg else None
+        }
+    
+    def _get_or_encode(self, repo_id: str, pipeline, device, prompt: str, negative_prompt: str, do_cfg: bool):
+        key = (repo_id, prompt, negative_prompt)
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is not None or not do_cfg):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], entry[1]
+            self.misses += 1
+        
+        # Encode outside the lock; a partial hit reuses the cached positive embedding
+        start = time.perf_counter()
+        positive, negative = pipeline.encode_prompt(
+            prompt,
+            device,
+            1,
+            do_cfg,
+            negative_prompt=negative_prompt if do_cfg else None,
+            prompt_embeds=entry[0] if entry is not None else None
+        )
+        elapsed = time.perf_counter() - start
+        metrics.observe_stage("text_encode", elapsed, pipeline=type(pipeline).__name__)
+        
+        with self._lock:
+            self.encode_seconds += elapsed
+            self._store(key, positive, negative if do_cfg else None)
+        return positive, negative
+    
+    def _store(self, key, positive: torch.Tensor, negative: Optional[torch.Tensor]):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= self._entry_bytes(old)
+        
+        entry = [positive, negative]
+        size = self._entry_bytes(entry)
+        if size > self.max_bytes:
+            return
+        
+        self._entries[key] = entry
+        self._bytes += size
+        
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._entry_bytes(evicted)
+            self.evictions += 1
+    
+    @staticmethod
+    def _entry_bytes(entry: List[Optional[torch.Tensor]]) -> int:
+        return sum(t.numel() * t.element_size() for t in entry if t is not None)
+    
+    def invalidate(self, repo_id: str):
+        """Drop the embeddings of a repo whose weights were (re)loaded."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == repo_id]:
+                self._bytes -= self._entry_bytes(self._entries.pop(key))
+    
+    def stats(self) -> dict:
+        """Hit/miss counters and an estimate of the encoder time saved by hits."""
+        with self._lock:
+            avg_encode = self.encode_seconds / self.misses if self.misses else 0.0
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxEntries": self.max_entries,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "encodeSeconds": round(self.encode_seconds, 4),
+                "savedSecondsEstimate": round(self.hits * avg_encode, 4)
+            }
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from pathlib import Path
 from typing import Optional, Literal
@@ -5,6 +6,17 @@ import uuid
 import torch
 from PIL import Image
 from diffusers import StableDiffusionImg2ImgPipeline, DiffusionPipeline
+from diffusers.utils.torch_utils import randn_tensor
+
+from services.image_store import ImageStore
+from services.inference_executor import InferenceExecutor
+from services.cpu_profile import CpuPerformanceProfile
+from services.fast_load import PipelineSnapshots, load_pipeline
+from services.latent_cache import EncodedLatents, LatentCache
+from services.metrics import metrics
+from services.model_pool import ModelPool
+from services.previews import StepProgress
+from services.prompt_cache import PromptEmbeddingCache
 
 logger = logging.getLogger(__name__)
 
@@ -13,29 +25,95 @@ RefinerModelType = Literal["sdxs", "small-sd-v0"]
 class RefinerService:
     """Service for image refinement using img2img pipelines."""
     
-    def __init__(self, models_dir: Path, images_dir: Path, refined_images_dir: Path):
+    def __init__(
+        self,
+        models_dir: Path,
+        images_dir: Path,
+        refined_images_dir: Path,
+        executor: InferenceExecutor,
+        prompt_cache: PromptEmbeddingCache,
+        model_pool: ModelPool,
+        image_store: ImageStore,
+        latent_cache: LatentCache,
+        cpu_profile: Optional[CpuPerformanceProfile] = None,
+        fast_load: bool = True,
+        snapshots: Optional[PipelineSnapshots] = None
+    ):
         self.models_dir = models_dir
         self.images_dir = images_dir
         self.refined_images_dir = refined_images_dir
+        self.executor = executor
+        self.prompt_cache = prompt_cache
+        self.model_pool = model_pool
+        self.image_store = image_store
+        self.latent_cache = latent_cache
+        self.cpu_profile = cpu_profile
+        self.fast_load = fast_load
+        self.snapshots = snapshots
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
         
-        # Storage for loaded refiner models
-        self.refiner_pipelines = {}
-        self.sdxs_pipeline = None  # Will be set from main loader
+        # Loaded refiner pipelines live in the shared model pool, keyed by (model_type, repo_id)
+        self.refiner_repo_ids = {}
+        self.sdxs_repo_id = None  # Will be set from main loader
         
         logger.info(f"RefinerService initialized with device: {self.device}")
     
-    def set_sdxs_pipeline(self, pipeline):
+    def set_sdxs_pipeline(self, pipeline, repo_id: str):
         """Set the SDXS pipeline from the main model loader."""
-        self.sdxs_pipeline = pipeline
+        # The img2img view is pooled as a child of the base pipeline, so it is
+        # dropped whenever the base is replaced or evicted
+        view_key = ("sdxs-img2img", repo_id)
+        if repo_id == self.sdxs_repo_id and self.model_pool.contains(view_key):
+            logger.info("SDXS pipeline unchanged, reusing cached img2img pipeline")
+            return
+        
+        self.sdxs_repo_id = repo_id
+        
+        try:
+            img2img_pipeline = self._build_img2img_pipeline(pipeline)
+            self.model_pool.put(view_key, img2img_pipeline, self.device, parent=("sdxs", repo_id))
+            
+            # Refinements can also decode (and encode) with the large VAE when the model has one
+            large_vae_pipeline = self.model_pool.get(("sdxs-vae_large", repo_id))
+            if large_vae_pipeline is not None:
+                self.model_pool.put(
+                    ("sdxs-img2img-vae_large", repo_id),
+                    self._build_img2img_pipeline(large_vae_pipeline),
+                    self.device,
+                    parent=("sdxs", repo_id)
+                )
+        except Exception as e:
+            logger.error(f"Could not create img2img pipeline from SDXS: {e}")
+        
         logger.info("SDXS pipeline linked to refiner service")
     
-    async def load_refiner_model(self, model_type: RefinerModelType, repo_id: str, model_path: Path):
-        """Load a refiner model (Small SD V0)."""
+    def _build_img2img_pipeline(self, pipeline) -> StableDiffusionImg2ImgPipeline:
+        """Create an img2img pipeline sharing the SDXS text2img components."""
+        img2img_pipeline = StableDiffusionImg2ImgPipeline(
+            vae=pipeline.vae,
+            text_encoder=pipeline.text_encoder,
+            tokenizer=pipeline.tokenizer,
+            unet=pipeline.unet,
+            scheduler=pipeline.scheduler,
+            safety_checker=None,
+            feature_extractor=pipeline.feature_extractor if hasattr(pipeline, 'feature_extractor') else None,
+            requires_safety_checker=False,
+        )
+        return img2img_pipeline.to(self.device)
+    
+    async def load_refiner_model(
+        self,
+        model_type: RefinerModelType,
+        repo_id: str,
+        model_path: Path,
+        local_only: bool = False
+    ):
+        """Load a refiner model (Small SD V0); ``local_only`` forbids falling back to the Hub."""
         try:
             if model_type == "sdxs":
                 # SDXS uses the already loaded pipeline
-                if self.sdxs_pipeline is None:
+                if not self.is_refiner_loaded("sdxs"):
                     raise Exception("SDXS pipeline not loaded. Please load SDXS model first.")
                 logger.info("Using existing SDXS pipeline for refinement")
                 return
@@ -43,35 +121,16 @@ class RefinerService:
             elif model_type == "small-sd-v0":
                 logger.info(f"Loading Small SD V0 refiner from {model_path}...")
                 
-                try:
-                    # Try loading from local path first
-                    pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
-                        str(model_path),
-                        torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                        safety_checker=None,
-                        use_safetensors=True
-                    )
-                    logger.info("Loaded Small SD V0 from local path")
-                except Exception as e:
-                    logger.warning(f"Could not load from local path: {e}")
-                    logger.info("Loading Small SD V0 from HuggingFace directly...")
-                    pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
-                        repo_id,
-                        torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                        safety_checker=None,
-                        use_safetensors=True
-                    )
-                
-                pipeline = pipeline.to(self.device)
+                # Weight loading takes minutes on CPU, keep it off the event loop
+                with metrics.time_stage("model_load", model_type=model_type):
+                    pipeline = await asyncio.to_thread(self._load_img2img_pipeline, repo_id, model_path, local_only)
                 
-                # Enable optimizations
-                if self.device == "cuda":
-                    try:
-                        pipeline.enable_attention_slicing()
-                    except:
-                        pass
+                previous_repo_id = self.refiner_repo_ids.get(model_type)
+                if previous_repo_id is not None and previous_repo_id != repo_id:
+                    self.model_pool.remove((model_type, previous_repo_id))
                 
-                self.refiner_pipelines[model_type] = pipeline
+                self.model_pool.put((model_type, repo_id), pipeline, self.device)
+                self.refiner_repo_ids[model_type] = repo_id
                 logger.info(f"Small SD V0 refiner loaded successfully")
             
             else:
@@ -81,107 +140,190 @@ class RefinerService:
             logger.error(f"Error loading refiner model: {e}")
             raise Exception(f"Failed to load refiner model: {str(e)}")
     
+    def _load_img2img_pipeline(
+        self,
+        repo_id: str,
+        model_path: Path,
+        local_only: bool = False
+    ) -> StableDiffusionImg2ImgPipeline:
+        """Load and configure an img2img refiner pipeline; runs in a worker thread."""
+        snapshot = self.snapshots.find(repo_id, self.dtype, model_path) if self.snapshots is not None else None
+        try:
+            # Try loading from a snapshot or the local path first
+            pipeline = load_pipeline(
+                StableDiffusionImg2ImgPipeline, snapshot or model_path, self.dtype, fast=self.fast_load
+            )
+            logger.info(f"Loaded Small SD V0 from {snapshot or model_path}")
+        except Exception as e:
+            logger.warning(f"Could not load from local path: {e}")
+            if local_only:
+                raise
+            logger.info("Loading Small SD V0 from HuggingFace directly...")
+            pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
+                repo_id,
+                torch_dtype=self.dtype,
+                safety_checker=None,
+                use_safetensors=True
+            )
+        
+        # Snapshot before device placement and CPU optimizations, which are redone on every load
+        if self.snapshots is not None and snapshot is None:
+            try:
+                self.snapshots.save(repo_id, self.dtype, model_path, pipeline)
+            except Exception as e:
+                logger.warning(f"Could not save snapshot of {repo_id}: {e}")
+        
+        pipeline = pipeline.to(self.device)
+        
+        # Enable optimizations
+        if self.device == "cuda":
+            try:
+                pipeline.enable_attention_slicing()
+            except:
+                pass
+        elif self.cpu_profile is not None:
+            self.cpu_profile.optimize_pipeline(pipeline)
+        
+        return pipeline
+    
+    @staticmethod
+    def _encode_image(pipeline, image: Image.Image) -> EncodedLatents:
+        """VAE-encode an image into its posterior mean and standard deviation (unscaled)."""
+        with torch.inference_mode(), metrics.time_stage(
+            "vae_encode", pipeline=type(pipeline).__name__, vae=type(pipeline.vae).__name__
+        ):
+            pixels = pipeline.image_processor.preprocess(image)
+            pixels = pixels.to(device=pipeline.vae.device, dtype=pipeline.vae.dtype)
+            encoded = pipeline.vae.encode(pixels)
+            if hasattr(encoded, "latent_dist"):
+                return encoded.latent_dist.mean, encoded.latent_dist.std
+            # The tiny autoencoder returns latents directly
+            return encoded.latents, None
+    
+    @staticmethod
+    def _sample_latents(pipeline, latents: EncodedLatents, generator: Optional[torch.Generator]) -> torch.Tensor:
+        """Scaled init latents, sampled exactly as the img2img pipeline samples its own VAE encoding."""
+        mean, std = latents
+        if std is not None:
+            # Same draw from the request generator as DiagonalGaussianDistribution.sample, so seeds reproduce
+            mean = mean + std * randn_tensor(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+        return pipeline.vae.config.scaling_factor * mean
+    
     def is_refiner_loaded(self, model_type: RefinerModelType) -> bool:
         """Check if a refiner model is loaded."""
         if model_type == "sdxs":
-            return self.sdxs_pipeline is not None
-        return model_type in self.refiner_pipelines
+            return self.sdxs_repo_id is not None and self.model_pool.contains(("sdxs", self.sdxs_repo_id))
+        repo_id = self.refiner_repo_ids.get(model_type)
+        return repo_id is not None and self.model_pool.contains((model_type, repo_id))
     
     async def refine_image(
         self,
         original_image_filename: str,
         refinement_prompt: str,
         model_type: RefinerModelType,
+        negative_prompt: Optional[str] = None,
         strength: float = 0.75,
         steps: int = 20,
         guidance: float = 7.5,
-        seed: Optional[int] = None
+        seed: Optional[int] = None,
+        progress: Optional[StepProgress] = None,
+        vae: str = "large"
     ) -> str:
-        """Refine an image using img2img pipeline."""
+        """Refine an image using img2img pipeline.
+        
+        ``vae`` picks the SDXS decoder ("fast" or "large"); the large one is used
+        only if the model ships it. Other refiners always use their own VAE.
+        """
         try:
             # Check if refiner is loaded
             if not self.is_refiner_loaded(model_type):
                 raise Exception(f"Refiner model {model_type} not loaded")
             
-            # Load original image
-            original_image_path = self.images_dir / original_image_filename
-            if not original_image_path.exists():
-                raise Exception(f"Original image not found: {original_image_filename}")
-            
-            original_image = Image.open(original_image_path).convert("RGB")
-            logger.info(f"Loaded original image: {original_image_path}")
-            
             # Get the appropriate pipeline
             if model_type == "sdxs":
-                # Convert SDXS text2img pipeline to img2img on the fly
-                # We'll use the same pipeline but with an init image
-                pipeline = self.sdxs_pipeline
-                use_img2img = False
+                # img2img view over the SDXS components, built when the pipeline was linked
+                repo_id = self.sdxs_repo_id
+                pool_type = "sdxs-img2img"
+                if vae == "large" and self.model_pool.contains(("sdxs-img2img-vae_large", repo_id)):
+                    pool_type = "sdxs-img2img-vae_large"
+                pipeline = self.model_pool.get((pool_type, repo_id))
+                if pipeline is None:
+                    raise Exception("SDXS model does not support image refinement. Please use Small SD V0.")
             else:
-                pipeline = self.refiner_pipelines[model_type]
-                use_img2img = True
+                repo_id = self.refiner_repo_ids[model_type]
+                pool_type = model_type
+                pipeline = self.model_pool.get((model_type, repo_id))
+            
+            # Repeat refinements of the same image reuse its VAE latents,
+            # skipping both the image decode and the VAE encoder pass
+            latents_key = (pool_type, repo_id, original_image_filename)
+            encoded = self.latent_cache.get(latents_key)
+            if encoded is None:
+                original_image_path = self.image_store.resolve(self.images_dir, original_image_filename)
+                if not (self.image_store.is_pending(original_image_path) or original_image_path.exists()):
+                    raise Exception(f"Original image not found: {original_image_filename}")
+                
+                original_image = await self.image_store.open_image(original_image_path)
+                logger.info(f"Loaded original image: {original_image_path}")
+                
+                encoded = await self.executor.submit(self._encode_image, pipeline, original_image)
+                self.latent_cache.put(latents_key, encoded)
             
             # Set seed for reproducibility
             if seed is not None:
                 generator = torch.Generator(device=self.device).manual_seed(seed)
             else:
                 generator = None
+            init_latents = self._sample_latents(pipeline, encoded, generator)
             
-            logger.info(f"Refining with {model_type}: strength={strength}, steps={steps}, guidance={guidance}")
+            logger.info(
+                f"Refining with {model_type}: strength={strength}, steps={steps}, guidance={guidance}, "
+                f"vae={type(pipeline.vae).__name__}"
+            )
             
             # Prepare generation parameters
-            if use_img2img or hasattr(pipeline, 'image'):
-                # Proper img2img pipeline
-                gen_params = {
-                    "prompt": refinement_prompt,
-                    "image": original_image,
-                    "strength": strength,
-                    "num_inference_steps": steps,
-                    "guidance_scale": guidance,
-                    "generator": generator
-                }
-            else:
-                # Fallback for SDXS if it doesn't have img2img
-                # We'll try to use it as img2img anyway
-                try:
-                    # Attempt to create img2img pipeline from existing components
-                    from diffusers import StableDiffusionImg2ImgPipeline
-                    img2img_pipeline = StableDiffusionImg2ImgPipeline(
-                        vae=pipeline.vae,
-                        text_encoder=pipeline.text_encoder,
-                        tokenizer=pipeline.tokenizer,
-                        unet=pipeline.unet,
-                        scheduler=pipeline.scheduler,
-                        safety_checker=None,
-                        feature_extractor=pipeline.feature_extractor if hasattr(pipeline, 'feature_extractor') else None,
-                    )
-                    img2img_pipeline = img2img_pipeline.to(self.device)
-                    
-                    gen_params = {
-                        "prompt": refinement_prompt,
-                        "image": original_image,
-                        "strength": strength,
-                        "num_inference_steps": steps,
-                        "guidance_scale": guidance,
-                        "generator": generator
-                    }
-                    pipeline = img2img_pipeline
-                except Exception as e:
-                    logger.error(f"Could not create img2img pipeline from SDXS: {e}")
-                    raise Exception("SDXS model does not support image refinement. Please use Small SD V0.")
+            gen_params = {
+                "image": init_latents,
+                "strength": strength,
+                "num_inference_steps": steps,
+                "guidance_scale": guidance,
+                "generator": generator
+            }
             
-            # Generate refined image
-            with torch.inference_mode():
-                result = pipeline(**gen_params)
+            # Generate refined image on the inference thread, reusing cached prompt embeddings
+            embeds = await self.executor.submit(
+                self.prompt_cache.encode,
+                repo_id,
+                pipeline,
+                [refinement_prompt],
+                [negative_prompt],
+                guidance
+            )
+            result = await self.executor.run_pipeline(pipeline, progress=[progress], **gen_params, **embeds)
             
             refined_image = result.images[0]
             
-            # Save refined image
-            filename = f"refined_{uuid.uuid4()}.png"
-            refined_image_path = self.refined_images_dir / filename
-            refined_image.save(refined_image_path)
+            # Queue refined image for saving, it is served from memory until written
+            refined_image_path = await self.image_store.save(
+                refined_image,
+                self.refined_images_dir,
+                f"refined_{uuid.uuid4()}",
+                parent=original_image_filename,
+                params={
+                    "kind": "refine",
+                    "modelType": model_type,
+                    "repoId": repo_id,
+                    "prompt": refinement_prompt,
+                    "negativePrompt": negative_prompt,
+                    "strength": strength,
+                    "steps": steps,
+                    "guidance": guidance,
+                    "seed": seed,
+                    "vae": ("large" if pool_type == "sdxs-img2img-vae_large" else "fast") if model_type == "sdxs" else None
+                }
+            )
             
-            logger.info(f"Refined image saved to {refined_image_path}")
+            logger.info(f"Refined image queued for {refined_image_path}")
             return str(refined_image_path)
             
         except Exception as e:
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+def model_fingerprint(model_path: Path) -> str:
+    """Cheap identity of a local checkpoint: names, sizes and mtimes of its weight files.
+    
+    Re-downloading or re-converting a model changes it, so results cached
+    for the old weights stop matching.
+    """
+    if not model_path.is_dir():
+        return "remote"
+    digest = hashlib.sha256()
+    for path in sorted(model_path.rglob("*.safetensors")):
+        stat = path.stat()
+        digest.update(f"{path.relative_to(model_path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:16]
+
+class ResultCache:
+    """Content-addressed index from deterministic requests to images already on disk.
+    
+    A key is the SHA-256 of the normalized request parameters and the
+    model identity, so only seeded requests are cacheable. The index lives
+    in SQLite and survives restarts. Least recently used entries are evicted
+    once there are more than ``max_entries`` or the images they point to
+    exceed ``max_bytes``. Evicting an entry only forgets it; the image stays
+    where it is. ``locate`` maps a stored path to the image's current one,
+    and entries whose image has since been deleted are dropped on lookup.
+    """
+    
+    def __init__(
+        self,
+        path: Path,
+        root: Path,
+        max_entries: int = 10000,
+        max_bytes: int = 0,
+        locate: Optional[Callable[[Path], Optional[Path]]] = None
+    ):
+        self.path = path
+        self.root = root  # Image paths under it are stored relative to it
+        self.max_entries = max_entries  # 0 means unbounded
+        self.max_bytes = max_bytes
+        self.locate = locate or (lambda path: path if path.is_file() else None)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY, path TEXT NOT NULL, bytes INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            self._entries, self._bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM results"
+            ).fetchone()
+        logger.info(
+            f"Result cache at {path}: {self._entries} entries, max_entries={max_entries}, "
+            f"max_bytes={max_bytes}"
+        )
+    
+    @staticmethod
+    def key(kind: str, model: dict, **params) -> str:
+        """Hash a request; prompts are whitespace-normalized and missing negatives equal empty ones."""
+        normalized = {}
+        for name, value in params.items():
+            if name.endswith("prompt"):
+                value = " ".join((value or "").split())
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and name != "seed":
+                # 4 and 4.0 are the same guidance
+                value = float(value)
+            normalized[name] = value
+        payload = json.dumps({"kind": kind, "model": model, "params": normalized}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+    
+    def get(self, key: str) -> Optional[Path]:
+        """Image path for a key, or None on a miss."""
+        with self._lock:
+            row = self._conn.execute("SELECT path, bytes FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                path = self.locate(self.root / row[0])
+                if path is not None:
+                    self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self.hits += 1
+                    return path
+                # The image was removed behind the cache's back
+                self._delete(key, row[1])
+            self.misses += 1
+            return None
+    
+    def put(self, key: str, path: Path, size: int):
+        """Record the image produced for a key; ``size`` is its encoded byte count."""
+        now = time.time()
+        try:
+            stored = str(path.relative_to(self.root))
+        except ValueError:
+            stored = str(path)
+        with self._lock:
+            previous = self._conn.execute("SELECT bytes FROM results WHERE key = ?", (key,)).fetchone()
+            if previous is not None:
+                self._delete(key, previous[0])
+            self._conn.execute(
+                "INSERT INTO results (key, path, bytes, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, stored, size, now, now)
+            )
+            self._entries += 1
+            self._bytes += size
+            self._evict()
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._entries,
+            "bytes": self._bytes,
+            "maxEntries": self.max_entries,
+            "maxBytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions
+        }
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    
+    def _delete(self, key: str, size: int):
+        self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+        self._entries -= 1
+        self._bytes -= size
+    
+    def _evict(self):
+        while (
+            (self.max_entries and self._entries > self.max_entries)
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            row = self._conn.execute("SELECT key, bytes FROM results ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                return
+            self._delete(*row)
+            self.evictions += 1
@@ -0,0 +1,114 @@
+import logging
+import time
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from services.inference_executor import InferenceExecutor
+from services.metrics import metrics
+from services.prompt_cache import PromptEmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+WARMUP_PROMPT = "warmup"
+
+class ModelWarmup:
+    """Runs dummy generations after a model loads so real traffic never hits it cold.
+    
+    Each configured (size, batch size) pair goes through the same path as a
+    batched request: cached prompt encoding, then a pipeline call on the
+    inference thread. That primes the allocator, kernel selection and, with
+    ``CPU_COMPILE``, the compiled graph for every shape real requests use.
+    A model counts as warming until its pass completes, which keeps the
+    readiness check false meanwhile.
+    """
+    
+    def __init__(
+        self,
+        executor: InferenceExecutor,
+        prompt_cache: PromptEmbeddingCache,
+        sizes: Sequence[str] = ("512x512",),
+        batch_sizes: Sequence[int] = (1,),
+        steps: int = 1,
+        guidance: float = 4.0
+    ):
+        self.executor = executor
+        self.prompt_cache = prompt_cache
+        self.sizes = list(sizes)
+        self.batch_sizes = list(batch_sizes)
+        self.steps = max(1, steps)
+        self.guidance = guidance
+        self._warming: Set[str] = set()
+        self._reports: Dict[str, dict] = {}
+        logger.info(f"Model warmup: sizes={self.sizes}, batch_sizes={self.batch_sizes}, steps={self.steps}")
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sizes and self.batch_sizes)
+    
+    def is_warming(self, repo_id: Optional[str]) -> bool:
+        return repo_id in self._warming
+    
+    def report(self, repo_id: Optional[str]) -> Optional[dict]:
+        """Outcome and per-shape cost of the latest warmup of a model."""
+        return self._reports.get(repo_id)
+    
+    async def warm(self, repo_id: str, pipelines: List[Tuple[str, object]]) -> dict:
+        """Warm ``(vae, pipeline)`` pairs of a model for every configured shape.
+        
+        Failures are reported rather than raised: a model that could not be
+        warmed still serves requests, just slowly at first.
+        """
+        report = {
+            "repoId": repo_id,
+            "status": "warming",
+            "startedAt": time.time(),
+            "totalSeconds": 0.0,
+            "runs": [],
+            "error": None
+        }
+        self._reports[repo_id] = report
+        if not self.enabled:
+            report["status"] = "skipped"
+            return report
+        
+        self._warming.add(repo_id)
+        start = time.perf_counter()
+        try:
+            for vae, pipeline in pipelines:
+                for size in self.sizes:
+                    for batch_size in self.batch_sizes:
+                        seconds = await self._run(repo_id, pipeline, size, batch_size)
+                        metrics.observe_stage("warmup", seconds, size=size, batch_size=batch_size, vae=vae)
+                        report["runs"].append({"vae": vae, "size": size, "batchSize": batch_size, "seconds": seconds})
+                        logger.info(f"Warmed {repo_id} ({vae} VAE) at {size} x{batch_size} in {seconds:.2f}s")
+            report["status"] = "completed"
+        except Exception as e:
+            logger.warning(f"Warmup of {repo_id} failed: {e}")
+            report["status"] = "failed"
+            report["error"] = str(e)
+        finally:
+            report["totalSeconds"] = time.perf_counter() - start
+            self._warming.discard(repo_id)
+        
+        logger.info(f"Warmup of {repo_id} finished in {report['totalSeconds']:.1f}s")
+        return report
+    
+    async def _run(self, repo_id: str, pipeline, size: str, batch_size: int) -> float:
+        width, height = map(int, size.split("x"))
+        start = time.perf_counter()
+        embeds = await self.executor.submit(
+            self.prompt_cache.encode,
+            repo_id,
+            pipeline,
+            [WARMUP_PROMPT] * batch_size,
+            [None] * batch_size,
+            self.guidance
+        )
+        await self.executor.run_pipeline(
+            pipeline,
+            num_inference_steps=self.steps,
+            width=width,
+            height=height,
+            guidance_scale=self.guidance,
+            **embeds
+        )
+        return time.perf_counter() - start
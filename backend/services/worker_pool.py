@@ -0,0 +1,444 @@
+import asyncio
+import copy
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import psutil
+import torch
+from PIL import Image
+
+from services.background import spawn
+from services.cpu_profile import CpuPerformanceProfile
+from services.fast_load import PipelineSnapshots
+from services.inference_executor import InferenceExecutor
+from services.metrics import metrics
+from services.model_loader import ModelLoader
+from services.model_pool import ModelPool
+from services.previews import InferenceCancelled, StepProgress
+from services.prompt_cache import PromptEmbeddingCache
+from services.warmup import ModelWarmup
+
+logger = logging.getLogger(__name__)
+
+class _WorkerHandle:
+    """Supervisor-side state of one worker process."""
+    
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.Process] = None
+        self.requests = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+        self.crashes = 0  # Exits since the last answered call, for restart backoff
+        self.spawned_at = 0.0
+        self.models: Set[str] = set()  # Repos loaded and warmed in this worker
+    
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+    
+    def stats(self) -> dict:
+        memory = None
+        if self.alive:
+            try:
+                info = psutil.Process(self.process.pid).memory_full_info()
+                memory = {"rssBytes": info.rss, "ussBytes": info.uss, "pssBytes": getattr(info, "pss", None)}
+            except psutil.Error:
+                pass
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process is not None else None,
+            "alive": self.alive,
+            "inFlight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "restarts": self.restarts,
+            "models": sorted(self.models),
+            "memory": memory
+        }
+
+class InferenceWorkerPool:
+    """Generation worker processes that share one copy of the model weights.
+    
+    Each worker loads models from their serving-dtype snapshot, which it
+    memory-maps read-only, so the weights sit once in the page cache however
+    many workers map them. Generation batches go to the worker with the
+    fewest calls in flight, letting a multi-core host run several
+    generations in parallel. Workers that die fail their pending calls and
+    are restarted; models are reloaded on demand.
+    """
+    
+    def __init__(
+        self,
+        num_workers: int,
+        snapshots_dir: Path,
+        local_path: Callable[[str], Path],
+        cpu_profile: CpuPerformanceProfile,
+        threads_per_worker: int = 0,
+        load_large_vae: bool = True,
+        pool_budget_bytes: int = 0,
+        prompt_cache_entries: int = 256,
+        prompt_cache_bytes: int = 64 * 1024 * 1024,
+        warmup_sizes: Optional[List[str]] = None,
+        warmup_batch_sizes: Optional[List[int]] = None,
+        warmup_steps: int = 1,
+        warmup_vaes: Optional[List[str]] = None
+    ):
+        self.num_workers = num_workers
+        self.local_path = local_path
+        # Split the cores between workers unless told otherwise
+        worker_profile = copy.copy(cpu_profile)
+        worker_profile.intra_op_threads = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        if worker_profile.channels_last or worker_profile.torch_compile:
+            # Both rewrite the weights into private memory, which undoes sharing the snapshot mapping
+            logger.warning("CPU_CHANNELS_LAST and CPU_COMPILE are ignored in inference workers")
+            worker_profile.channels_last = False
+            worker_profile.torch_compile = False
+        self.settings = {
+            "snapshots_dir": snapshots_dir,
+            "cpu_profile": worker_profile,
+            "load_large_vae": load_large_vae,
+            "pool_budget_bytes": pool_budget_bytes,
+            "prompt_cache_entries": prompt_cache_entries,
+            "prompt_cache_bytes": prompt_cache_bytes,
+            "warmup_sizes": warmup_sizes or [],
+            "warmup_batch_sizes": warmup_batch_sizes or [],
+            "warmup_steps": warmup_steps,
+            "warmup_vaes": warmup_vaes or ["fast"]
+        }
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_WorkerHandle(index) for index in range(num_workers)]
+        self._responses = None
+        self._pending: Dict[int, Tuple[asyncio.Future, _WorkerHandle, List[Optional[StepProgress]]]] = {}
+        self._call_ids = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+        self._stopping = False
+    
+    def start(self):
+        """Spawn the workers; call from the event loop at startup."""
+        self._loop = asyncio.get_running_loop()
+        self._responses = self._context.Queue()
+        for worker in self._workers:
+            self._spawn(worker)
+        self._reader = threading.Thread(target=self._read_responses, name="worker-responses", daemon=True)
+        self._reader.start()
+        logger.info(
+            f"Started {self.num_workers} inference workers with "
+            f"{self.settings['cpu_profile'].intra_op_threads} threads each"
+        )
+    
+    async def load(self, repo_id: str):
+        """Load (and warm) a model in every worker."""
+        await asyncio.gather(*(self._load(worker, repo_id) for worker in self._workers))
+    
+    def is_loaded(self, repo_id: Optional[str]) -> bool:
+        return all(worker.alive and repo_id in worker.models for worker in self._workers)
+    
+    async def generate(
+        self,
+        repo_id: str,
+        vae: str,
+        prompts: List[str],
+        negative_prompts: List[Optional[str]],
+        seeds: List[int],
+        width: int,
+        height: int,
+        steps: int,
+        guidance: float,
+        progress: List[Optional[StepProgress]]
+    ) -> List[Image.Image]:
+        """Run one generation batch on the least busy worker."""
+        if progress and all(p is not None and p.cancelled for p in progress):
+            raise InferenceCancelled("Generation cancelled")
+        worker = min(self._workers, key=lambda w: (not w.alive, w.in_flight, w.index))
+        images = await self._call(
+            worker,
+            "generate",
+            progress,
+            repo_id=repo_id,
+            model_path=str(self.local_path(repo_id)),
+            vae=vae,
+            prompts=prompts,
+            negative_prompts=negative_prompts,
+            seeds=seeds,
+            width=width,
+            height=height,
+            steps=steps,
+            guidance=guidance,
+            preview_every=[p.preview_every if p is not None and p.on_preview is not None else 0 for p in progress]
+        )
+        worker.models.add(repo_id)
+        return images
+    
+    def in_flight(self) -> int:
+        return sum(worker.in_flight for worker in self._workers)
+    
+    def stats(self) -> dict:
+        return {
+            "workers": [worker.stats() for worker in self._workers],
+            "threadsPerWorker": self.settings["cpu_profile"].intra_op_threads
+        }
+    
+    def shutdown(self):
+        """Stop the workers, letting running calls finish."""
+        self._stopping = True
+        for worker in self._workers:
+            if worker.requests is not None:
+                worker.requests.put(("stop", None, None))
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout=10)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+        logger.info("Inference workers stopped")
+    
+    async def _load(self, worker: _WorkerHandle, repo_id: str):
+        await self._call(worker, "load", None, repo_id=repo_id, model_path=str(self.local_path(repo_id)))
+        worker.models.add(repo_id)
+    
+    async def _reload(self, worker: _WorkerHandle, repo_ids: List[str]):
+        # Readiness requires every worker to hold the active model, so bring it back eagerly
+        for repo_id in repo_ids:
+            try:
+                await self._load(worker, repo_id)
+            except Exception as e:
+                logger.error(f"Could not reload {repo_id} in worker {worker.index}: {e}")
+    
+    async def _call(
+        self,
+        worker: _WorkerHandle,
+        kind: str,
+        progress: Optional[List[Optional[StepProgress]]],
+        **payload
+    ):
+        call_id = next(self._call_ids)
+        future = self._loop.create_future()
+        progress = progress or []
+        self._pending[call_id] = (future, worker, progress)
+        for p in progress:
+            if p is not None:
+                p.add_cancel_callback(functools.partial(self._cancel_if_abandoned, call_id))
+        
+        worker.in_flight += 1
+        start = time.perf_counter()
+        worker.requests.put((kind, call_id, payload))
+        try:
+            result = await future
+            worker.completed += 1
+            worker.crashes = 0
+            return result
+        except Exception:
+            worker.failed += 1
+            raise
+        finally:
+            worker.in_flight -= 1
+            self._pending.pop(call_id, None)
+            metrics.observe_stage("worker_call", time.perf_counter() - start, kind=kind, worker=worker.index)
+    
+    def _cancel_if_abandoned(self, call_id: int):
+        # Same rule as the in-process executor: stop only once every sample is cancelled
+        pending = self._pending.get(call_id)
+        if pending is None:
+            return
+        _, worker, progress = pending
+        if all(p is not None and p.cancelled for p in progress):
+            worker.requests.put(("cancel", call_id, None))
+    
+    def _spawn(self, worker: _WorkerHandle):
+        worker.requests = self._context.Queue()
+        worker.models.clear()
+        worker.spawned_at = time.monotonic()
+        worker.process = self._context.Process(
+            target=_worker_main,
+            args=(worker.index, self.settings, worker.requests, self._responses),
+            name=f"inference-worker-{worker.index}",
+            daemon=True
+        )
+        worker.process.start()
+    
+    def _read_responses(self):
+        last_check = time.monotonic()
+        while not self._stopping:
+            try:
+                message = self._responses.get(timeout=1.0)
+                self._loop.call_soon_threadsafe(self._dispatch, message)
+            except queue.Empty:
+                pass
+            except (EOFError, OSError):
+                break
+            if time.monotonic() - last_check >= 1.0:
+                last_check = time.monotonic()
+                self._loop.call_soon_threadsafe(self._check_workers)
+    
+    def _dispatch(self, message: tuple):
+        kind, call_id, payload = message
+        pending = self._pending.get(call_id)
+        if pending is None:
+            return
+        future, _, progress = pending
+        if kind == "preview":
+            index, step, total_steps, image = payload
+            if index < len(progress) and progress[index] is not None and progress[index].on_preview is not None:
+                progress[index].on_preview(step, total_steps, image)
+        elif future.done():
+            return
+        elif kind == "result":
+            future.set_result(payload)
+        elif kind == "cancelled":
+            future.set_exception(InferenceCancelled(payload))
+        else:
+            future.set_exception(Exception(payload))
+    
+    def _check_workers(self):
+        if self._stopping:
+            return
+        for worker in self._workers:
+            if worker.process is None or worker.alive:
+                continue
+            for future, owner, _ in list(self._pending.values()):
+                if owner is worker and not future.done():
+                    future.set_exception(Exception(f"Inference worker {worker.index} exited"))
+            # Back off when a worker keeps dying before it gets any work done
+            if time.monotonic() - worker.spawned_at < min(60, 2 ** worker.crashes):
+                continue
+            logger.error(f"Inference worker {worker.index} exited with code {worker.process.exitcode}, restarting it")
+            worker.crashes += 1
+            worker.restarts += 1
+            models = list(worker.models)
+            self._spawn(worker)
+            spawn(self._reload(worker, models), f"reload of inference worker {worker.index}")
+
+def _worker_main(index: int, settings: dict, requests, responses):
+    """Entry point of a worker process."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - worker {index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(_InferenceWorker(index, settings, requests, responses).serve())
+
+class _InferenceWorker:
+    """Model loading and generation inside a worker process, using the same services as the server."""
+    
+    def __init__(self, index: int, settings: dict, requests, responses):
+        self.index = index
+        self.requests = requests
+        self.responses = responses
+        cpu_profile = settings["cpu_profile"]
+        cpu_profile.apply_threads()
+        self.model_loader = ModelLoader(
+            ModelPool(budget_bytes=settings["pool_budget_bytes"]),
+            load_large_vae=settings["load_large_vae"],
+            cpu_profile=cpu_profile,
+            snapshots=PipelineSnapshots(settings["snapshots_dir"])
+        )
+        self.executor = InferenceExecutor(cpu_profile, self.model_loader.model_pool)
+        self.prompt_cache = PromptEmbeddingCache(settings["prompt_cache_entries"], settings["prompt_cache_bytes"])
+        self.warmup = ModelWarmup(
+            self.executor,
+            self.prompt_cache,
+            sizes=settings["warmup_sizes"],
+            batch_sizes=settings["warmup_batch_sizes"],
+            steps=settings["warmup_steps"]
+        )
+        self.warmup_vaes = settings["warmup_vaes"]
+        self._progress: Dict[int, List[StepProgress]] = {}
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+    
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        logger.info(f"Inference worker {self.index} ready (pid {os.getpid()})")
+        while True:
+            kind, call_id, payload = await loop.run_in_executor(None, self.requests.get)
+            if kind == "stop":
+                break
+            if kind == "cancel":
+                for progress in self._progress.get(call_id, []):
+                    progress.cancel()
+                continue
+            spawn(self._handle(kind, call_id, payload), f"worker {kind} call {call_id}")
+        self.executor.shutdown()
+    
+    async def _handle(self, kind: str, call_id: int, payload: dict):
+        try:
+            if kind == "load":
+                result = await self._load(**payload)
+            elif kind == "generate":
+                result = await self._generate(call_id, **payload)
+            else:
+                raise ValueError(f"Unknown worker call: {kind}")
+            self.responses.put(("result", call_id, result))
+        except InferenceCancelled as e:
+            self.responses.put(("cancelled", call_id, str(e)))
+        except Exception as e:
+            logger.error(f"Worker {kind} call failed: {e}")
+            self.responses.put(("error", call_id, str(e)))
+    
+    async def _load(self, repo_id: str, model_path: str):
+        async with self._load_locks.setdefault(repo_id, asyncio.Lock()):
+            if self.model_loader.is_loaded(repo_id):
+                return
+            await self.model_loader.load_model(repo_id, Path(model_path), local_only=True)
+            self.prompt_cache.invalidate(repo_id)
+            pipelines = {}
+            for vae in self.warmup_vaes:
+                if vae == "large" and not self.model_loader.has_large_vae(repo_id):
+                    continue
+                pipeline = self.model_loader.get_pipeline(repo_id, vae=vae)
+                pipelines.setdefault(id(pipeline), (vae, pipeline))
+            await self.warmup.warm(repo_id, list(pipelines.values()))
+    
+    async def _generate(
+        self,
+        call_id: int,
+        repo_id: str,
+        model_path: str,
+        vae: str,
+        prompts: List[str],
+        negative_prompts: List[Optional[str]],
+        seeds: List[int],
+        width: int,
+        height: int,
+        steps: int,
+        guidance: float,
+        preview_every: List[int]
+    ) -> List[Image.Image]:
+        # A restarted worker, or one whose pool evicted the model, loads it on demand
+        await self._load(repo_id, model_path)
+        pipeline = self.model_loader.get_pipeline(repo_id, vae=vae)
+        
+        progress = [
+            StepProgress(functools.partial(self._send_preview, call_id, i) if every else None, every or 1)
+            for i, every in enumerate(preview_every)
+        ]
+        self._progress[call_id] = progress
+        try:
+            embeds = await self.executor.submit(
+                self.prompt_cache.encode, repo_id, pipeline, prompts, negative_prompts, guidance
+            )
+            result = await self.executor.run_pipeline(
+                pipeline,
+                progress=progress,
+                num_inference_steps=steps,
+                width=width,
+                height=height,
+                guidance_scale=guidance,
+                generator=[torch.Generator(device=self.model_loader.device).manual_seed(seed) for seed in seeds],
+                **embeds
+            )
+            return result.images
+        finally:
+            self._progress.pop(call_id, None)
+    
+    def _send_preview(self, call_id: int, index: int, step: int, total_steps: int, image: bytes):
+        self.responses.put(("preview", call_id, (index, step, total_steps, image)))
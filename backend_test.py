@@ -90,14 +90,36 @@ class SDXSAPITester:
             "POST",
             "model/prepare",
             200,
-            data={"modelCardUrl": "https://huggingface.co/IDKiro/sdxs-512-0.9"},
-            timeout=600  # 10 minutes timeout for model download
+            data={"modelCardUrl": "https://huggingface.co/IDKiro/sdxs-512-0.9"}
         )
         
-        if success and response.get('ok'):
-            print(f"   Model loaded: {response.get('repoId')}")
-            print(f"   Message: {response.get('message')}")
-            return True, response
+        if not (success and response.get('ok')):
+            return False, response
+        
+        # Preparation runs as a background job, poll until it finishes
+        job_id = response.get('jobId')
+        print(f"   Prepare job: {job_id}")
+        deadline = time.time() + 600  # 10 minutes timeout for model download
+        while time.time() < deadline:
+            success, job = self.run_test(
+                "Model Prepare - Job Status",
+                "GET",
+                f"model/prepare/{job_id}",
+                200
+            )
+            if not success:
+                return False, job
+            if job.get('status') == 'completed':
+                print(f"   Model loaded: {job.get('repoId')}")
+                print(f"   Message: {job.get('message')}")
+                return True, job
+            if job.get('status') == 'failed':
+                self.log_test("Model Prepare - Job Completed", False, job.get('error'))
+                return False, job
+            print(f"   Phase: {job.get('phase')}, {job.get('bytesDownloaded')}/{job.get('bytesTotal')} bytes")
+            time.sleep(5)
+        
+        self.log_test("Model Prepare - Job Completed", False, "Timed out waiting for prepare job")
         return False, response
 
     def test_generate_without_model(self):
@@ -194,9 +216,30 @@ class SDXSAPITester:
             timeout=600  # 10 minutes timeout for model download
         )
         
-        if success and response.get('ok'):
-            print(f"   Small SD V0 refiner loaded: {response.get('message')}")
-            return True
+        if not (success and response.get('ok')):
+            return False
+        
+        # Preparation runs as a background job, poll until it finishes
+        job_id = response.get('jobId')
+        deadline = time.time() + 600  # 10 minutes timeout for model download
+        while time.time() < deadline:
+            success, job = self.run_test(
+                "Refiner Prepare - Job Status",
+                "GET",
+                f"model/prepare/{job_id}",
+                200
+            )
+            if not success:
+                return False
+            if job.get('status') == 'completed':
+                print(f"   Small SD V0 refiner loaded: {job.get('message')}")
+                return True
+            if job.get('status') == 'failed':
+                self.log_test("Refiner Prepare - Job Completed", False, job.get('error'))
+                return False
+            time.sleep(5)
+        
+        self.log_test("Refiner Prepare - Job Completed", False, "Timed out waiting for prepare job")
         return False
 
     def test_refine_image_sdxs(self, original_filename):
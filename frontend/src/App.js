@@ -12,6 +12,11 @@ import { Loader2 } from 'lucide-react';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Resized WebP copies for the browser to pick from; the server makes them on first request
+const DISPLAY_WIDTHS = [256, 512];
+const IMAGE_SIZES = '(max-width: 900px) 100vw, 900px';
+const imageSrcSet = (url) => DISPLAY_WIDTHS.map((width) => `${url}?w=${width}&format=webp ${width}w`).join(', ');
+
 function App() {
   // Suppress ResizeObserver errors at component level
   useEffect(() => {
@@ -49,6 +54,45 @@ function App() {
   const [refinedImage, setRefinedImage] = useState(null);
   const [refinerStatusMessage, setRefinerStatusMessage] = useState('');
 
+  const pollPrepareJob = async (jobId, setMessage) => {
+    while (true) {
+      const { data: job } = await axios.get(`${API}/model/prepare/${jobId}`);
+      if (job.status === 'completed' || job.status === 'failed') {
+        return job;
+      }
+
+      if (job.phase === 'downloading' && job.bytesTotal) {
+        const percent = Math.floor((job.bytesDownloaded / job.bytesTotal) * 100);
+        setMessage(`Downloading model from HuggingFace... ${percent}% (${job.filesDone}/${job.filesTotal} files)`);
+      } else if (job.phase === 'loading') {
+        setMessage('Loading model into memory...');
+      } else if (job.phase === 'warming') {
+        setMessage('Warming up model...');
+      }
+
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  };
+
+  const pollInferenceJob = async (jobId, setMessage, label) => {
+    while (true) {
+      const { data: job } = await axios.get(`${API}/jobs/${jobId}`);
+      if (job.status === 'completed' || job.status === 'failed' || job.status === 'cancelled') {
+        return job;
+      }
+
+      if (job.status === 'queued' && job.queuePosition) {
+        setMessage(`${label} (queued, position ${job.queuePosition})`);
+      } else if (job.status === 'running' && job.totalSteps) {
+        setMessage(`${label} (step ${job.step} of ${job.totalSteps})`);
+      } else if (job.status === 'running') {
+        setMessage(`${label}...`);
+      }
+
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  };
+
   const handleFetchModel = async () => {
     if (!modelUrl.trim()) {
       toast.error('Please enter a model URL');
@@ -63,11 +107,16 @@ function App() {
         modelCardUrl: modelUrl
       });
 
-      if (response.data.ok) {
+      // Preparation runs as a background job on the server, poll until it finishes
+      const job = await pollPrepareJob(response.data.jobId, setStatusMessage);
+
+      if (job.status === 'completed') {
         setModelLoaded(true);
         setRefinerLoaded(prev => ({ ...prev, sdxs: true })); // SDXS refiner is auto-loaded
-        setStatusMessage(`✓ ${response.data.message}`);
+        setStatusMessage(`✓ ${job.message}`);
         toast.success('Model loaded successfully!');
+      } else {
+        throw new Error(job.error || 'Model preparation failed');
       }
     } catch (error) {
       console.error('Error loading model:', error);
@@ -90,21 +139,24 @@ function App() {
     setRefinedImage(null); // Reset refined image on new generation
     
     try {
-      const response = await axios.post(`${API}/generate`, {
+      const response = await axios.post(`${API}/jobs/generate`, {
         prompt: prompt,
         size: '512x512',
         steps: 8,
         guidance: 4.0
-      }, {
-        timeout: 120000 // 2 minute timeout
       });
 
-      if (response.data.ok) {
-        const imageUrl = `${BACKEND_URL}${response.data.imagePath}`;
+      // Generation runs as a background job, poll instead of holding the request open
+      const job = await pollInferenceJob(response.data.jobId, setStatusMessage, 'Generating image');
+
+      if (job.status === 'completed') {
+        const imageUrl = `${BACKEND_URL}${job.imagePath}`;
         setGeneratedImage(imageUrl);
-        setGeneratedImageFilename(response.data.filename);
-        setStatusMessage(`✓ Image generated: ${response.data.filename}`);
+        setGeneratedImageFilename(job.filename);
+        setStatusMessage(`✓ Image generated: ${job.filename}`);
         toast.success('Image generated successfully!');
+      } else {
+        throw new Error(job.error || 'Image generation failed');
       }
     } catch (error) {
       console.error('Error generating image:', error);
@@ -135,10 +187,15 @@ function App() {
           modelType: 'small-sd-v0'
         });
 
-        if (response.data.ok) {
+        // Preparation runs as a background job on the server, poll until it finishes
+        const job = await pollPrepareJob(response.data.jobId, setRefinerStatusMessage);
+
+        if (job.status === 'completed') {
           setRefinerLoaded(prev => ({ ...prev, 'small-sd-v0': true }));
-          setRefinerStatusMessage(`✓ ${response.data.message}`);
+          setRefinerStatusMessage('✓ Small SD V0 refiner loaded successfully');
           toast.success('Small SD V0 refiner loaded!');
+        } else {
+          throw new Error(job.error || 'Refiner preparation failed');
         }
       } catch (error) {
         console.error('Error loading refiner:', error);
@@ -166,22 +223,24 @@ function App() {
     setRefinerStatusMessage('Refining image... (this may take 30-60 seconds)');
     
     try {
-      const response = await axios.post(`${API}/refiner/refine`, {
+      const response = await axios.post(`${API}/jobs/refine`, {
         originalImageFilename: generatedImageFilename,
         refinementPrompt: refinementPrompt,
         modelType: selectedRefiner,
         strength: 0.75,
         steps: 20,
         guidance: 7.5
-      }, {
-        timeout: 120000 // 2 minute timeout
       });
 
-      if (response.data.ok) {
-        const refinedImageUrl = `${BACKEND_URL}${response.data.refinedImagePath}`;
+      const job = await pollInferenceJob(response.data.jobId, setRefinerStatusMessage, 'Refining image');
+
+      if (job.status === 'completed') {
+        const refinedImageUrl = `${BACKEND_URL}${job.imagePath}`;
         setRefinedImage(refinedImageUrl);
-        setRefinerStatusMessage(`✓ Image refined: ${response.data.filename}`);
+        setRefinerStatusMessage(`✓ Image refined: ${job.filename}`);
         toast.success('Image refined successfully!');
+      } else {
+        throw new Error(job.error || 'Image refinement failed');
       }
     } catch (error) {
       console.error('Error refining image:', error);
@@ -291,6 +350,8 @@ function App() {
               <img
                 data-testid="generated-image"
                 src={generatedImage}
+                srcSet={imageSrcSet(generatedImage)}
+                sizes={IMAGE_SIZES}
                 alt="Generated"
                 className="generated-image"
               />
@@ -390,6 +451,8 @@ function App() {
                   <img
                     data-testid="refined-image"
                     src={refinedImage}
+                    srcSet={imageSrcSet(refinedImage)}
+                    sizes={IMAGE_SIZES}
                     alt="Refined"
                     className="generated-image"
                   />
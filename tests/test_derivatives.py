@@ -0,0 +1,70 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from services.derivatives import DerivativeStore  # noqa: E402
+from services.image_cache import ImageCache  # noqa: E402
+from services.image_storage import ImageStorage  # noqa: E402
+from services.image_store import ImageStore  # noqa: E402
+
+DAY = 86400
+
+@pytest.fixture
+def stores(tmp_path):
+    images_dir = tmp_path / "images"
+    images_dir.mkdir()
+    image_cache = ImageCache()
+    derivative_store = None
+    
+    def forget(directory, filename):
+        # What the server does when retention deletes an image
+        image_cache.remove(directory / filename)
+        image_cache.remove(storage.shard_path(directory, filename))
+        derivative_store.remove(directory, filename)
+    
+    storage = ImageStorage(tmp_path / "images.sqlite3", [images_dir], max_age_days=1, on_delete=forget)
+    image_store = ImageStore(image_cache, storage=storage)
+    derivative_store = DerivativeStore(image_store, widths=[32])
+    yield images_dir, storage, derivative_store
+    derivative_store.shutdown()
+    image_store.shutdown()
+    storage.close()
+
+def write_flat_original(images_dir, storage, filename, age_days):
+    path = images_dir / filename
+    Image.new("RGB", (64, 64), "red").save(path)
+    storage.record(path, path.stat().st_size, created_at=time.time() - age_days * DAY)
+    return path
+
+def test_sweeping_a_flat_original_removes_its_derivatives(stores):
+    images_dir, storage, derivative_store = stores
+    original = write_flat_original(images_dir, storage, "legacy.png", age_days=2)
+    
+    derived = asyncio.run(derivative_store.load(images_dir, "legacy.png", 32, "webp"))
+    assert derived is not None
+    derived_path = derivative_store.path_for(images_dir, "legacy.png", 32, "webp")
+    assert derived_path.is_file()
+    # Derivatives sit beside the image's shard, not beside the flat original
+    assert derived_path.parent.parent != original.parent
+    
+    assert storage.sweep() == 1
+    assert not original.exists()
+    assert not derived_path.exists()
+    # The route answers 404 when load returns None
+    assert asyncio.run(derivative_store.load(images_dir, "legacy.png", 32, "webp")) is None
+
+def test_derivative_of_a_missing_original_is_not_served(stores):
+    images_dir, storage, derivative_store = stores
+    original = write_flat_original(images_dir, storage, "gone.png", age_days=0)
+    asyncio.run(derivative_store.load(images_dir, "gone.png", 32, "webp"))
+    
+    # Deleted behind the store's back, so the derivative file is left over
+    original.unlink()
+    assert derivative_store.path_for(images_dir, "gone.png", 32, "webp").is_file()
+    assert asyncio.run(derivative_store.load(images_dir, "gone.png", 32, "webp")) is None
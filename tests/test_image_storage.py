@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from services.image_storage import ImageStorage  # noqa: E402
+
+DAY = 86400
+
+@pytest.fixture
+def images_dir(tmp_path):
+    directory = tmp_path / "images"
+    directory.mkdir()
+    return directory
+
+def make_storage(tmp_path, images_dir, **kwargs):
+    deleted = []
+    storage = ImageStorage(
+        tmp_path / "images.sqlite3",
+        [images_dir],
+        on_delete=lambda directory, filename: deleted.append((directory, filename)),
+        **kwargs
+    )
+    return storage, deleted
+
+def write_image(storage, images_dir, filename, size, age_days=0.0):
+    path = storage.new_path(images_dir, filename)
+    path.write_bytes(b"x" * size)
+    storage.record(path, size, created_at=time.time() - age_days * DAY)
+    return path
+
+def test_sweep_deletes_images_past_max_age(tmp_path, images_dir):
+    storage, deleted = make_storage(tmp_path, images_dir, max_age_days=7)
+    old = write_image(storage, images_dir, "old.png", 10, age_days=8)
+    recent = write_image(storage, images_dir, "recent.png", 10, age_days=6)
+    
+    assert storage.sweep() == 1
+    assert not old.exists() and recent.exists()
+    assert deleted == [(images_dir.resolve(), "old.png")]
+    assert storage.stats()["images"] == 1
+    assert storage.stats()["bytes"] == 10
+
+def test_sweep_deletes_oldest_first_until_under_quota(tmp_path, images_dir):
+    storage, _ = make_storage(tmp_path, images_dir, max_bytes=250)
+    paths = [write_image(storage, images_dir, f"{i}.png", 100, age_days=3 - i) for i in range(4)]
+    
+    assert storage.sweep() == 2
+    assert [path.exists() for path in paths] == [False, False, True, True]
+    assert storage.stats()["bytes"] == 200
+
+def test_sweep_counts_expired_images_toward_quota(tmp_path, images_dir):
+    storage, _ = make_storage(tmp_path, images_dir, max_age_days=7, max_bytes=150)
+    expired = write_image(storage, images_dir, "expired.png", 100, age_days=10)
+    kept = write_image(storage, images_dir, "kept.png", 100, age_days=1)
+    
+    # Removing the expired image already fits the quota, so the recent one stays
+    assert storage.sweep() == 1
+    assert not expired.exists() and kept.exists()
+
+def test_sweep_skips_protected_images(tmp_path, images_dir):
+    storage, _ = make_storage(tmp_path, images_dir, max_age_days=1)
+    pending = write_image(storage, images_dir, "pending.png", 10, age_days=2)
+    
+    assert storage.sweep(is_protected=lambda path: path == pending) == 0
+    assert pending.exists()
+    assert storage.metadata("pending.png") is not None
+
+def test_reconcile_indexes_new_files_and_drops_missing_ones(tmp_path, images_dir):
+    storage, _ = make_storage(tmp_path, images_dir)
+    gone = write_image(storage, images_dir, "gone.png", 10)
+    gone.unlink()
+    untracked = storage.new_path(images_dir, "untracked.png")
+    untracked.write_bytes(b"x" * 5)
+    
+    storage.reconcile()
+    assert storage.metadata("gone.png") is None
+    metadata = storage.metadata("untracked.png")
+    assert metadata["bytes"] == 5
+    assert metadata["createdAt"] == pytest.approx(untracked.stat().st_mtime)
+    assert storage.stats()["images"] == 1
+
+def test_reconcile_indexes_flat_files_in_place_by_default(tmp_path, images_dir):
+    storage, _ = make_storage(tmp_path, images_dir)
+    flat = images_dir / "flat.png"
+    flat.write_bytes(b"x" * 5)
+    
+    storage.reconcile()
+    assert flat.exists()
+    assert storage.locate(images_dir, "flat.png") == flat
+    assert storage.metadata("flat.png")["bytes"] == 5
+    
+    # Reconciling again neither duplicates nor drops it
+    storage.reconcile()
+    assert storage.stats()["images"] == 1
+
+def test_reconcile_moves_flat_files_into_shards_when_migrating(tmp_path, images_dir):
+    storage, _ = make_storage(tmp_path, images_dir, migrate_flat=True)
+    (images_dir / "flat.png").write_bytes(b"x" * 5)
+    (images_dir / ".hidden").write_bytes(b"x")
+    
+    storage.reconcile()
+    sharded = storage.shard_path(images_dir, "flat.png")
+    assert sharded.exists() and sharded != images_dir / "flat.png"
+    assert not (images_dir / "flat.png").exists()
+    assert (images_dir / ".hidden").exists()
+    assert storage.locate(images_dir, "flat.png") == sharded
+    assert storage.metadata("flat.png")["path"] == os.path.relpath(sharded, tmp_path)